@@ -2,19 +2,38 @@ import matchingmarkets.agent
 import matchingmarkets.algorithms
 import matchingmarkets.metaalgorithms
 import matchingmarkets.market
+import matchingmarkets.graph
+import matchingmarkets.matrix
+import matchingmarkets.pool
 import matchingmarkets.simulations
 import matchingmarkets.generators
-import matchingmarkets.tests
 from matchingmarkets.agent import *
 from matchingmarkets.generators import *
 from matchingmarkets.generators.basic import *
 from matchingmarkets.metaalgorithms import *
 from matchingmarkets.algorithms import *
 from matchingmarkets.algorithms.basic import *
-from matchingmarkets.algorithms import pulp
 from matchingmarkets.market import *
+from matchingmarkets.graph import *
+from matchingmarkets.matrix import *
+from matchingmarkets.pool import *
 from matchingmarkets.simulations import simulation
-from matchingmarkets.tests import *
 
-__all__ = ["agent", "algorithms", "algorithms.*", "market", "metaalgorithms",
+__all__ = ["agent", "algorithms", "algorithms.*", "graph", "market",
+           "matrix",
+           "metaalgorithms", "pool",
            "simulations", "generators", "generators.*", "tests"]
+
+
+def __getattr__(name):
+    """
+    Loads pulp and the test suite on first use
+    Keeps `import matchingmarkets` cheap for process pool workers
+    """
+    import importlib
+    if name == "pulp":
+        return importlib.import_module(__name__ + ".algorithms.pulp")
+    if name in ("tests", "FullTest"):
+        tests = importlib.import_module(__name__ + ".tests")
+        return tests if name == "tests" else tests.FullTest
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -30,6 +30,11 @@ class Agent:
     UtilFct: fct(int) -> float
         may be overriden from default
     """
+    # No per-instance __dict__: markets keep every agent they create
+    __slots__ = ("name", "discount_rate", "time_to_critical", "type",
+                 "type2", "match_util", "match_fail_prob", "sojourn",
+                 "is_critical")
+
     def __init__(self, name=0, discount_rate=0, time_to_critical=0,
                  myType=1, myType2=None
                  ):
@@ -96,8 +101,62 @@ class Agent:
         returns list<mm.Agent.name>
         where match_fail_prob > 0
         """
+        # Matrix-backed maps scan their row directly
+        if hasattr(self.match_fail_prob, "neighbors"):
+            return self.match_fail_prob.neighbors()
         neighbors = [
             key for key in self.match_fail_prob.keys()
             if self.match_fail_prob[key] > 0
             ]
         return neighbors
+
+
+class AgentArrays:
+    """
+    Columns of a block of agents, used by batched generator functions
+    Attributes
+    ---------
+    name: np.array
+        agents' names
+    type: np.array
+        agents' types
+    type2: np.array
+        agents' second types
+    """
+    def __init__(self, name, myType, myType2):
+        self.name = name
+        self.type = myType
+        self.type2 = myType2
+
+    def __len__(self):
+        return len(self.name)
+
+    def take(self, rows):
+        """
+        AgentArrays of the agents at positions rows
+        """
+        return AgentArrays(self.name[rows], self.type[rows],
+                           self.type2[rows])
+
+    @classmethod
+    def from_agents(cls, Agents):
+        """
+        Builds the columns from a list of mm.Agent
+        """
+        return cls(np.array([a.name for a in Agents]),
+                   _column([a.type for a in Agents]),
+                   _column([a.type2 for a in Agents]))
+
+
+def _column(values):
+    """
+    1-d array of arbitrary (possibly non-scalar) values
+    """
+    try:
+        column = np.array(values)
+    except ValueError:
+        column = None
+    if column is None or column.ndim != 1:
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+    return column
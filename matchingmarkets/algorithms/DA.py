@@ -1,9 +1,12 @@
 import random
 import copy
+import heapq
+from collections import deque
 from copy import deepcopy
 import numpy as np
 from numpy.random import randn
 import networkx as nx
+from matchingmarkets.algorithms.bipartite import _sides
 
 
 """
@@ -14,21 +17,111 @@ Collection of variations on the Gale-Shapley Deffered Acceptance algo
 """
 
 
+def deferred_acceptance(proposer_prefs, acceptor_ranks, capacities=1,
+                        order=None):
+    """
+    Proposer-optimal deferred acceptance on preference arrays
+    Each proposer keeps a pointer to its next choice and acceptors
+        compare proposers by rank lookup, so the algorithm makes
+        at most one proposal per (proposer, acceptor) pair: O(n^2)
+    Acceptors with capacity c hold their c best proposals (heap)
+
+    Arguments
+    ---------
+    proposer_prefs: np.array of int (n_proposers, k)
+        acceptor indices in each proposer's decreasing preference
+        entries after the proposer's last acceptable acceptor are -1
+    acceptor_ranks: np.array of int (n_acceptors, n_proposers)
+        rank of each proposer for each acceptor, lower is preferred
+        negative if the acceptor never accepts the proposer
+    capacities: int or np.array of int (n_acceptors,)
+        number of proposers each acceptor can hold
+    order: list<int> or None
+        order in which proposers first propose
+        doesn't change the result, only the sequence of proposals
+    Returns
+    -------
+    np.array of int (n_proposers,)
+        acceptor of each proposer, -1 if unmatched
+    """
+    proposer_prefs = np.asarray(proposer_prefs).tolist()
+    acceptor_ranks = np.asarray(acceptor_ranks).tolist()
+    n_acceptors = len(acceptor_ranks)
+    capacities = np.broadcast_to(capacities, (n_acceptors,)).tolist()
+    if order is None:
+        order = range(len(proposer_prefs))
+    match = [-1] * len(proposer_prefs)
+    next_choice = [0] * len(proposer_prefs)
+    # max-heap of (-rank, proposer) held by each acceptor
+    held = [list() for j in range(n_acceptors)]
+    free = deque(order)
+    while free:
+        i = free.popleft()
+        prefs = proposer_prefs[i]
+        while next_choice[i] < len(prefs) and prefs[next_choice[i]] >= 0:
+            j = prefs[next_choice[i]]
+            next_choice[i] += 1
+            rank = acceptor_ranks[j][i]
+            if rank < 0 or capacities[j] < 1:
+                continue
+            if len(held[j]) < capacities[j]:
+                heapq.heappush(held[j], (-rank, i))
+                match[i] = j
+                break
+            worst_rank, worst = held[j][0]
+            if rank < -worst_rank:
+                # Acceptor trades its worst held proposer for i
+                heapq.heapreplace(held[j], (-rank, i))
+                match[i] = j
+                match[worst] = -1
+                free.append(worst)
+                break
+    return np.array(match, dtype=int)
+
+
+def _ranked(values, compatible, tiebreak):
+    """
+    Column indices of each row in decreasing order of values
+        ties broken by increasing tiebreak rank of the columns,
+        incompatible columns replaced by -1 at the end
+    """
+    keys = (np.broadcast_to(tiebreak, values.shape), -values, ~compatible)
+    order = np.lexsort(keys, axis=1)
+    ordered_compatible = np.take_along_axis(compatible, order, axis=1)
+    return np.where(ordered_compatible, order, -1)
+
+
+def _order_rank(agents, order):
+    """
+    Rank of each agent when sorted in increasing order of order(agent)
+    """
+    ranks = np.empty(len(agents), dtype=int)
+    ranks[sorted(range(len(agents)),
+                 key=lambda i: order(agents[i]))] = np.arange(len(agents))
+    return ranks
+
+
 def gale_shapley(Mrkt, Agents, verbose=False,
                  m=None, f=None,
                  m_order=lambda x: (x.time_to_critical - x.sojourn),
-                 f_order=lambda x: (x.time_to_critical - x.sojourn)
+                 f_order=lambda x: (x.time_to_critical - x.sojourn),
+                 capacity=1
                  ):
 
     """
     Gale-Shapley deffered acceptance algorithm
-    Agents sequentially propose their top preference according to an ordering
+    m-type agents propose to f-type agents, which defer acceptance
+    Returns the m-optimal stable matching
 
-    The ordering is a function f(agent) -> float
-    The agents are sorted in INCREASING order
-        of return value of the ordering fct
+    Agents of different sides are acceptable to each other if
+        either is a neighbor of the other
+    Each agent ranks the other side by expected match utility
+        (utility * success probability), from Mrkt.preferences
+    The orderings are functions f(agent) -> float; they break ties
+        in preferences in INCREASING order of return value,
+        and m_order sets the order of the first proposals
 
-    Proven Properties: Strategyproof
+    Proven Properties: Strategyproof (for the m side), Stable
 
     Arguments
     ---------
@@ -40,6 +133,7 @@ def gale_shapley(Mrkt, Agents, verbose=False,
         the type of the proposers (males in stable marriage)
     f: agent type or list<agent type>
         the type of the acceptors (females in stable marriage)
+        if only one of m, f is given, the other side is everyone else
     m_order: function(mm.Agent) -> Real
         a function that assigns a number to an agent
         Used to create the sorting on which agents are used
@@ -48,6 +142,12 @@ def gale_shapley(Mrkt, Agents, verbose=False,
         a function that assigns a number to an agent
         Used to create the sorting on which agents are used
         Default uses time left in the market before perishing
+    capacity: int, dict{agent.name: int} or function(mm.Agent) -> int
+        number of proposers each acceptor can take (school choice)
+        with capacities above 1, every proposer maps to its acceptor
+        and an acceptor maps to its preferred admitted proposer,
+        as the market holds one match per agent.
+        Use deferred_acceptance for the full assignment
     verbose: bool
         Whether algorithm prints information on action
     Returns
@@ -55,75 +155,50 @@ def gale_shapley(Mrkt, Agents, verbose=False,
     dict { agent.name : agent.name } of matches
     """
     if verbose:
-        print("\Gale-Shapley Deferred Acceptance Algorithm\n")
+        print("\nGale-Shapley Deferred Acceptance Algorithm\n")
         print("Agents to match ", [a.name for a in Agents], "\n")
 
     # Get males and females for bipartite graph
-    agentTypes = set([a.type for a in Agents])
-    if m is None and f is None:
-        print("\nERROR: Gale-Shapley running without \
-                defined males and female agent types")
-        return
-    if type(m) is not list:
-        m = [m]
-    if type(f) is not list:
-        f = [f]
-    if len(m) == 0:
-        m = [a for a in agentTypes if a not in f]
-    if len(f) == 0:
-        f = [a for a in agentTypes if a not in m]
-    if verbose:
-        print("\nMales: ", [a.name for a in m])
-        print("\nFemales: ", [a.name for a in f])
-
-    # Sort Agents
-    m.sort(key=m_order)
-    f.sort(key=f_order)
+    men, fem = _sides(Agents, m, f)
     if verbose:
-        print("\nSorted Males ", m)
-        print("\nSorted Females ", f)
-
-    # copy list of agents to match to delete on while iterating
-    men = [a for a in Agents if a.name in m]
-    fem = [a for a in Agents if a.name in f]
-
-    # track rejections for males
-    rejections = dict()
-    for a in m:
-        rejections[a] = []
+        print("\nMales: ", [a.name for a in men])
+        print("\nFemales: ", [a.name for a in fem])
+    if len(men) == 0 or len(fem) == 0:
+        return dict()
+
+    # Ranked preference arrays, computed once
+    util, prob = Mrkt.preferences(men, fem)
+    util_back, prob_back = Mrkt.preferences(fem, men)
+    compatible = (prob > 0) | (prob_back.T > 0)
+    m_rank = _order_rank(men, m_order)
+    f_rank = _order_rank(fem, f_order)
+    men_prefs = _ranked(util * prob, compatible, f_rank)
+    fem_prefs = _ranked(util_back * prob_back, compatible.T, m_rank)
+    # Inverse of the acceptors' lists: rank of each proposer
+    fem_ranks = np.full(fem_prefs.shape, -1)
+    rows, cols = np.nonzero(fem_prefs >= 0)
+    fem_ranks[rows, fem_prefs[rows, cols]] = cols
+
+    if callable(capacity):
+        capacities = [capacity(a) for a in fem]
+    elif isinstance(capacity, dict):
+        capacities = [capacity.get(a.name, 1) for a in fem]
+    else:
+        capacities = capacity
+    match = deferred_acceptance(men_prefs, fem_ranks, capacities,
+                                order=np.argsort(m_rank).tolist())
 
     matches = dict()  # Return value of the algorithm
-
-    iter_num = 0
-    # While unmatched persons, iterate
-    while len(matches) != len(men) and len(matches) != len(fem):
-        iter_num += 1
-        if verbose:
-            print("\n\n-------------------\G-S Iteration ", iter_num)
-
-        # dict of proposals from men to women
-        # for this iteration
-        proposals = {}
-
-        # men propose
-        for man in men:
-            potential_matches = {f_name: man.match_util[f_name]
-                                 for f_name in fem
-                                 if f_name not in rejections[man]}
-            proposals[man] = max(potential_matches, key=potential_matches.get)
-
-        # woman choose the top proposition
-        for woman in fem:
-            myproposals = {man: proposals[man] for man, v in proposals
-                           if proposals[man] == woman}
-            my_preferred = max(myproposals, key=myproposals.get)
-            matches[woman.name] = my_preferred.name
-            matches[my_preferred.name] = woman.name
-
-            for loser in myproposals:
-                if loser != my_preferred:
-                    rejections[loser].append(woman)
-
+    best = dict()  # Acceptors keep their preferred admitted proposer
+    for i, j in enumerate(match.tolist()):
+        if j < 0:
+            continue
+        matches[men[i].name] = fem[j].name
+        if j not in best or fem_ranks[j, i] < fem_ranks[j, best[j]]:
+            best[j] = i
+    for j, i in best.items():
+        matches[fem[j].name] = men[i].name
     if verbose:
+        print("Matches ", matches)
         print("\n\n++++++\nGale-Shapley Done\n+++++++\n\n")
     return matches
@@ -90,71 +90,72 @@ def TTC(Mrkt, Agents, verbose=False):
     Preferences are weighed by expected utility
     That is, utility of 10 with 50% success rate
     is weighed as 5 utils by agent in ranking
+    Only neighbors among Agents are ranked, an agent
+    matched to itself needs itself as neighbor
 
-    NOTE: Algorithm not guaranteed to be deterministic
-          if preferences are not strict
+    Each agent's preferences are sorted once, then a pointer
+        skips the agents already matched or left out
+    Cycles are found by an iterative walk on the graph of
+        top choices: an agent stays on the walk until it's removed,
+        so the run is O(n log n + total # of neighbors)
+
+    NOTE: ties in preferences are broken by order in Agents
     """
+    names = [a.name for a in Agents]
+    position = {name: i for i, name in enumerate(names)}
+    # Sorted once, decreasing expected utility
+    prefs = list()
+    for agent in Agents:
+        ranked = [(-agent.match_util[name] * prob, position[name])
+                  for name, prob in agent.match_fail_prob.items()
+                  if prob > 0 and name in position]
+        ranked.sort()
+        prefs.append([j for _, j in ranked])
+    pointer = [0] * len(Agents)
+    removed = [False] * len(Agents)
+    path_index = [-1] * len(Agents)  # position on the walk, -1 if off it
+
+    def top(i):
+        """
+        Top choice of i among remaining agents, -1 if none left
+        """
+        choices = prefs[i]
+        k = pointer[i]
+        while k < len(choices) and removed[choices[k]]:
+            k += 1
+        pointer[i] = k
+        return choices[k] if k < len(choices) else -1
+
     matched = dict()
-    to_match = list(Agents)
-    iter_num = 0
-    # While agents unmatched, iterate
-    while len(to_match) > 0:
-        iter_num += 1
-        to_match_names = [a.name for a in to_match]
-
-        if verbose:
-            print("\n\n-------------------\nTTC Iteration ",
-                  iter_num, "\n\tTo Match", to_match_names)
-
-        preference_graph = dict()
-
-        # If no neighbors, remove
-        for agent in reversed(to_match):
-            if len(set(agent.neighbors()).intersection(to_match_names)) == 0:
-                to_match.remove(agent)
-                to_match_names.remove(agent.name)
+    path = list()
+    for start in range(len(Agents)):
+        if removed[start]:
+            continue
+        path_index[start] = 0
+        path.append(start)
+        while path:
+            i = path[-1]
+            j = top(i)
+            if j < 0:
+                # No one left to trade with
+                removed[i] = True
+                path_index[i] = -1
+                path.pop()
                 if verbose:
-                    print("\tremoved agent ", agent.name)
-        # Now, get preferences and form graph
-        for agent in to_match:
-            # Sort preferences in decreasing order
-            preferenceList = sorted(agent.match_util,
-                                    key=lambda k: agent.match_util[k] *
-                                    agent.match_fail_prob[k],
-                                    reverse=True)
-            # Add top available preference to graph
-            for preference in preferenceList:
-                if preference in to_match_names:
-                    preference_graph[agent.name] = [preference]
-                    break
-
-        if verbose:
-            print("\n\nPreference Graph\n\t", preference_graph)
-
-        # Find cycles in graph
-        cycles = strongly_connected_components(preference_graph)
-
-        if verbose:
-            print("\n\nCycles\n\t", cycles)
-
-        for cycle in cycles:
-            # if cycle singleton, add to match if pointing to self
-            if len(cycle) == 1:
-                if preference_graph[cycle[0]] == [cycle[0]]:
-                    matched[cycle[0]] = cycle[0]
-                    to_remove_index = np.inf
-                    for i in range(len(to_match)):
-                        if to_match[i].name == cycle[0]:
-                            to_remove_index = i
-                            del to_match[to_remove_index]
-                            break
-                continue
-            # else add members of cycle to result and clean to_match up
-            for i in range(len(cycle)):
-                matched[cycle[i-1]] = cycle[i]
-            for i in range(len(cycle)):
-                for agent in to_match:
-                    if agent.name == cycle[i]:
-                        to_match.remove(agent)
+                    print("\tremoved agent ", names[i])
+            elif path_index[j] >= 0:
+                # Walk came back to j: trade along the cycle
+                cycle = path[path_index[j]:]
+                del path[path_index[j]:]
+                for k in range(len(cycle)):
+                    matched[names[cycle[k-1]]] = names[cycle[k]]
+                for k in cycle:
+                    removed[k] = True
+                    path_index[k] = -1
+                if verbose:
+                    print("\tcycle ", [names[k] for k in cycle])
+            else:
+                path_index[j] = len(path)
+                path.append(j)
 
     return matched
@@ -2,7 +2,18 @@ from matchingmarkets.algorithms import *
 from matchingmarkets.algorithms.basic import *
 from matchingmarkets.algorithms.TTC import *
 from matchingmarkets.algorithms.DA import *
-from matchingmarkets.algorithms import pulp
+from matchingmarkets.algorithms.bipartite import *
+from matchingmarkets.algorithms.kidney_solvers import *
 
-# Kidney Solvers not implmented yet
-__all__ = ["basic", "TTC", "pulp", "DA"] #, "kidney_solvers"]
+
+def __getattr__(name):
+    """
+    Loads the vendored pulp on first use
+    """
+    if name == "pulp":
+        import importlib
+        return importlib.import_module(__name__ + ".pulp")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# pulp is loaded lazily, import it explicitly
+__all__ = ["basic", "TTC", "DA", "bipartite", "kidney_solvers"]
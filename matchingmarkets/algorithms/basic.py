@@ -1,6 +1,4 @@
 import random
-import copy
-from copy import deepcopy
 import numpy as np
 import networkx as nx
 
@@ -20,6 +18,67 @@ import networkx as nx
 #    dict { agent.name : agent.name } of matches
 
 
+def needs_graph(algorithm):
+    """
+    Decorator for matching algorithms reading Mrkt.Graph
+    Markets maintain their graph incrementally for these algorithms,
+        others run headless (the graph is only built if accessed)
+    """
+    algorithm.needs_graph = True
+    return algorithm
+
+
+def _graph_to_match(Mrkt, Agents):
+    """
+    Undirected NetworkX graph of Mrkt.Graph induced by Agents
+    Nodes are agent names, built from an edge list:
+        neither the agents nor the market graph are copied or modified
+    Agents are linked if either is a neighbor of the other,
+        the weight is the sum of the expected utilities
+        in both directions, as floats
+        (integer weights break Nx verifyOptimum())
+    Self loops are left out
+    """
+    Graph = Mrkt.Graph
+    # If Agents not whole market, get subgraph
+    # (a view for NetworkX, a CSR slice for SparseGraph)
+    if len(Graph.nodes()) != len(Agents):
+        Graph = Graph.subgraph(Agents)
+    to_match = nx.Graph()
+    to_match.add_nodes_from(a.name for a in Agents)
+    for u, v, weight in Graph.edges(data="weight"):
+        if u is v:
+            continue
+        if to_match.has_edge(u.name, v.name):
+            to_match[u.name][v.name]["weight"] += float(weight)
+        else:
+            to_match.add_edge(u.name, v.name, weight=float(weight))
+    return to_match
+
+
+def _mate_dict(mate):
+    """
+    dict { agent.name : agent.name } of a NetworkX matching
+    (set of name pairs), in both directions
+    """
+    result = dict()
+    for u, v in mate:
+        result[u] = v
+        result[v] = u
+    return result
+
+
+def _choice(Mrkt, options):
+    """
+    Random element of a list
+    Drawn from the market's rng if it has one, else from random
+    """
+    rng = getattr(Mrkt, "rng", None)
+    if rng is None:
+        return random.choice(options)
+    return options[rng.integers(len(options))]
+
+
 def arbitraryMatch(Mrkt, Agents, verbose=False):
     """
     Random __bilateral__ matches
@@ -46,26 +105,20 @@ def arbitraryMatch(Mrkt, Agents, verbose=False):
     if verbose:
         print("\n\n++++\nStarting Arbitrary Match Algo\n++++\n\n")
     matched = dict()
-    allAgentNames = [a.name for a in Mrkt.Agents]
     if verbose:
         print("Agents to match ", [a.name for a in Agents], "\n")
-    # copy list of agents to match
-    # to delete on while iterating
-    AgentCopy = list(Agents)
+    # names of agents still available to match
+    available = {a.name for a in Agents}
     for agent in Agents:
         # If not in pool, skip
-        if agent not in AgentCopy:
+        if agent.name not in available:
             continue
-        myNeighbors = agent.neighbors()
         if verbose:
             print("Trying:", agent.name, "in Pool",
-                  [a.name for a in AgentCopy])
+                  [a.name for a in Agents if a.name in available])
         # remove already matched neighbors
-        localAgentNames = [a.name for a in AgentCopy]
-        for neighborName in reversed(myNeighbors):
-            if neighborName in allAgentNames and \
-                      neighborName not in localAgentNames:
-                myNeighbors.remove(neighborName)
+        myNeighbors = [name for name in agent.neighbors()
+                       if name in available]
         if verbose:
             if len(myNeighbors) == 0:
                 print("\tNo Neighbors for ", agent.name)
@@ -73,18 +126,15 @@ def arbitraryMatch(Mrkt, Agents, verbose=False):
                 print("\tNeighbors", myNeighbors)
         # If neighbors, match at random
         if len(myNeighbors) > 0:
-            match = random.choice(myNeighbors)
+            match = _choice(Mrkt, myNeighbors)
             matched[agent.name] = match
             matched[match] = agent.name
             if verbose:
                 print("\tMatched ", agent.name, " with ",
                       match)
             # Clean up matched agents
-            AgentCopy.remove(agent)
-            for agent_match in AgentCopy:
-                if agent_match.name == match:
-                    AgentCopy.remove(agent_match)
-                    break
+            available.discard(agent.name)
+            available.discard(match)
 
     if verbose:
         print("\n\n++++++\nArbitrary Match Algorithm Done\n+++++++\n\n")
@@ -121,8 +171,7 @@ def serialDictatorship(Mrkt, Agents, verbose=False,
 
 
     """
-    allAgentNames = [a.name for a in Mrkt.Agents]
-    AgentOrder = AgentCopy = list(Agents)
+    AgentOrder = list(Agents)
     if verbose:
         print("\nSerial Dictatorship Algorithm\n")
         print("Agents to match ", [a.name for a in AgentOrder], "\n")
@@ -132,26 +181,21 @@ def serialDictatorship(Mrkt, Agents, verbose=False,
     if verbose:
         print("\nSorted Agents ", AgentOrder)
 
-    # copy list of agents to match to delete on while iterating
-    AgentCopy = list(Agents)
+    # names of agents still available to match
+    available = {a.name for a in Agents}
     result = dict()  # Return value of the algorithm
 
     # Implement matches
     for agent in AgentOrder:
         # If matched, skip
-        if agent not in AgentCopy:
+        if agent.name not in available:
             continue
-        localAgentNames = [a.name for a in AgentCopy]
-        myNeighbors = agent.neighbors()
         if verbose:
             print("Trying:", agent.name, "in Pool",
-                  [a.name for a in AgentCopy])
+                  [a.name for a in AgentOrder if a.name in available])
         # remove already matched neighbors
-        localAgentNames = [a.name for a in AgentCopy]
-        for neighborName in reversed(myNeighbors):
-            if neighborName in allAgentNames and \
-                      neighborName not in localAgentNames:
-                myNeighbors.remove(neighborName)
+        myNeighbors = [name for name in agent.neighbors()
+                       if name in available]
         if verbose:
             if len(myNeighbors) == 0:
                 print("\tNo Neighbors for ", agent.name)
@@ -161,9 +205,8 @@ def serialDictatorship(Mrkt, Agents, verbose=False,
         # If neighbors, get match
         if len(myNeighbors) > 0:
             potential_matches = {name: agent.match_util[name]
-                                 for name in agent.match_util
-                                 if (name in myNeighbors and
-                                     agent.match_fail_prob[name] > 0)}
+                                 for name in myNeighbors
+                                 if agent.match_fail_prob[name] > 0}
             if verbose:
                 print("Potential matches for ", agent.name,
                       potential_matches.keys())
@@ -177,17 +220,15 @@ def serialDictatorship(Mrkt, Agents, verbose=False,
                 print("\tMatched ", agent.name, " with ",
                       match)
             # Clean up matched agents
-            AgentCopy.remove(agent)
-            for agent_match in AgentCopy:
-                if agent_match.name == match:
-                    AgentCopy.remove(agent_match)
-                    break
+            available.discard(agent.name)
+            available.discard(match)
 
     if verbose:
         print("\n\n++++++\nSerial Dictatorship Done\n+++++++\n\n")
     return result
 
 
+@needs_graph
 def max_weight_matching(Mrkt, Agents, verbose=False, maxcardinality=True):
     """
     Computes max-weight matching of graph of inputted agents
@@ -219,22 +260,14 @@ def max_weight_matching(Mrkt, Agents, verbose=False, maxcardinality=True):
         print("\nMax Weight Match Algorithm\n")
         print("Agents to match ", [a.name for a in Agents], "\n")
 
-    # If Agents not whole market, get subgraph
-    if len(Mrkt.Graph.nodes()) != len(Agents):
-        to_match = deepcopy(Mrkt.Graph.subgraph(Agents))
-    else:
-        to_match = Mrkt.Graph
-    # Workaround of assertionerror in Nx verifyOptimum() function
-    # Breaks around integer weights
-    for u, v, d in to_match.edges(data=True):
-        d['weight'] = float(d['weight'])
+    to_match = _graph_to_match(Mrkt, Agents)
 
     mate = nx.max_weight_matching(to_match, maxcardinality=maxcardinality)
 
-    result = {a.name: mate[a].name for a in mate}
-    return result
+    return _mate_dict(mate)
 
 
+@needs_graph
 def max_cardinality_matching(Mrkt, Agents, verbose=False):
     """
     Find a maximal cardinality matching in the graph.
@@ -263,17 +296,8 @@ def max_cardinality_matching(Mrkt, Agents, verbose=False):
         print("\nMax Weight Match Algorithm\n")
         print("Agents to match ", [a.name for a in Agents], "\n")
 
-    # If Agents not whole market, get subgraph
-    if len(Mrkt.Graph.nodes()) != len(Agents):
-        to_match = deepcopy(Mrkt.Graph.subgraph(Agents))
-    else:
-        to_match = Mrkt.Graph
-    # Workaround of assertionerror in Nx verifyOptimum() function
-    # Breaks around integer weights
-    for u, v, d in to_match.edges(data=True):
-        d['weight'] = float(d['weight'])
+    to_match = _graph_to_match(Mrkt, Agents)
 
     mate = nx.maximal_matching(to_match)
 
-    result = {a[0].name: a[1].name for a in mate}
-    return result
+    return _mate_dict(mate)
@@ -0,0 +1,95 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+"""
+Matching algorithms for two-sided markets
+Agents are split in two sides by type, as in DA.gale_shapley
+"""
+
+
+def _sides(Agents, m, f):
+    """
+    Splits Agents into the m-type and f-type sides
+    If only one of m, f is given, the other side is every other agent
+    """
+    if m is None and f is None:
+        raise Exception("Bipartite matching needs the agent types "
+                        "of at least one side (m or f)")
+    if m is not None and type(m) is not list:
+        m = [m]
+    if f is not None and type(f) is not list:
+        f = [f]
+    if m is None:
+        men = [a for a in Agents if a.type not in f]
+    else:
+        men = [a for a in Agents if a.type in m]
+    if f is None:
+        fem = [a for a in Agents if a.type not in m]
+    else:
+        fem = [a for a in Agents if a.type in f]
+    return men, fem
+
+
+def bipartite_max_weight_matching(Mrkt, Agents, verbose=False,
+                                  m=None, f=None, maxcardinality=True):
+    """
+    Max-weight matching between the two sides of a market
+    Solved as an assignment problem by
+        scipy.optimize.linear_sum_assignment (Jonker-Volgenant)
+    Runtime: O(n^3) in compiled code, for n agents on the larger side
+
+    Agents of different sides are compatible if either is a neighbor
+        of the other. The weight of a pair is the sum of the expected
+        match utilities (utility * success probability) of both agents,
+        same as in max_weight_matching
+    Weights come from the market's preference data in one block
+        (see mm.Market.preferences)
+
+    Arguments
+    ---------
+    Mrkt: mm.Market object
+        The market in which the matches are made
+    Agents: list
+        list of agents initiating matches
+    m: agent type or list<agent type>
+        the types on one side of the market
+    f: agent type or list<agent type>
+        the types on the other side
+        if only one of m, f is given, the other side is everyone else
+    maxcardinality: bool
+        if True, compute the maximum-cardinality matching
+        with maximum weight among all maximum-cardinality matchings.
+    verbose: bool
+        Whether algorithm prints information on action
+    Returns
+    -------
+    dict { agent.name : agent.name } of matches
+    """
+    men, fem = _sides(Agents, m, f)
+    if verbose:
+        print("\nBipartite Max Weight Match Algorithm\n")
+        print("Side m ", [a.name for a in men])
+        print("Side f ", [a.name for a in fem], "\n")
+    if len(men) == 0 or len(fem) == 0:
+        return dict()
+
+    util, prob = Mrkt.preferences(men, fem)
+    util_back, prob_back = Mrkt.preferences(fem, men)
+    compatible = (prob > 0) | (prob_back.T > 0)
+    weights = np.where(compatible, util * prob + (util_back * prob_back).T,
+                       0)
+    if maxcardinality:
+        # Any extra match outweighs every weight difference
+        weights = np.where(compatible,
+                           weights + 1 + np.abs(weights).sum(), 0)
+
+    rows, cols = linear_sum_assignment(weights, maximize=True)
+    result = dict()
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        # The assignment is full, drop pairs that can't match
+        if compatible[i, j]:
+            result[men[i].name] = fem[j].name
+            result[fem[j].name] = men[i].name
+    if verbose:
+        print("Matches ", result)
+    return result
@@ -1,147 +1,504 @@
-import pulp
+import time
+import weakref
+import numpy as np
+from scipy import sparse
 
 
 """
-NOT IMPLEMENTED YET
-NOT IMPLEMENTED YET
-NOT IMPLEMENTED YET
+Kidney exchange solvers
+Agents are patient/donor pairs
+    the patient has blood type agent.type, the donor agent.type2
+    ex. patient_donor_pair.type = "AB+"
+        patient_donor_pair.type2 = "O-"
+Altruistic donors (NDDs) have no patient, their type is NDD_TYPE
+
+Agent a can give to agent b if b is a neighbor of a
+    (use transplant_compatibility as compatFct)
+Matches are directed: matches[a] = b when a's donor gives to b's patient
+
+The vendored pulp is imported on first solve, it's slow to load
 """
-# flake8: noqa
 
+NDD_TYPE = "NDD"
 
-##########################################
-#                                        #
-#       Code used by all formulations    #
-#                                        #
-##########################################
 
-def score(agent1, agent2):
-    return agent1.match_util[agent2.name]
+def is_ndd(agent):
+    """
+    Whether agent is an altruistic donor (non-directed donor)
+    """
+    return agent.type == NDD_TYPE
 
 
-def update_solver_ndds(Market, verbose=False):
+def compatibility_graph(Mrkt, Agents, ndd=is_ndd):
     """
-    Translates NX graph to kidney-solver graph models
-    If first period, initiate ndd agents list to Market object
-    Then add new agents to ndd list every period
+    Kidney exchange graph between agents
+    Edge i -> j if the donor of Agents[i] can give to the patient
+        of Agents[j], altruistic donors have no incoming edge
 
     Arguments
-    ------------
-    Market: mm.Market object
-        NOTE kidney solvers assume that the agents in the market
-        are patient/donor pairs.
-        This assumes agents have they have both type and type2
-            ex. patient_donor_pair.type = "ab+"
-                patient_donor_pair.type2 = "O-"
-        NOTE We only assume this structure, not specific types in the list
-    """
-
-    # If first period, initiate ndd and chain lists
-    if Market.time < 2:
-        if verbose:
-            print("initiating kidney solver")
-        Market.ndds = {}  # dict of ndds with {Agent : [outgoing edges]}
+    ---------
+    Mrkt: mm.Market object
+        The market holding the agents' preferences
+    Agents: list
+        list of agents in the graph
+    ndd: function(mm.Agent) -> bool
+        whether an agent is an altruistic donor
+    Returns
+    -------
+    (weights, successors, altruists) tuple
+        weights: np.array (n x n), expected utility of each edge
+            (utility * success probability), as in Mrkt.Graph
+        successors: list<list<int>> heads of the edges out of each agent
+        altruists: np.array of bool, which agents are altruistic donors
+    """
+    util, prob = Mrkt.preferences(Agents, Agents)
+    compatible = prob > 0
+    np.fill_diagonal(compatible, False)
+    altruists = np.array([ndd(a) for a in Agents], dtype=bool)
+    compatible[:, altruists] = False
+    successors = [np.flatnonzero(row).tolist() for row in compatible]
+    return util * prob, successors, altruists
+
 
+def _paths(successors, start, max_length, closing):
     """
-    Clean up ndds from last iteration
-    then
-    Find ndds and input them here
+    Depth-first walk of the simple paths from start
+        with at most max_length vertices
+    closing(v) is True if v can't extend paths (but may close them)
+    Yields each path as a tuple, then the vertex it reaches
     """
+    path = [start]
+    on_path = {start}
+    stack = [iter(successors[start])]
+    while stack:
+        v = next(stack[-1], None)
+        if v is None:
+            stack.pop()
+            on_path.discard(path.pop())
+            continue
+        yield tuple(path), v
+        if v in on_path or closing(v) or len(path) == max_length:
+            continue
+        path.append(v)
+        on_path.add(v)
+        stack.append(iter(successors[v]))
 
 
-####################################################
-#                                                  #
-#                Uncapped formulation              #
-#                                                  #
-####################################################
+def kidney_cycles(successors, max_length=3, starts=None):
+    """
+    Cycles of at most max_length vertices in a directed graph
+    Each cycle is listed once, from its lowest vertex in starts,
+        by a walk that doesn't visit lower vertices of starts:
+        O(k * d^(max_length - 1)) for k starts of out-degree d
+
+    Arguments
+    ---------
+    successors: list<list<int>>
+        heads of the edges out of each vertex
+    max_length: int
+        longest cycle allowed
+    starts: list<int> or None
+        only cycles through these vertices are listed,
+        None for every cycle
+    Returns
+    -------
+    list<tuple<int>> cycles, in edge order
+    """
+    if starts is None:
+        starts = range(len(successors))
+        is_start = None
+    else:
+        starts = sorted(starts)
+        is_start = set(starts)
+    cycles = list()
+    for start in starts:
+        if is_start is None:
+            def closing(v):
+                return v < start
+        else:
+            def closing(v):
+                return v < start and v in is_start
+        for path, v in _paths(successors, start, max_length, closing):
+            if v == start:
+                cycles.append(path)
+    return cycles
 
 
-def add_unlimited_vars_and_constraints(Market, ndds, m):
+def kidney_chains(successors, starts, max_length=3, fresh=None):
     """
-    For each ndd
-        add binary var in m for each outgoing edge
-    add constraint to m that sum of used edges per ndd is <= 1
+    Chains of at most max_length transplants from altruistic donors
+    With fresh, only chains through fresh vertices are walked:
+        from the altruistic donor if it's fresh, else from the
+        chain's first fresh pair, back over older pairs to the
+        donor, then forward
 
-    for each paired donor edge
-        add outgoing and incoming edges as binary var to m
-    for each paired vertex
-        add constraint to m that incoming edge sum is <= 1
+    Arguments
+    ---------
+    successors: list<list<int>>
+        heads of the edges out of each vertex
+    starts: list<int>
+        the altruistic donors, which have no incoming edges
+    max_length: int
+        most transplants in a chain
+    fresh: list<int> or None
+        only chains through these vertices are listed,
+        None for every chain
+    Returns
+    -------
+    list<tuple<int>> chains, the altruistic donor first
     """
-    directed_donors = [node for node in Market.Graph.nodes()
-                       if node not in ndds]
+    is_fresh = None if fresh is None else set(fresh)
+    chains = list()
+    for start in starts:
+        if is_fresh is None or start in is_fresh:
+            for path, v in _paths(successors, start, max_length,
+                                  lambda v: False):
+                if v not in path:
+                    chains.append(path + (v,))
+    if is_fresh is None:
+        return chains
+    altruists = set(starts)
+    predecessors = [list() for _ in successors]
+    for u, heads in enumerate(successors):
+        for v in heads:
+            predecessors[v].append(u)
 
-    # Initiate directed donor solver constraint variables
-    for v in Market.Graph.nodes():
-        if v not in ndds:
-            v.solver_vars_in = []
-            v.solver_vars_out = []
-    # Initiate edge solver variables
-    Market.edge_vars = []
+    def closing_back(v):
+        return v in is_fresh or v in altruists
 
-    for ndd in ndds:
-        ndd_edge_vars = []
-        for e in ndd.edges:
-            edge_name = str(str(e[0].type) + "," + str(e[1].type))
-            edge_var = pulp.LpVariable(edge_name, cat='Binary')
-            m += edge_var
-            e.edge_var = edge_var
-            ndd_edge_vars.append(edge_var)
-            e.target_v.solver_vars_in.append(edge_var)
-        m += sum(ndd_edge_vars) <= 1
+    for first in sorted(is_fresh - altruists):
+        for back, v in _paths(predecessors, first, max_length,
+                              closing_back):
+            if v not in altruists or v in is_fresh:
+                continue
+            # Older pairs from the donor to the first fresh pair
+            prefix = (v,) + back[::-1]
+            chains.append(prefix)
+            if len(back) == max_length:
+                continue
+            on_prefix = set(prefix)
+            for path, w in _paths(successors, first,
+                                  max_length - len(back),
+                                  on_prefix.__contains__):
+                if w not in path and w not in on_prefix:
+                    chains.append(prefix + path[1:] + (w,))
+    return chains
 
-    # Add pair->pair edge variables
-    for e in Market.Graph.edges(directed_donors):
-        edge_name = str(str(e[0].type) + "," + str(e[1].type))
-        edge_var = pulp.LpVariable(edge_name, cat='Binary')
-        m += edge_var
-        # Add constraint variables to keep track
-        Market.edge_vars.append(edge_var)
-        e[0].solver_vars_out.append(edge_var)
-        e[1].solver_vars_in.append(edge_var)
 
-    # Update constraints on LP model
-    for v in Market.Graph.nodes():
-        if len(v.solver_vars_in) > 1:
-            m += sum(v.solver_vars_in) <= 1
+def _structure_weights(weights, cycles, chains):
+    """
+    Total edge weight of each cycle (wrapping around) and chain
+    """
+    edges = [(s[k - 1], s[k]) for s in cycles for k in range(len(s))] + \
+            [(s[k - 1], s[k]) for s in chains for k in range(1, len(s))]
+    if not edges:
+        return np.zeros(0)
+    sizes = [len(s) for s in cycles] + [len(s) - 1 for s in chains]
+    tails, heads = np.array(edges, dtype=int).T
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    return np.add.reduceat(weights[tails, heads], starts)
 
-    # Sum of edges into a vertex must be >= sum of edges out
-    for v in Market.Graph.nodes():
-        m.addConstr(quicksum(v.grb_vars_in) >= quicksum(v.grb_vars_out))
 
+def _default_solver():
+    """
+    Solver used when none is given:
+        pulp's in-process CoinMP library if it loads,
+        else pulp's default solver (CBC) with MIP starts,
+        else "highs"
+    """
+    from matchingmarkets.algorithms import pulp
+    if pulp.COINMP_DLL.available():
+        return pulp.COINMP_DLL(msg=0)
+    default = pulp.LpSolverDefault
+    if default is None:
+        return "highs"
+    if isinstance(default, pulp.COIN_CMD):
+        return type(default)(msg=0, warmStart=True)
+    return default
 
-def optimise_uuef(cfg):
-    """Optimise using the uncapped edge formulation.
 
-    Args:
-        cfg: an OptConfig object
+class KidneyModel:
+    """
+    Kidney exchange IP kept from one market period to the next
+    Same formulation as kidney_exchange, but the cycles and chains
+        and their pulp variables and constraints persist:
+        each call removes those of departed agents and only
+        enumerates the ones through arriving agents
+    Agents' preferences are fixed on arrival, so the structures
+        between agents already in the model don't change
+    The last solution is the MIP start of the next solve, it stays
+        feasible since agents only leave the model
+    The model belongs to one market, it starts over when called
+        on another one (ex. the next run of a simulation)
+        (used by solvers with warm starts, ex. COIN_CMD(warmStart=True))
+
+    Instances are algorithms:
+        Market.update(algorithm=KidneyModel(max_cycle=3))
 
-    Returns:
-        an OptSolution object
+    Attributes
+    ----------
+    problem: pulp.LpProblem or None
+        the IP, None when solved with scipy's HiGHS
+    weights: dict<tuple<name>, float>
+        weight of each cycle or chain, keyed by its agents' names
+        in donation order (the altruistic donor first for chains)
+    variables: dict<tuple<name>, pulp.LpVariable>
+        binary variable of each cycle or chain
+    members: dict<name, set<tuple<name>>>
+        cycles and chains through each agent
+    chosen: set<tuple<name>>
+        cycles and chains of the last solution
+    altruists: set<name>
+        altruistic donors in the model
+    market: weakref to mm.Market or None
+        market the model was built for
     """
-    assert Market.acceptable_prob == 1, "uucef  does not support failure-aware matching."
+    def __init__(self, max_cycle=3, max_chain=3, ndd=is_ndd, solver=None):
+        self.max_cycle = max_cycle
+        self.max_chain = max_chain
+        self.ndd = ndd
+        self.solver = solver
+        self.reset()
 
-    m = pulp.LpProblem("uucef", pulp.LpMaximize)
+    def reset(self):
+        """
+        Empties the model
+        """
+        self.market = None
+        self.problem = None
+        self.weights = dict()
+        self.variables = dict()
+        self.members = dict()
+        self.chosen = set()
+        self.altruists = set()
+        self.n_variables = 0
 
-    add_unlimited_vars_and_constraints(cfg.digraph, cfg.ndds, m)
+    def __call__(self, Mrkt, Agents, verbose=False):
+        """
+        Algorithm interface, see kidney_exchange
+        """
+        start = time.perf_counter()
+        timings = self.update(Mrkt, Agents)
+        if verbose:
+            print("\nKidney exchange on ", [a.name for a in Agents])
+            print("Cycles and chains ", len(self.weights))
+        tic = time.perf_counter()
+        self.solve()
+        timings["solve"] = time.perf_counter() - tic
+
+        matches = dict()  # Return value of the algorithm
+        for key in self.chosen:
+            for k in range(1, len(key)):
+                matches[key[k - 1]] = key[k]
+            if key[0] in self.altruists:
+                # The last pair of a chain gives to nobody
+                matches[key[-1]] = None
+            else:
+                matches[key[-1]] = key[0]
+        timings["total"] = time.perf_counter() - start
+        Mrkt.kidney_timings.append(timings)
+        if verbose:
+            print("Matches ", matches)
+            print("Timings ", timings)
+        return matches
+
+    @staticmethod
+    def _constraint(name):
+        return "agent_" + str(name)
+
+    def update(self, Mrkt, Agents):
+        """
+        Syncs the model with the agents in Agents
+        Returns
+        -------
+        dict of seconds spent on "graph" and "enumerate"
+        """
+        if self.market is None or self.market() is not Mrkt:
+            # Names are only unique within a market
+            self.reset()
+            self.market = weakref.ref(Mrkt)
+        if self.solver is None:
+            self.solver = _default_solver()
+        if self.problem is None and self.solver != "highs":
+            from matchingmarkets.algorithms import pulp
+            self.problem = pulp.LpProblem("kidney_exchange",
+                                          pulp.LpMaximize)
+            self.problem += pulp.LpAffineExpression()
 
-    m.objective = (sum(e.score * e.edge_var for ndd in cfg.ndds
-                       for e in ndd.edges) +
-                   sum(e.score * var for e in cfg.digraph.es for var in e.grb_vars))
+        start = time.perf_counter()
+        Agents = list(Agents)
+        names = [a.name for a in Agents]
+        live = set(names)
+        for name in [name for name in self.members if name not in live]:
+            self._remove(name)
+        fresh = [i for i, name in enumerate(names)
+                 if name not in self.members]
+        weights, successors, altruists = compatibility_graph(Mrkt, Agents,
+                                                             self.ndd)
+        self.altruists.update(names[i] for i in np.flatnonzero(altruists))
+        timings = {"graph": time.perf_counter() - start}
 
-    m.setObjective(obj_expr, GRB.MAXIMIZE)
-    optimise(m, cfg)
+        tic = time.perf_counter()
+        cycles = list()
+        chains = list()
+        if fresh:
+            cycles = kidney_cycles([[] if a else s for a, s in
+                                    zip(altruists.tolist(), successors)],
+                                   self.max_cycle, starts=fresh)
+        if fresh and self.max_chain > 0:
+            chains = kidney_chains(successors,
+                                   np.flatnonzero(altruists).tolist(),
+                                   self.max_chain, fresh=fresh)
+        values = _structure_weights(weights, cycles, chains).tolist()
+        for structure, value in zip(cycles + chains, values):
+            self._add(tuple(names[i] for i in structure), value)
+        # Agents without cycle or chain are still in the model
+        for name in names:
+            self.members.setdefault(name, set())
+        timings["enumerate"] = time.perf_counter() - tic
+        return timings
 
-    # Try all possible cycle start positions
-    cycle_start_vv = range(cfg.digraph.n)
+    def _add(self, key, weight):
+        """
+        Adds a cycle or chain, with its variable if solved by pulp
+        """
+        self.weights[key] = weight
+        for name in key:
+            self.members.setdefault(name, set()).add(key)
+        if self.problem is None:
+            return
+        from matchingmarkets.algorithms import pulp
+        var = pulp.LpVariable("x" + str(self.n_variables),
+                              cat=pulp.LpBinary)
+        self.n_variables += 1
+        self.variables[key] = var
+        # addterm, not item assignment: it updates the variable index
+        self.problem.objective.addterm(var, weight)
+        for name in key:
+            constraint = self.problem.constraints.get(self._constraint(name))
+            if constraint is None:
+                constraint = pulp.LpConstraint(pulp.LpAffineExpression(),
+                                               pulp.LpConstraintLE,
+                                               self._constraint(name), 1)
+                self.problem.addConstraint(constraint)
+            constraint.addterm(var, 1)
 
-    cycle_next_vv = {}
-    for e in cfg.digraph.es:
-        for var in e.grb_vars:
-            if var.x > 0.1:
-                cycle_next_vv[e.src.id] = e.tgt.id
+    def _remove(self, name):
+        """
+        Removes an agent, its cycles and chains and its constraint
+        """
+        removed = list()
+        self.altruists.discard(name)
+        for key in self.members.pop(name):
+            del self.weights[key]
+            self.chosen.discard(key)
+            var = self.variables.pop(key, None)
+            if var is not None:
+                removed.append(var)
+            for other in key:
+                if other == name:
+                    continue
+                self.members[other].discard(key)
+                if var is None:
+                    continue
+                constraint = self.problem.constraints[self._constraint(other)]
+                del constraint[var]
+                if not constraint:
+                    del self.problem.constraints[self._constraint(other)]
+        if self.problem is not None:
+            self.problem.constraints.pop(self._constraint(name), None)
+            self.problem.deleteVariables(removed)
 
-    return OptSolution(ip_model=m,
-                       cycles=kidney_utils.selected_edges_to_cycles(
-                                    cfg.digraph, cycle_start_vv, cycle_next_vv),
-                       chains=kidney_utils.get_optimal_chains(cfg.digraph, cfg.ndds),
-                       digraph=cfg.digraph)
+    def solve(self):
+        """
+        Solves the IP, starting from the last solution
+        Returns
+        -------
+        set<tuple<name>> chosen cycles and chains
+        """
+        if not self.weights:
+            self.chosen = set()
+        elif self.problem is None:
+            keys = list(self.weights)
+            rows = {name: i for i, name in enumerate(self.members)}
+            entries = [rows[name] for key in keys for name in key]
+            cols = np.repeat(np.arange(len(keys)), [len(k) for k in keys])
+            incidence = sparse.csr_matrix(
+                (np.ones(len(entries)), (entries, cols)),
+                shape=(len(rows), len(keys)))
+            chosen = _solve_highs(incidence, np.array(
+                [self.weights[key] for key in keys]))
+            self.chosen = set(keys[i] for i in chosen.tolist())
+        else:
+            from matchingmarkets.algorithms import pulp
+            for key, var in self.variables.items():
+                var.setInitialValue(1 if key in self.chosen else 0)
+            status = self.problem.solve(self.solver)
+            if status != pulp.LpStatusOptimal:
+                raise Exception("Kidney exchange IP not solved: " +
+                                pulp.LpStatus[status])
+            self.chosen = set(key for key, var in self.variables.items()
+                              if var.varValue is not None and
+                              var.varValue > 0.5)
+        return self.chosen
+
+
+def _solve_highs(incidence, weights):
+    """
+    Solves max weights.x s.t. incidence.x <= 1, x binary,
+        with scipy.optimize.milp (HiGHS)
+    Returns np.array of the chosen columns
+    """
+    # scipy >= 1.9, only needed when solving with "highs"
+    from scipy.optimize import Bounds, LinearConstraint, milp
+    result = milp(-weights, integrality=np.ones(len(weights)),
+                  bounds=Bounds(0, 1),
+                  constraints=LinearConstraint(incidence, -np.inf, 1))
+    if not result.success:
+        raise Exception("Kidney exchange IP not solved: " + result.message)
+    return np.flatnonzero(result.x > 0.5)
+
+
+def kidney_exchange(Mrkt, Agents, verbose=False, max_cycle=3, max_chain=3,
+                    ndd=is_ndd, solver=None):
+    """
+    Kidney exchange with bounded cycles and altruistic donor chains
+    Cycle formulation: one binary variable per cycle of at most
+        max_cycle pairs and per chain of at most max_chain transplants,
+        each agent is in at most one chosen cycle or chain
+    Maximizes the total expected utility of the transplants
+    The model is built from scratch, use a KidneyModel to keep
+        it from one period to the next
+
+    A chain ends with a pair whose donor doesn't give in the chain,
+        that pair is matched to None: the market removes it
+        without match utility
+
+    Times of each step are appended to Mrkt.kidney_timings, as
+        a dict of seconds for "graph", "enumerate", "solve", "total"
+
+    Arguments
+    ---------
+    Mrkt: mm.Market object
+        The market in which the matches are made
+    Agents: list
+        list of agents that can be matched
+    max_cycle: int
+        longest exchange cycle (# of pairs)
+    max_chain: int
+        longest chain (# of transplants), 0 for no chains
+    ndd: function(mm.Agent) -> bool
+        whether an agent is an altruistic donor
+    solver: pulp solver, "highs" or None
+        pulp solver of the IP (ex. pulp.PULP_CBC_CMD()),
+        or "highs" for scipy.optimize.milp
+        None uses pulp's CoinMP library or default solver,
+        or HiGHS if pulp has none
+    verbose: bool
+        Whether algorithm prints information on action
+    Returns
+    -------
+    dict { agent.name : agent.name } of matches
+    """
+    model = KidneyModel(max_cycle, max_chain, ndd, solver)
+    return model(Mrkt, Agents, verbose)
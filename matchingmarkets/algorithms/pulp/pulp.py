@@ -97,10 +97,14 @@ import types
 import string
 import itertools
 import warnings
+import io
+import contextlib
+import numpy as np
 
 from .constants import *
 from .solvers import *
-from collections import Iterable
+from . import sparse
+from collections.abc import Iterable
 
 import logging
 log = logging.getLogger(__name__)
@@ -126,6 +130,35 @@ if sys.platform not in ['cli']:
     except ImportError:
         pass
 
+#buffer size of the files written by writeMPS and writeLP
+LpWriteBufferSize = 1 << 20
+
+@contextlib.contextmanager
+def _openOutput(filename):
+    """
+    Text stream to write a model to
+    filename is a path, opened with a LpWriteBufferSize buffer,
+    or a file-like object (ex. the stdin pipe of a solver process)
+    that is left open. Binary streams are written through
+    a TextIOWrapper that is detached, not closed, at the end
+    """
+    if not hasattr(filename, "write"):
+        with open(filename, "w", buffering = LpWriteBufferSize) as f:
+            yield f
+    elif isinstance(filename, (io.RawIOBase, io.BufferedIOBase)):
+        f = io.TextIOWrapper(filename)
+        try:
+            yield f
+        finally:
+            f.flush()
+            f.detach()
+    else:
+        yield filename
+
+
+def _variableName(variable):
+    return variable.name
+
 
 def setConfigInformation(**keywords):
     """
@@ -177,8 +210,9 @@ class LpElement(object):
         self.hash = id(self)
         self.modified = True
 
-    def __hash__(self):
-        return self.hash
+    # identity hash in C, like self.hash: expressions are dicts keyed
+    # by elements and a python __hash__ is called on every term
+    __hash__ = object.__hash__
 
     def __str__(self):
         return self.name
@@ -494,8 +528,10 @@ class LpVariable(LpElement):
     def setInitialValue(self,val):
         """sets the initial value of the Variable to val
         may of may not be supported by the solver
+        (see the warmStart option of COIN_CMD)
         """
-        raise NotImplementedError
+        self.varValue = val
+        return True
 
 
 class LpAffineExpression(_DICT_TYPE):
@@ -522,6 +558,9 @@ class LpAffineExpression(_DICT_TYPE):
     """
     #to remove illegal characters from the names
     trans = maketrans("-+[] ","_____")
+    #problems holding the expression as objective or constraint,
+    #whose variable index addterm keeps up to date
+    _problems = ()
     def setName(self,name):
         if name:
             self.__name = str(name).translate(self.trans)
@@ -585,6 +624,24 @@ class LpAffineExpression(_DICT_TYPE):
             s += v.valueOrDefault() * x
         return s
 
+    def __setitem__(self, key, value):
+        #new variables go to the index of the problems holding self,
+        #except problems being copied, which rebuild it in __setstate__
+        if self._problems and key not in self:
+            for problem in self._problems:
+                if "_variable_ids" in problem.__dict__:
+                    problem.addVariable(key)
+        _DICT_TYPE.__setitem__(self, key, value)
+
+    def update(self, *args, **kwargs):
+        for key, value in _DICT_TYPE(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default = None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
     def addterm(self, key, value):
             y = self.get(key, 0)
             if y:
@@ -593,6 +650,48 @@ class LpAffineExpression(_DICT_TYPE):
             else:
                 self[key] = value
 
+    @classmethod
+    def fromArrays(cls, variables, coefficients = None, *args, **kwargs):
+        """
+        Builds an expression from parallel sequences of variables and
+        coefficients in linear time, without intermediate expressions
+        The other arguments are those of the class after e,
+        ex. LpConstraint.fromArrays(x, c, LpConstraintLE, rhs = 1)
+
+        Examples:
+
+           >>> x = [LpVariable('x_%d' % i) for i in range(3)]
+           >>> LpAffineExpression.fromArrays(x, [1, -3, 4], 2)
+           1*x_0 + -3*x_1 + 4*x_2 + 2
+        """
+        return cls(None, *args, **kwargs).addArrays(variables, coefficients)
+
+    def addArrays(self, variables, coefficients = None):
+        """
+        Adds coefficients[k] * variables[k] for every k, in linear time
+        coefficients can be a numpy array, None gives coefficients of 1
+        Repeated variables are summed
+        """
+        variables = list(variables)
+        if coefficients is None:
+            coefficients = [1] * len(variables)
+        elif hasattr(coefficients, "tolist"):
+            coefficients = coefficients.tolist()
+        else:
+            coefficients = list(coefficients)
+        if len(variables) != len(coefficients):
+            raise ValueError("%d variables for %d coefficients"
+                             % (len(variables), len(coefficients)))
+        if not self and not self._problems:
+            _DICT_TYPE.update(self, zip(variables, coefficients))
+            if len(self) == len(variables):
+                return self
+            #repeated variables overwrote each other
+            self.clear()
+        for v, x in zip(variables, coefficients):
+            self.addterm(v, x)
+        return self
+
     def emptyCopy(self):
         return LpAffineExpression()
 
@@ -698,7 +797,9 @@ class LpAffineExpression(_DICT_TYPE):
         return result
 
     def addInPlace(self, other):
-        if other in (0, None): return self
+        # not `other in (0, None)`: == on expressions builds constraints
+        if other is None or (isinstance(other, (int, float)) and other == 0):
+            return self
         if isinstance(other,LpElement):
             self.addterm(other, 1)
         elif isinstance(other,LpAffineExpression):
@@ -717,7 +818,9 @@ class LpAffineExpression(_DICT_TYPE):
         return self
 
     def subInPlace(self, other):
-        if other in (0, None): return self
+        # not `other in (0, None)`: == on expressions builds constraints
+        if other is None or (isinstance(other, (int, float)) and other == 0):
+            return self
         if isinstance(other,LpElement):
             self.addterm(other, -1)
         elif isinstance(other,LpAffineExpression):
@@ -1089,8 +1192,75 @@ class LpConstraintVar(LpElement):
     def value(self):
         return self.constraint.value()
 
+class LpConstraintDict(_DICT_TYPE):
+    """
+    The constraints of an LpProblem, by name
+    Constraints set in it are registered with the problem, so their
+    variables are added to the problem's variable index, and
+    constraints replaced or removed are unregistered
+    """
+    def __init__(self, problem = None, *args, **kwargs):
+        self.problem = problem
+        _DICT_TYPE.__init__(self, *args, **kwargs)
+
+    def __setitem__(self, name, constraint):
+        if self.problem is not None:
+            old = self.get(name)
+            if old is not None and old is not constraint:
+                self.problem._unregister(old)
+            self.problem._register(constraint)
+        _DICT_TYPE.__setitem__(self, name, constraint)
+
+    def __delitem__(self, name):
+        if self.problem is not None and name in self:
+            self.problem._unregister(self[name])
+        _DICT_TYPE.__delitem__(self, name)
+
+    def pop(self, name, *default):
+        if self.problem is not None and name in self:
+            self.problem._unregister(self[name])
+        return _DICT_TYPE.pop(self, name, *default)
+
+    def popitem(self, *args):
+        name, constraint = _DICT_TYPE.popitem(self, *args)
+        if self.problem is not None:
+            self.problem._unregister(constraint)
+        return name, constraint
+
+    def clear(self):
+        if self.problem is not None:
+            for constraint in self.values():
+                self.problem._unregister(constraint)
+        _DICT_TYPE.clear(self)
+
+    def update(self, *args, **kwargs):
+        for name, constraint in _DICT_TYPE(*args, **kwargs).items():
+            self[name] = constraint
+
+    def setdefault(self, name, constraint = None):
+        if name not in self:
+            self[name] = constraint
+        return self[name]
+
+    def __reduce__(self):
+        #no problem while the items are set back: the copied
+        #constraints are registered already, the problem sets
+        #itself back in __setstate__
+        return (LpConstraintDict, (), None, None, iter(self.items()))
+
+    def copy(self):
+        return LpConstraintDict(None, self)
+
 class LpProblem(object):
-    """An LP Problem"""
+    """An LP Problem
+
+    The problem keeps an index of its variables: every variable of
+    its objective and constraints, in order of addition, and the
+    same variables sorted by name. addConstraint, setObjective,
+    += and the expressions of the problem (addterm, item setting)
+    keep it up to date, so variables() only sorts the variables
+    added since its last call.
+    """
     def __init__(self, name = "NoName", sense = LpMinimize):
         """
         Creates an LP Problem
@@ -1103,8 +1273,16 @@ class LpProblem(object):
                 or :data:`~pulp.constants.LpMaximize`.
         :return: An LP Problem
         """
+        self._variables = []
+        self._variable_ids = {}  #old school using dict.keys() for a set
+        #variables()
+        self._sortedVariables = []
+        #variables not in _sortedVariables yet
+        self._newVariables = []
+        #variablesDict(), None when outdated
+        self._variablesByName = None
         self.objective = None
-        self.constraints = _DICT_TYPE()
+        self.constraints = LpConstraintDict(self)
         self.name = name
         self.sense = sense
         self.sos1 = {}
@@ -1116,14 +1294,68 @@ class LpProblem(object):
         self.modifiedVariables = []
         self.modifiedConstraints = []
         self.resolveOK = False
-        self._variables = []
-        self._variable_ids = {}  #old school using dict.keys() for a set
         self.dummyVar = None
 
 
         # locals
         self.lastUnused = 0
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        #the index is keyed by id, which unpickled variables don't keep
+        self._variable_ids = dict((id(v), v) for v in self._variables)
+        self._constraints.problem = self
+
+    def _getObjective(self):
+        return self._objective
+
+    def _setObjective(self, objective):
+        old = getattr(self, "_objective", None)
+        if objective is not old:
+            self._unregister(old)
+            self._register(objective)
+        self._objective = objective
+
+    objective = property(fget=_getObjective, fset=_setObjective)
+
+    def _getConstraints(self):
+        return self._constraints
+
+    def _setConstraints(self, constraints):
+        if not isinstance(constraints, LpConstraintDict):
+            constraints = LpConstraintDict(None, constraints)
+        old = getattr(self, "_constraints", None)
+        if old is not None and old is not constraints:
+            for constraint in old.values():
+                self._unregister(constraint)
+            old.problem = None
+        constraints.problem = self
+        for constraint in constraints.values():
+            self._register(constraint)
+        self._constraints = constraints
+
+    constraints = property(fget=_getConstraints, fset=_setConstraints)
+
+    def _register(self, expression):
+        """
+        Adds the variables of an expression to the index and has
+        addterm add the variables it gets later
+        """
+        if not isinstance(expression, LpAffineExpression):
+            return
+        if self not in expression._problems:
+            expression._problems = expression._problems + (self,)
+        self.addVariables(expression.keys())
+
+    def _unregister(self, expression):
+        """
+        Stops addterm on an expression the problem no longer holds
+        from adding variables to the index
+        """
+        if isinstance(expression, LpAffineExpression):
+            expression._problems = tuple(p for p in expression._problems
+                                         if p is not self)
+
     def __repr__(self):
         string = self.name+":\n"
         if self.sense == 1:
@@ -1227,6 +1459,8 @@ class LpProblem(object):
         if id(variable) not in self._variable_ids:
             self._variables.append(variable)
             self._variable_ids[id(variable)] = variable
+            self._newVariables.append(variable)
+            self._variablesByName = None
 
     def addVariables(self, variables):
         """
@@ -1237,6 +1471,25 @@ class LpProblem(object):
         for v in variables:
             self.addVariable(v)
 
+    def deleteVariables(self, variables):
+        """
+        Removes variables from the problem and its objective
+
+        @param variables: the variables to be removed, they must
+            not be in any constraint of the problem anymore
+        """
+        for v in variables:
+            if self.objective is not None:
+                self.objective.pop(v, None)
+            self._variable_ids.pop(id(v), None)
+        self._variables = [v for v in self._variables
+                           if id(v) in self._variable_ids]
+        self._sortedVariables = [v for v in self._sortedVariables
+                                 if id(v) in self._variable_ids]
+        self._newVariables = [v for v in self._newVariables
+                              if id(v) in self._variable_ids]
+        self._variablesByName = None
+
     def variables(self):
         """
         Returns a list of the problem variables
@@ -1245,28 +1498,33 @@ class LpProblem(object):
             - none
 
         Returns:
-            - A list of the problem variables
+            - A list of the problem variables, sorted by name
         """
-        if self.objective:
-            self.addVariables(list(self.objective.keys()))
-        for c in self.constraints.values():
-            self.addVariables(list(c.keys()))
-        variables = self._variables
-        #sort the varibles DSU
-        variables = [[v.name, v] for v in variables]
-        variables.sort()
-        variables = [v for _, v in variables]
-        return variables
+        if self._newVariables:
+            self._newVariables.sort(key = _variableName)
+            #timsort merges the two sorted runs in linear time
+            self._sortedVariables.extend(self._newVariables)
+            self._sortedVariables.sort(key = _variableName)
+            self._newVariables = []
+        return list(self._sortedVariables)
 
     def variablesDict(self):
-        variables = {}
-        if self.objective:
-            for v in self.objective:
-                variables[v.name] = v
-        for c in list(self.constraints.values()):
-            for v in c:
-                variables[v.name] = v
-        return variables
+        """
+        Returns a dict of the problem variables by name
+        """
+        if self._variablesByName is None:
+            self._variablesByName = dict((v.name, v)
+                                         for v in self._variables)
+        return dict(self._variablesByName)
+
+    def _renamedVariables(self):
+        """
+        Sorts the variables again on the next variables() call,
+        after some were renamed
+        """
+        self._newVariables = list(self._variables)
+        self._sortedVariables = []
+        self._variablesByName = None
 
     def add(self, constraint, name = None):
         self.addConstraint(constraint, name)
@@ -1294,7 +1552,6 @@ class LpProblem(object):
                 print("Warning: overlapping constraint names:", name)
         self.constraints[name] = constraint
         self.modifiedConstraints.append(constraint)
-        self.addVariables(list(constraint.keys()))
 
     def setObjective(self,obj):
         """
@@ -1361,6 +1618,8 @@ class LpProblem(object):
         elif isinstance(other, LpProblem):
             for v in set(other.variables()).difference(self.variables()):
                 v.name = other.name + v.name
+            other._renamedVariables()
+            self._renamedVariables()
             for name,c in other.constraints.items():
                 c.name = other.name + name
                 self.addConstraint(c)
@@ -1390,9 +1649,50 @@ class LpProblem(object):
                 coefs.extend([(translation[v.name], ctr, cst[v]) for v in cst])
         return coefs
 
+    def columnArrays(self, variables):
+        """
+        Returns the constraint coefficients by column, as numpy arrays
+        (starts, rows, values): the coefficients of variables[j] are
+        values[starts[j]:starts[j + 1]], in the constraints numbered
+        rows[starts[j]:starts[j + 1]] in self.constraints order
+
+        Every variable of the constraints must be in variables
+        """
+        #by id: LpElement.__hash__ is slow python code
+        v2n = dict((id(v), i) for i, v in enumerate(variables))
+        numRows = len(self.constraints)
+        rowLengths = np.fromiter(map(len, self.constraints.values()),
+                                 np.int32, numRows)
+        numels = int(rowLengths.sum())
+        matrix = sparse.Matrix(numRows, len(variables), capacity = numels)
+        matrix.addentries(
+            np.repeat(np.arange(numRows, dtype = np.int32), rowLengths),
+            np.fromiter(map(v2n.__getitem__, map(id,
+                itertools.chain.from_iterable(
+                    map(dict.keys, self.constraints.values())))),
+                np.int32, numels),
+            #dict.values: OrderedDict.values hashes every key
+            np.fromiter(itertools.chain.from_iterable(
+                map(dict.values, self.constraints.values())),
+                np.float64, numels))
+        numels, starts, lengths, rows, values = matrix.col_based_arrays()
+        return starts, rows, values
+
     def writeMPS(self, filename, mpsSense = 0, rename = 0, mip = 1):
+        """
+        Write the given Lp problem to a .mps file.
+
+        The matrix is written column by column from the compact
+        arrays of columnArrays(), lines are streamed to the file
+
+        :param filename: the name of the file to be created,
+            or a file-like object to write to
+        """
+        with _openOutput(filename) as f:
+            return self._writeMPS(f, mpsSense, rename, mip)
+
+    def _writeMPS(self, f, mpsSense, rename, mip):
         wasNone, dummyVar = self.fixObjective()
-        f = open(filename, "w")
         if mpsSense == 0: mpsSense = self.sense
         cobj = self.objective
         if mpsSense != self.sense:
@@ -1401,10 +1701,10 @@ class LpProblem(object):
             cobj.name = n
         if rename:
             constraintsNames, variablesNames, cobj.name = self.normalisedNames()
-        f.write("*SENSE:"+LpSenses[mpsSense]+"\n")
+        f.write("*SENSE:%s\n" % LpSenses[mpsSense])
         n = self.name
         if rename: n = "MODEL"
-        f.write("NAME          "+n+"\n")
+        f.write("NAME          %s\n" % n)
         vs = self.variables()
         # constraints
         f.write("ROWS\n")
@@ -1412,34 +1712,25 @@ class LpProblem(object):
         if not objName: objName = "OBJ"
         f.write(" N  %s\n" % objName)
         mpsConstraintType = {LpConstraintLE:"L", LpConstraintEQ:"E", LpConstraintGE:"G"}
-        for k,c in self.constraints.items():
-            if rename: k = constraintsNames[k]
-            f.write(" "+mpsConstraintType[c.sense]+"  "+k+"\n")
+        if rename:
+            rowNames = [constraintsNames[k] for k in self.constraints]
+        else:
+            rowNames = list(self.constraints)
+        f.writelines(" %s  %s\n" % (mpsConstraintType[c.sense], k)
+                     for k, c in zip(rowNames, self.constraints.values()))
         # matrix
         f.write("COLUMNS\n")
-        # Creation of a dict of dict:
-        # coefs[nomVariable][nomContrainte] = coefficient
-        coefs = {}
-        for k,c in self.constraints.items():
-            if rename: k = constraintsNames[k]
-            for v in c:
-                n = v.name
-                if rename: n = variablesNames[n]
-                if n in coefs:
-                    coefs[n][k] = c[v]
-                else:
-                    coefs[n] = {k:c[v]}
-
-        for v in vs:
+        starts, rows, values = self.columnArrays(vs)
+        starts = starts.tolist()
+        for j, v in enumerate(vs):
             if mip and v.cat == LpInteger:
                 f.write("    MARK      'MARKER'                 'INTORG'\n")
             n = v.name
             if rename: n = variablesNames[n]
-            if n in coefs:
-                cv = coefs[n]
-                # Most of the work is done here
-                for k in cv: f.write("    %-8s  %-8s  % .12e\n" % (n,k,cv[k]))
-
+            # Most of the work is done here
+            f.writelines("    %-8s  %-8s  % .12e\n" % (n, rowNames[i], x)
+                         for i, x in zip(rows[starts[j]:starts[j + 1]].tolist(),
+                                         values[starts[j]:starts[j + 1]].tolist()))
             # objective function
             if v in cobj: f.write("    %-8s  %-8s  % .12e\n" % (n,objName,cobj[v]))
             if mip and v.cat == LpInteger:
@@ -1475,7 +1766,6 @@ class LpProblem(object):
                 if v.upBound != None:
                     f.write(" UP BND       %-8s  % .12e\n" % (n, v.upBound))
         f.write("ENDATA\n")
-        f.close()
         self.restoreObjective(wasNone, dummyVar)
         # returns the variables, in writing order
         if rename == 0:
@@ -1489,13 +1779,18 @@ class LpProblem(object):
 
         This function writes the specifications (objective function,
         constraints, variables) of the defined Lp problem to a file.
+        Constraints are streamed to the file one at a time.
 
-        :param filename:  the name of the file to be created.
+        :param filename:  the name of the file to be created,
+            or a file-like object to write to
 
         Side Effects:
             - The file is created.
         """
-        f = open(filename, "w")
+        with _openOutput(filename) as f:
+            self._writeLP(f, writeSOS, mip)
+
+    def _writeLP(self, f, writeSOS, mip):
         f.write("\\* "+self.name+" *\\\n")
         if self.sense == 1:
             f.write("Minimize\n")
@@ -1572,7 +1867,6 @@ class LpProblem(object):
                     for v,val in sos.items():
                         f.write(" %s: %.12g\n" % (v.name, val))
         f.write("End\n")
-        f.close()
         self.restoreObjective(wasNone, objectiveDummyVar)
 
     def assignVarsVals(self, values):
@@ -1971,12 +2265,54 @@ def lpSum(vector):
     """
     Calculate the sum of a list of linear expressions
 
+    Terms are gathered in flat lists and the sum is built once
+    with LpAffineExpression.fromArrays, in linear time
+
     :param vector: A list of linear expressions
     """
-    return LpAffineExpression().addInPlace(vector)
+    variables = []
+    coefficients = []
+    constant = _gatherTerms(vector, variables, coefficients, 0)
+    return LpAffineExpression.fromArrays(variables, coefficients, constant)
+
+def _gatherTerms(e, variables, coefficients, constant):
+    """
+    Appends the terms of e to variables and coefficients,
+    returns constant plus the constant of e
+    e is an element, expression, number, dict or iterable of those,
+    as in LpAffineExpression.addInPlace
+    """
+    if e is None:
+        return constant
+    if isinstance(e, LpElement):
+        variables.append(e)
+        coefficients.append(1)
+    elif isinstance(e, LpAffineExpression):
+        #dict.values: OrderedDict.values hashes every key
+        variables.extend(dict.keys(e))
+        coefficients.extend(dict.values(e))
+        constant += e.constant
+    elif isinstance(e, dict):
+        for x in e.values():
+            constant = _gatherTerms(x, variables, coefficients, constant)
+    elif isinstance(e, Iterable):
+        for x in e:
+            if isinstance(x, LpElement):
+                variables.append(x)
+                coefficients.append(1)
+            else:
+                constant = _gatherTerms(x, variables, coefficients,
+                                        constant)
+    else:
+        constant += e
+    return constant
 
 def lpDot(v1, v2):
-    """Calculate the dot product of two lists of linear expressions"""
+    """Calculate the dot product of two lists of linear expressions
+
+    The dot product of variables and numbers is built at once
+    with LpAffineExpression.fromArrays
+    """
     if not isiterable(v1) and not isiterable(v2):
         return v1 * v2
     elif not isiterable(v1):
@@ -1984,6 +2320,16 @@ def lpDot(v1, v2):
     elif not isiterable(v2):
         return lpDot(v1,[v2]*len(v1))
     else:
+        v1 = list(v1)
+        v2 = list(v2)
+        if all(isinstance(e, LpElement) for e in v2):
+            v1, v2 = v2, v1
+        if (all(isinstance(e, LpElement) for e in v1) and
+                all(isinstance(e, (int, float)) for e in v2)):
+            #zero terms are dropped, as by LpAffineExpression.__mul__
+            terms = [(e, c) for e, c in zip(v1, v2) if c != 0]
+            return LpAffineExpression.fromArrays([e for e, _ in terms],
+                                                 [c for _, c in terms])
         return lpSum([lpDot(e1,e2) for e1,e2 in zip(v1,v2)])
 
 def isNumber(x):
@@ -2260,6 +2606,7 @@ def configSolvers():
 def pulpTestAll():
     from .tests import pulpTestSolver
     solvers = [PULP_CBC_CMD,
+               CBC_DLL,
                CPLEX_DLL,
                CPLEX_CMD,
                CPLEX_PY,
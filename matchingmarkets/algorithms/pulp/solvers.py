@@ -38,6 +38,7 @@ try:
 except ImportError:
     import ConfigParser as configparser
 from . import sparse
+import numpy as np
 import collections
 import warnings
 from tempfile import mktemp
@@ -150,6 +151,12 @@ else: #run as a script
 cplex_dll_path, ilm_cplex_license, ilm_cplex_license_signature, coinMP_path,\
         gurobi_path, cbc_path, glpk_path, pulp_cbc_path, scip_path = \
         initialize(config_filename, operating_system, arch)
+# C interface library of cbc for CBC_DLL, found on the library path
+try:
+    import ctypes.util
+    cbc_lib_path = ctypes.util.find_library("CbcSolver")
+except ImportError:
+    cbc_lib_path = None
 
 
 # See later for LpSolverDefault definition
@@ -226,7 +233,7 @@ class LpSolver:
         upperBounds = NumVarDoubleArray()
         initValues = NumVarDoubleArray()
         for v in lp.variables():
-            colNames[self.v2n[v]] = str(v.name)
+            colNames[self.v2n[v]] = str(v.name).encode()
             initValues[self.v2n[v]] = 0.0
             if v.lowBound != None:
                 lowerBounds[self.v2n[v]] = v.lowBound
@@ -252,28 +259,28 @@ class LpSolver:
             rhsValues[i] = -lp.constraints[c].constant
             #for ranged constraints a<= constraint >=b
             rangeValues[i] = 0.0
-            rowNames[i] = str(c)
-            rowType[i] = senseDict[lp.constraints[c].sense]
+            rowNames[i] = str(c).encode()
+            rowType[i] = senseDict[lp.constraints[c].sense].encode()
             self.c2n[c] = i
             self.n2c[i] = c
             i = i+1
         #return the coefficient matrix as a series of vectors
-        coeffs = lp.coefficients()
-        sparseMatrix = sparse.Matrix(list(range(numRows)), list(range(numVars)))
-        for var,row,coeff in coeffs:
-            sparseMatrix.add(self.c2n[row], self.vname2n[var], coeff)
-        (numels, mystartsBase, mylenBase, myindBase,
-         myelemBase) = sparseMatrix.col_based_arrays()
-        elemBase = ctypesArrayFill(myelemBase, ctypes.c_double)
-        indBase = ctypesArrayFill(myindBase, ctypes.c_int)
-        startsBase = ctypesArrayFill(mystartsBase, ctypes.c_int)
-        lenBase = ctypesArrayFill(mylenBase, ctypes.c_int)
+        #by variable, not by name: names may repeat
+        #rows are numbered in lp.constraints order, see c2n
+        mystartsBase, myindBase, myelemBase = lp.columnArrays(variables)
+        mylenBase = np.diff(mystartsBase).astype(np.int32)
+        numels = len(myelemBase)
+        #ctypes views of the numpy buffers, not copies
+        elemBase = ctypesArrayView(myelemBase)
+        indBase = ctypesArrayView(myindBase)
+        startsBase = ctypesArrayView(mystartsBase)
+        lenBase = ctypesArrayView(mylenBase)
         #MIP Variables
         NumVarCharArray = ctypes.c_char * numVars
         columnType = NumVarCharArray()
         if lp.isMIP():
             for v in lp.variables():
-                columnType[self.v2n[v]] = LpVarCategories[v.cat]
+                columnType[self.v2n[v]] = LpVarCategories[v.cat].encode()
         self.addedVars = numVars
         self.addedRows = numRows
         return  (numVars, numRows, numels, rangeCount,
@@ -913,7 +920,7 @@ try:
             #return the coefficient matrix as a series of vectors
             myobjectCoeffs = {}
             numRows = len(lp.constraints)
-            sparseMatrix = sparse.Matrix(list(range(numRows)), list(range(numVars)))
+            sparseMatrix = sparse.Matrix(numRows, numVars)
             for var in vars:
                 for row,coeff in var.expression.items():
                    if row.name == lp.objective.name:
@@ -926,10 +933,10 @@ try:
                 objectCoeffs[self.v2n[var]-offset] = myobjectCoeffs[var]
             (numels, mystartsBase, mylenBase, myindBase,
              myelemBase) = sparseMatrix.col_based_arrays()
-            elemBase = ctypesArrayFill(myelemBase, ctypes.c_double)
-            indBase = ctypesArrayFill(myindBase, ctypes.c_int)
-            startsBase = ctypesArrayFill(mystartsBase, ctypes.c_int)
-            lenBase = ctypesArrayFill(mylenBase, ctypes.c_int)
+            elemBase = ctypesArrayView(myelemBase)
+            indBase = ctypesArrayView(myindBase)
+            startsBase = ctypesArrayView(mystartsBase)
+            lenBase = ctypesArrayView(mylenBase)
             #MIP Variables
             NumVarCharArray = ctypes.c_char * numVars
             columnType = NumVarCharArray()
@@ -1335,7 +1342,8 @@ class COIN_CMD(LpSolver_CMD):
     def __init__(self, path = None, keepFiles = 0, mip = 1,
             msg = 0, cuts = None, presolve = None, dual = None,
             strong = None, options = [],
-            fracGap = None, maxSeconds = None, threads = None):
+            fracGap = None, maxSeconds = None, threads = None,
+            warmStart = False):
         LpSolver_CMD.__init__(self, path, keepFiles, mip, msg, options)
         self.cuts = cuts
         self.presolve = presolve
@@ -1344,6 +1352,8 @@ class COIN_CMD(LpSolver_CMD):
         self.fracGap = fracGap
         self.maxSeconds = maxSeconds
         self.threads = threads
+        # pass the initial values of the variables as a MIP start
+        self.warmStart = warmStart
         #TODO hope this gets fixed in cbc as it does not like the c:\ in windows paths
         if os.name == 'nt':
             self.tmpDir = ''
@@ -1355,6 +1365,7 @@ class COIN_CMD(LpSolver_CMD):
         aCopy.presolve = self.presolve
         aCopy.dual = self.dual
         aCopy.strong = self.strong
+        aCopy.warmStart = self.warmStart
         return aCopy
 
     def actualSolve(self, lp, **kwargs):
@@ -1375,16 +1386,21 @@ class COIN_CMD(LpSolver_CMD):
             tmpLp = os.path.join(self.tmpDir, "%d-pulp.lp" % pid)
             tmpMps = os.path.join(self.tmpDir, "%d-pulp.mps" % pid)
             tmpSol = os.path.join(self.tmpDir, "%d-pulp.sol" % pid)
+            tmpMst = os.path.join(self.tmpDir, "%d-pulp.mst" % pid)
         else:
             tmpLp = lp.name+"-pulp.lp"
             tmpMps = lp.name+"-pulp.mps"
             tmpSol = lp.name+"-pulp.sol"
+            tmpMst = lp.name+"-pulp.mst"
         if use_mps:
             vs, variablesNames, constraintsNames, objectiveName = lp.writeMPS(
                         tmpMps, rename = 1)
             cmds = ' '+tmpMps+" "
             if lp.sense == LpMaximize:
                 cmds += 'max '
+            if self.warmStart:
+                self.writesol(tmpMst, vs, variablesNames)
+                cmds += "mips "+tmpMst+" "
         else:
             lp.writeLP(tmpLp)
             cmds = ' '+tmpLp+" "
@@ -1447,8 +1463,25 @@ class COIN_CMD(LpSolver_CMD):
                 os.remove(tmpSol)
             except:
                 pass
+            try:
+                os.remove(tmpMst)
+            except:
+                pass
         return lp.status
 
+    def writesol(self, filename, vs, variablesNames):
+        """
+        Writes the initial values of the variables in a CBC solution
+        file, read back by cbc as a MIP start (mips command)
+        Variables without a value are left out
+        """
+        values = [(variablesNames[v.name], v.varValue) for v in vs
+                  if v.varValue is not None]
+        with open(filename, "w") as f:
+            f.write("Stopped on iterations - objective value 0\n")
+            for i, (name, value) in enumerate(values):
+                f.write("%7d %-11s %15s %23s\n" % (i, name, value, 0))
+
     def readsol_MPS(self, filename, lp, vs, variablesNames, constraintsNames,
                 objectiveName):
         """
@@ -1756,6 +1789,174 @@ class COINMP_DLL(LpSolver):
 if COINMP_DLL.available():
     COIN = COINMP_DLL
 
+def CBC_DLL_load_dll(path):
+    """
+    Loads the C interface library of CBC (libCbcSolver)
+    and declares the signatures of the functions CBC_DLL calls
+    """
+    import ctypes
+    if path is None:
+        raise OSError("libCbcSolver not found")
+    lib = ctypes.CDLL(path, mode = ctypes.RTLD_GLOBAL)
+    model = ctypes.c_void_p
+    intArray = ctypes.POINTER(ctypes.c_int)
+    doubleArray = ctypes.POINTER(ctypes.c_double)
+    lib.Cbc_newModel.restype = model
+    lib.Cbc_deleteModel.argtypes = [model]
+    lib.Cbc_loadProblem.argtypes = [model, ctypes.c_int, ctypes.c_int,
+                                    intArray, intArray, doubleArray,
+                                    doubleArray, doubleArray, doubleArray,
+                                    doubleArray, doubleArray]
+    lib.Cbc_setInteger.argtypes = [model, ctypes.c_int]
+    lib.Cbc_setObjSense.argtypes = [model, ctypes.c_double]
+    lib.Cbc_setParameter.argtypes = [model, ctypes.c_char_p, ctypes.c_char_p]
+    lib.Cbc_solve.argtypes = [model]
+    for name in ("Cbc_getColSolution", "Cbc_getReducedCost",
+                 "Cbc_getRowActivity", "Cbc_getRowPrice"):
+        getattr(lib, name).argtypes = [model]
+        getattr(lib, name).restype = doubleArray
+    for name in ("Cbc_getObjValue", "Cbc_getBestPossibleObjValue"):
+        getattr(lib, name).argtypes = [model]
+        getattr(lib, name).restype = ctypes.c_double
+    for name in ("Cbc_isProvenOptimal", "Cbc_isProvenInfeasible",
+                 "Cbc_isContinuousUnbounded"):
+        getattr(lib, name).argtypes = [model]
+        getattr(lib, name).restype = ctypes.c_int
+    if hasattr(lib, "Cbc_setMIPStartI"):
+        lib.Cbc_setMIPStartI.argtypes = [model, ctypes.c_int, intArray,
+                                         doubleArray]
+    return lib
+
+class CBC_DLL(LpSolver):
+    """
+    The COIN-OR CBC MIP solver, in process through its C interface
+    (libCbcSolver), found on the library path
+
+    The problem is loaded as column arrays from getCplexStyleArrays,
+    without the MPS/LP files and the cbc process of COIN_CMD,
+    which dominate the solve time of small problems
+
+    :param timeLimit: The number of seconds before forcing the solver to exit
+    :param epgap: The fractional mip tolerance
+    :param threads: The number of threads of the branch and bound
+    :param warmStart: pass the initial values of the variables as a MIP start
+    """
+    try:
+        lib = CBC_DLL_load_dll(cbc_lib_path)
+    except (ImportError, OSError, AttributeError):
+        @classmethod
+        def available(cls):
+            """True if the solver is available"""
+            return False
+        def actualSolve(self, lp):
+            """Solve a well formulated lp problem"""
+            raise PulpSolverError("CBC_DLL: Not Available")
+    else:
+        def __init__(self, mip = 1, msg = 0, timeLimit = None, epgap = None,
+                     threads = None, warmStart = False):
+            LpSolver.__init__(self, mip, msg)
+            self.maxSeconds = timeLimit
+            self.fracGap = epgap
+            self.threads = threads
+            self.warmStart = warmStart
+
+        def copy(self):
+            """Make a copy of self"""
+            aCopy = LpSolver.copy(self)
+            aCopy.maxSeconds = self.maxSeconds
+            aCopy.fracGap = self.fracGap
+            aCopy.threads = self.threads
+            aCopy.warmStart = self.warmStart
+            return aCopy
+
+        @classmethod
+        def available(cls):
+            """True if the solver is available"""
+            return True
+
+        def setParameter(self, model, name, value):
+            self.lib.Cbc_setParameter(model, name.encode(),
+                                      str(value).encode())
+
+        def actualSolve(self, lp):
+            """Solve a well formulated lp problem"""
+            import ctypes
+            infinity = sys.float_info.max
+            (numVars, numRows, numels, rangeCount,
+                objectSense, objectCoeffs, objectConst,
+                rhsValues, rangeValues, rowType, startsBase,
+                lenBase, indBase,
+                elemBase, lowerBounds, upperBounds, initValues, colNames,
+                rowNames, columnType, n2v, n2c) = self.getCplexStyleArrays(
+                    lp, infBound = infinity)
+            #cbc takes row bounds instead of senses and right hand sides
+            NumRowsDoubleArray = ctypes.c_double * numRows
+            rowLower = NumRowsDoubleArray()
+            rowUpper = NumRowsDoubleArray()
+            for i in range(numRows):
+                sense = rowType[i]
+                rowLower[i] = -infinity if sense == b"L" else rhsValues[i]
+                rowUpper[i] = infinity if sense == b"G" else rhsValues[i]
+            model = self.lib.Cbc_newModel()
+            try:
+                self.lib.Cbc_loadProblem(model, numVars, numRows,
+                                         startsBase, indBase, elemBase,
+                                         lowerBounds, upperBounds,
+                                         objectCoeffs, rowLower, rowUpper)
+                self.lib.Cbc_setObjSense(model, objectSense)
+                isMIP = lp.isMIP() and self.mip
+                if isMIP:
+                    for i in range(numVars):
+                        if columnType[i] == b"I":
+                            self.lib.Cbc_setInteger(model, i)
+                if not self.msg:
+                    self.setParameter(model, "log", 0)
+                if self.maxSeconds is not None:
+                    self.setParameter(model, "sec", self.maxSeconds)
+                if self.fracGap is not None:
+                    self.setParameter(model, "ratio", self.fracGap)
+                if self.threads:
+                    self.setParameter(model, "threads", self.threads)
+                if isMIP and self.warmStart and \
+                        hasattr(self.lib, "Cbc_setMIPStartI"):
+                    start = [(i, v.varValue) for i, v in n2v.items()
+                             if v.varValue is not None]
+                    self.lib.Cbc_setMIPStartI(model, len(start),
+                        ctypesArrayFill([i for i, _ in start], ctypes.c_int),
+                        ctypesArrayFill([x for _, x in start]))
+                self.cbcTime = -perf_counter()
+                self.lib.Cbc_solve(model)
+                self.cbcTime += perf_counter()
+
+                if self.lib.Cbc_isProvenOptimal(model):
+                    status = LpStatusOptimal
+                elif self.lib.Cbc_isProvenInfeasible(model):
+                    status = LpStatusInfeasible
+                elif self.lib.Cbc_isContinuousUnbounded(model):
+                    status = LpStatusUnbounded
+                else:
+                    status = LpStatusNotSolved
+                if isMIP:
+                    lp.bestBound = self.lib.Cbc_getBestPossibleObjValue(model)
+                #set on the variables, names may repeat
+                values = self.lib.Cbc_getColSolution(model)[:numVars]
+                for i in range(numVars):
+                    n2v[i].varValue = values[i]
+                activity = self.lib.Cbc_getRowActivity(model)[:numRows]
+                lp.assignConsSlack(dict((n2c[i], rhsValues[i] - activity[i])
+                                        for i in range(numRows)))
+                if not isMIP:
+                    reducedCosts = self.lib.Cbc_getReducedCost(model)
+                    for i in range(numVars):
+                        n2v[i].dj = reducedCosts[i]
+                    prices = self.lib.Cbc_getRowPrice(model)
+                    lp.assignConsPi(dict((n2c[i], prices[i])
+                                         for i in range(numRows)))
+            finally:
+                self.lib.Cbc_deleteModel(model)
+            lp.status = status
+            return lp.status
+
 # to import the gurobipy name into the module scope
 gurobipy = None
 class GUROBI(LpSolver):
@@ -2442,10 +2643,21 @@ try:
         for i,elem in enumerate(myList):
             cList[i] = elem
         return cList
+
+    def ctypesArrayView(array):
+        """
+        Creates a c array with ctypes sharing the buffer of
+        a contiguous numpy array, without copying
+        The c array keeps the numpy array alive
+        """
+        return np.ctypeslib.as_ctypes(np.ascontiguousarray(array))
 except(ImportError):
     def ctypesArrayFill(myList, type = None):
         return None
 
+    def ctypesArrayView(array):
+        return None
+
 class GurobiFormulation(object):
     """
     The Gurobi LP/MIP solver (via its python interface)
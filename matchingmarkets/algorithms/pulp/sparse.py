@@ -23,70 +23,124 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 """
-sparse this module provides basic pure python sparse matrix implementation
-notably this allows the sparse matrix to be output in various formats
+sparse this module provides a basic sparse matrix implementation
+on numpy buffers, notably this allows the sparse matrix to be output
+in the column based (CSC) arrays that solver libraries take
 """
 
-class Matrix(dict):
-    """ This is a dictionary based sparse matrix class
+import numpy as np
+
+class Matrix(object):
+    """ This is a coordinate (COO) sparse matrix class
+
+    Entries are appended to preallocated int32 row / col and float64
+    value buffers, doubled when full. Each entry is stored once.
+    col_based_arrays() sorts them by column into CSC arrays, which
+    solver dlls can read in place through numpy.ctypeslib.as_ctypes
+
+    Rows and columns are indices 0 .. rows - 1 and 0 .. cols - 1
+    Entries are expected to be added once per (row, col)
     """
-    def __init__(self,rows,cols):
+    def __init__(self, rows, cols, capacity = 64):
         """initialises the class by creating a matrix that will have the given
-        rows and columns
+        number of rows and columns, with room for capacity entries
         """
+        capacity = max(int(capacity), 1)
         self.rows = rows
         self.cols = cols
-        self.rowdict = dict([(row, {}) for row in rows])
-        self.coldict = dict([(col, {}) for col in cols])
-    
-    def add(self,row,col,item,colcheck = False, rowcheck = False):
-        if (not(rowcheck and row not in self.rows)):
-            if (not(colcheck and col not in self.cols)):
-                dict.__setitem__(self,(row,col),item)
-                self.rowdict[row][col] = item
-                self.coldict[col][row] = item
-            else:
-                print(self.cols)
-                raise RuntimeError("col %s is not in the matrix columns"%col)
-        else:
-            raise RuntimeError("row %s is not in the matrix rows"%row)
-    
-    def addcol(self,col,rowitems):
-        """adds a column
+        self.row = np.zeros(capacity, dtype = np.int32)
+        self.col = np.zeros(capacity, dtype = np.int32)
+        self.value = np.zeros(capacity, dtype = np.float64)
+        self.numEls = 0
+
+    def __len__(self):
+        return self.numEls
+
+    def _reserve(self, needed):
+        """doubles the buffers until needed more entries fit
+        """
+        size = len(self.row)
+        stop = self.numEls + needed
+        if stop <= size:
+            return
+        while size < stop:
+            size *= 2
+        for attr in ("row", "col", "value"):
+            old = getattr(self, attr)
+            grown = np.zeros(size, dtype = old.dtype)
+            grown[:self.numEls] = old[:self.numEls]
+            setattr(self, attr, grown)
+
+    def _check(self, rows, cols):
+        if len(rows) and (rows.min() < 0 or rows.max() >= self.rows):
+            raise RuntimeError("row %s is not in the matrix rows"
+                               % rows[(rows < 0) | (rows >= self.rows)][0])
+        if len(cols) and (cols.min() < 0 or cols.max() >= self.cols):
+            raise RuntimeError("col %s is not in the matrix columns"
+                               % cols[(cols < 0) | (cols >= self.cols)][0])
+
+    def add(self, row, col, item):
+        self.addentries([row], [col], [item])
+
+    def addentries(self, rows, cols, items):
+        """adds the entries rows[k], cols[k] = items[k]
+        rows or cols can be a single index, shared by every entry
         """
-        if col in self.cols:
-            for row,item in rowitems.items():
-                self.add(row, col, item, colcheck = False)
-        else:
-            raise RuntimeError("col is not in the matrix columns")
-            
-        
-        
-    def get(self,k,d=0):
-        return dict.get(self,k,d)
-    
+        items = np.asarray(items, dtype = np.float64)
+        n = len(items)
+        rows = np.broadcast_to(np.asarray(rows, dtype = np.int32), (n,))
+        cols = np.broadcast_to(np.asarray(cols, dtype = np.int32), (n,))
+        self._check(rows, cols)
+        self._reserve(n)
+        stop = self.numEls + n
+        self.row[self.numEls:stop] = rows
+        self.col[self.numEls:stop] = cols
+        self.value[self.numEls:stop] = items
+        self.numEls = stop
+
+    def addrow(self, row, colitems):
+        """adds a row from a dict {col: item}
+        """
+        n = len(colitems)
+        self.addentries(row,
+                        np.fromiter(colitems.keys(), np.int32, n),
+                        np.fromiter(colitems.values(), np.float64, n))
+
+    def addcol(self, col, rowitems):
+        """adds a column from a dict {row: item}
+        """
+        n = len(rowitems)
+        self.addentries(np.fromiter(rowitems.keys(), np.int32, n),
+                        col,
+                        np.fromiter(rowitems.values(), np.float64, n))
+
+    def get(self, k, d=0):
+        row, col = k
+        found = np.flatnonzero((self.row[:self.numEls] == row) &
+                               (self.col[:self.numEls] == col))
+        if len(found) == 0:
+            return d
+        return self.value[found[-1]].item()
+
     def col_based_arrays(self):
-        numEls = len(self)
-        elemBase = []
-        startsBase = []
-        indBase = []
-        lenBase = []
-        for i,col in enumerate(self.cols):
-            startsBase.append(len(elemBase))
-            elemBase.extend(list(self.coldict[col].values()))
-            indBase.extend(list(self.coldict[col].keys()))
-            lenBase.append(len(elemBase) - startsBase[-1])
-        startsBase.append(len(elemBase))
-        return numEls, startsBase, lenBase, indBase, elemBase
+        """returns numEls and the CSC arrays as contiguous numpy arrays:
+        startsBase (int32, cols + 1), lenBase (int32, cols),
+        indBase (int32, numEls) and elemBase (float64, numEls)
+        entries of a column keep the order they were added in
+        """
+        col = self.col[:self.numEls]
+        order = np.argsort(col, kind = "stable")
+        indBase = self.row[:self.numEls][order]
+        elemBase = self.value[:self.numEls][order]
+        lenBase = np.bincount(col, minlength = self.cols).astype(np.int32)
+        startsBase = np.zeros(self.cols + 1, dtype = np.int32)
+        np.cumsum(lenBase, out = startsBase[1:])
+        return self.numEls, startsBase, lenBase, indBase, elemBase
 
 if __name__ == "__main__":
     """ unit test
     """
-    rows = list(range(10))
-    cols = list(range(50,60))
-    mat = Matrix(rows,cols)
-    mat.add(1,52,"item")
-    mat.add(2,54,"stuff")
+    mat = Matrix(10, 10)
+    mat.add(1, 2, 5.0)
+    mat.add(2, 4, 6.0)
     print(mat.col_based_arrays())
-
-
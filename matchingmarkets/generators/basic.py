@@ -2,21 +2,197 @@ import numpy as np
 
 # Various functions to simulate markets
 
+
+def batched(vector_fct):
+    """
+    Decorator advertising a vectorized version of a generator function
+    The vectorized version is stored in fct.batched
+        and Market.update uses it automatically
+
+    compatFct / matchUtilFct protocol:
+        vector_fct(agents, others, cutoff=1) -> np.array
+        agents, others: mm.AgentArrays of the arriving block
+            and of the pool (columns name, type, type2)
+        cutoff: float or np.array of shape (len(agents), len(others))
+        returns the block of shape (len(agents), len(others))
+
+    success_prob / discount protocol:
+        vector_fct(size) -> np.array of draws of that shape
+
+    typeGenerator / time_to_crit protocol:
+        vector_fct(x, size) -> np.array of size draws
+        x: the generator's input (numTypes or crit_input)
+        arrivals of a period are drawn in one call
+        name (np.array of the arriving agents' names) is passed
+            too if vector_fct takes it
+
+    Functions may also take an rng argument (np.random.Generator)
+    """
+    def decorate(fct):
+        fct.batched = vector_fct
+        return fct
+    return decorate
+
+
+def by_type(compatible, row_field="type", col_field="type"):
+    """
+    Decorator declaring a compatFct / matchUtilFct is 0 unless
+        the agents' types are compatible
+    Markets then only evaluate the function on pairs of agents
+        from compatible type buckets (see mm.AgentPool.types)
+
+    compatible: fct(type) -> list<type> or None
+        types of otherAgent's col_field for which
+        fct(agent, otherAgent) can be nonzero, given agent's row_field
+        None means every type
+    row_field, col_field: "type" or "type2"
+        members of agent and otherAgent the compatibility is based on
+    """
+    def decorate(fct):
+        fct.compatible_types = compatible
+        fct.type_fields = (row_field, col_field)
+        return fct
+    return decorate
+
+
+def _only_same(myType):
+    """
+    compatible types for functions that are 0 across types
+    """
+    return [myType]
+
+
+def _compatible_in(table):
+    """
+    compatible types from a table as in TRANSPLANT_COMPATIBILITY
+    """
+    def compatible(myType):
+        if myType not in table:
+            raise Exception("Blood Type match error with type ", myType)
+        return table[myType]
+    return compatible
+
+
+def _rng(rng):
+    """
+    Source of random draws
+    the global numpy state (np.random) when no Generator is given
+    """
+    return np.random if rng is None else rng
+
+
+def _pair_shape(agents, others):
+    return (len(agents), len(others))
+
+
+def _same_type(agents, others):
+    """
+    Boolean block, True where types are equal
+    """
+    return agents.type[:, np.newaxis] == others.type[np.newaxis, :]
+
+
+def _distinct(agents, others):
+    """
+    Boolean block, True where names differ
+    """
+    return agents.name[:, np.newaxis] != others.name[np.newaxis, :]
+
+
+def _type_table(rows, cols, table):
+    """
+    Boolean block from a compatibility table
+    table: dict<row value, list<col values> or None>
+        None means compatible with everything
+    """
+    result = np.zeros((len(rows), len(cols)), dtype=bool)
+    for value in set(rows.tolist()):
+        if value not in table:
+            raise Exception("Blood Type match error with type ", value)
+        if table[value] is None:
+            result[rows == value] = True
+        else:
+            result[rows == value] = np.isin(cols, table[value])
+    return result
+
+#
+# Arrival, discount and criticality functions
+#
+
+
+def _poissonDraw(rate, size=None, rng=None):
+    return _rng(rng).poisson(rate, size)
+
+
+@batched(_poissonDraw)
+def poissonDraw(rate, rng=None):
+    """
+    arrival_fct / time_to_crit
+    draw from a poisson distribution with parameter rate
+    """
+    return _rng(rng).poisson(rate)
+
+
+def _noDiscount(size=None):
+    return np.ones(size)
+
+
+@batched(_noDiscount)
+def noDiscount():
+    """
+    discount
+    agents don't discount utility over time
+    """
+    return 1
+
 #
 # Agent Type Generating Functions
 #
 
 
-def randomType(numTypes):
+def _singleType(numTypes, size=None):
+    return np.ones(size, dtype=int)
+
+
+@batched(_singleType)
+def singleType(numTypes):
+    """
+    TypeGenerator
+    every agent has type 1
+    """
+    return 1
+
+
+def _randomType(numTypes, size=None, rng=None):
+    if rng is None:
+        return np.random.randint(numTypes, size=size)
+    return rng.integers(numTypes, size=size)
+
+
+@batched(_randomType)
+def randomType(numTypes, rng=None):
     """
     TypeGenerator
     uniformly assigns agent's type
     input is number of categories
     """
-    return np.random.randint(numTypes)
+    if rng is None:
+        return np.random.randint(numTypes)
+    return rng.integers(numTypes)
+
+
+# US distribution of blood types
+BLOOD_TYPES = np.array(["O+", "A+", "B+", "AB+", "O-", "A-", "B-", "AB-"])
+BLOOD_TYPE_WEIGHTS = np.array([0.374, 0.357, 0.085, 0.034,
+                               0.066, 0.063, 0.015, 0.006])
 
 
-def blood_types(no_input):
+def _blood_types(no_input, size=None, rng=None):
+    return _rng(rng).choice(BLOOD_TYPES, size=size, p=BLOOD_TYPE_WEIGHTS)
+
+
+@batched(_blood_types)
+def blood_types(no_input, rng=None):
     """
     TypeGenerator function
     Generates blood types
@@ -24,35 +200,27 @@ def blood_types(no_input):
     Input: void. Input form included only for compatibility
     Returns a string (ex. "AB-" or "O+")
     """
-    rndn = np.random.rand()
-    if rndn < 0.374:
-        return "O+"
-    elif 0.374 < rndn < 0.731:
-        return "A+"
-    elif 0.731 < rndn < 0.816:
-        return "B+"
-    elif 0.816 < rndn < 0.85:
-        return "AB+"
-    elif 0.85 < rndn < 0.916:
-        return "O-"
-    elif 0.916 < rndn < 0.979:
-        return "A-"
-    elif 0.979 < rndn < 0.994:
-        return "B-"
-    elif rndn > 0.994:
-        return "AB-"
-    else:
-        raise Exception("No Blood Type Found")
+    return str(_blood_types(no_input, rng=rng))
 
 
-def alternatingType(numTypes):
+def _alternatingType(numTypes, size=None, name=None):
+    if name is not None:
+        return name % numTypes
+    return np.array([alternatingType(numTypes) for i in range(size)])
+
+
+@batched(_alternatingType)
+def alternatingType(numTypes, name=None):
     """
     TypeGenerator
     ------Should only be used for testing-------
-    Based on a horrible hack using a global var
     Assigns types alternating starting from 0
     Based on the agent's name (expected to be int ordered to market entry)
+        Market.update passes the name of the agent being created
+    Called without a name, falls back on a global counter
     """
+    if name is not None:
+        return name % numTypes
     global alternatingTypeCount
     if 'alternatingTypeCount' not in globals():
         alternatingTypeCount = -1
@@ -61,6 +229,32 @@ def alternatingType(numTypes):
         return 0
     return alternatingTypeCount % numTypes
 
+
+def _coinFlip(size=None, rng=None):
+    return 1*(_rng(rng).random(size) > 0.5)
+
+
+@batched(_coinFlip)
+def coinFlip(rng=None):
+    """
+    success_prob function
+    match succeeds (1) or fails (0) with equal probability
+    """
+    return 1 if _rng(rng).random() > 0.5 else 0
+
+
+def _alwaysSucceed(size=None):
+    return np.ones(size)
+
+
+@batched(_alwaysSucceed)
+def alwaysSucceed():
+    """
+    success_prob function
+    every match succeeds
+    """
+    return 1
+
 ######################################################
 #                                                    #
 # Neighbor Functions                                 #
@@ -69,6 +263,12 @@ def alternatingType(numTypes):
 ######################################################
 
 
+def _neighborSameType(agents, others, cutoff=1):
+    return _same_type(agents, others) & _distinct(agents, others)
+
+
+@by_type(_only_same)
+@batched(_neighborSameType)
 def neighborSameType(agent, otherAgent, cutoff=1):
     """
     compatFct overload
@@ -79,6 +279,12 @@ def neighborSameType(agent, otherAgent, cutoff=1):
     return result
 
 
+def _neighborSameTypeWithSelf(agents, others, cutoff=1):
+    return _same_type(agents, others)
+
+
+@by_type(_only_same)
+@batched(_neighborSameTypeWithSelf)
 def neighborSameTypeWithSelf(agent, otherAgent, cutoff=1):
     """
     compatFct overload
@@ -87,21 +293,35 @@ def neighborSameTypeWithSelf(agent, otherAgent, cutoff=1):
     return agent.type == otherAgent.type
 
 
-def stochastic_neighborSameType(agent, otherAgent, cutoff=1):
+def _stochastic_neighborSameType(agents, others, cutoff=1, rng=None):
+    result = _same_type(agents, others) & _distinct(agents, others)
+    draw = _rng(rng).random(_pair_shape(agents, others))
+    return np.where(draw > cutoff, 0, 1*result)
+
+
+@by_type(_only_same)
+@batched(_stochastic_neighborSameType)
+def stochastic_neighborSameType(agent, otherAgent, cutoff=1, rng=None):
     """
     compatFct overload
     returns 1 if types are same
     """
     result = agent.type == otherAgent.type \
         and agent.name != otherAgent.name
-    draw = np.random.random()
+    draw = _rng(rng).random()
     if draw > cutoff:
         return 0
     else:
         return 1*result
 
 
-def rngDraw(agent, otherAgent, cutoff=1):
+def _rngDraw(agents, others, cutoff=1, rng=None):
+    draw = _rng(rng).random(_pair_shape(agents, others))
+    return 1*(draw > cutoff)
+
+
+@batched(_rngDraw)
+def rngDraw(agent, otherAgent, cutoff=1, rng=None):
     """
     compatFct overload
     used as standard
@@ -109,13 +329,18 @@ def rngDraw(agent, otherAgent, cutoff=1):
     else 0
     cutoff in [0,1]
     """
-    draw = np.random.random()
+    draw = _rng(rng).random()
     if draw > cutoff:
         return 1
     else:
         return 0
 
 
+def _std_compat(agents, others, cutoff=1):
+    return np.broadcast_to(cutoff, _pair_shape(agents, others))
+
+
+@batched(_std_compat)
 def std_compat(agent, otherAgent, cutoff=1):
     """
     compatFct overload
@@ -131,6 +356,12 @@ def std_compat(agent, otherAgent, cutoff=1):
 #####################################################
 
 
+def _utilSameType(agents, others, cutoff=1):
+    return cutoff * _same_type(agents, others)
+
+
+@by_type(_only_same)
+@batched(_utilSameType)
 def utilSameType(agent, otherAgent, cutoff=1):
     """
     matchUtilFct overload
@@ -139,12 +370,30 @@ def utilSameType(agent, otherAgent, cutoff=1):
     return cutoff * (agent.type == otherAgent.type)
 
 
-def utilRandom(agent, otherAgent, cutoff=1):
+def _utilConstant(agents, others, cutoff=1):
+    return np.ones(_pair_shape(agents, others))
+
+
+@batched(_utilConstant)
+def utilConstant(agent, otherAgent, cutoff=1):
+    """
+    matchUtilFct
+    utility = 1 for every match
+    """
+    return 1
+
+
+def _utilRandom(agents, others, cutoff=1, rng=None):
+    return _rng(rng).random(_pair_shape(agents, others))
+
+
+@batched(_utilRandom)
+def utilRandom(agent, otherAgent, cutoff=1, rng=None):
     """
     matchUtilFct
     returns random utility in [0,1]
     """
-    return np.random.random()
+    return _rng(rng).random()
 
 
 #####################################################
@@ -154,7 +403,38 @@ def utilRandom(agent, otherAgent, cutoff=1):
 #                                                   #
 #####################################################
 
+# Receiver types compatible with each donor type (None: all types)
+TRANSPLANT_COMPATIBILITY = {
+    "O+": None, "O-": None,
+    "B+": ["AB+", "AB-", "B+", "B-"], "B-": ["AB+", "AB-", "B+", "B-"],
+    "A+": ["AB+", "AB-", "A+", "A-"], "A-": ["AB+", "AB-", "A+", "A-"],
+    "AB+": ["AB+", "AB-"], "AB-": ["AB+", "AB-"],
+}
+
+BLOOD_COMPATIBILITY = {
+    "O-": None,
+    "O+": ["AB+", "A+", "B+", "O+"],
+    "B-": ["AB+", "AB-", "B+", "B-"],
+    "B+": ["AB+", "B+"],
+    "A-": ["AB+", "AB-", "A+", "A-"],
+    "A+": ["AB+", "A+", "B+", "O+"],
+    "AB-": ["AB+", "AB-"],
+    "AB+": ["AB+"],
+}
+
+
+def _transplant_compatibility(agents, others, cutoff=1):
+    return cutoff * _type_table(agents.type2, others.type,
+                                TRANSPLANT_COMPATIBILITY)
+
+
+def _blood_compatibility(agents, others, cutoff=1):
+    return cutoff * _type_table(agents.type2, others.type,
+                                BLOOD_COMPATIBILITY)
+
 
+@by_type(_compatible_in(TRANSPLANT_COMPATIBILITY), "type2", "type")
+@batched(_transplant_compatibility)
 def transplant_compatibility(agent, otherAgent, cutoff=1):
     """
     Looks for blood type compatibility
@@ -186,6 +466,8 @@ def transplant_compatibility(agent, otherAgent, cutoff=1):
                         otherAgent.name)
 
 
+@by_type(_compatible_in(BLOOD_COMPATIBILITY), "type2", "type")
+@batched(_blood_compatibility)
 def blood_compatibility(agent, otherAgent, cutoff=1):
     """
     Looks for blood type compatibility
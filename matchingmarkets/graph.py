@@ -0,0 +1,261 @@
+import numpy as np
+import networkx as nx
+from scipy import sparse
+
+
+class SparseGraph:
+    """
+    Directed graph of potential matches stored in scipy.sparse
+    Alternative to the NetworkX DiGraph kept by mm.Market
+        (Market(graph_backend="sparse"))
+
+    Nodes are agents, each gets an integer id in order of addition
+    Edges are appended to flat (source, target, weight) arrays
+    Removing a node only tombstones its id: its edges are skipped
+        until the graph is compacted, which happens once half
+        of the ids are dead
+    The CSR adjacency matrix is rebuilt lazily when edges changed
+
+    Supports the NetworkX methods used on Market.Graph
+        (add_node, add_edge, remove_node, nodes, edges, subgraph...)
+    NetworkX algorithms and plotting need to_networkx()
+
+    Attributes
+    ----------
+    agents: list<mm.Agent or None>
+        agent with each id, None once removed
+    ids: dict<mm.Agent, int>
+        id of each live agent
+    multigraph: bool
+        to_networkx() builds a MultiDiGraph instead of a DiGraph
+    """
+    def __init__(self, multigraph=False, capacity=64):
+        capacity = max(int(capacity), 1)
+        self.multigraph = multigraph
+        self.agents = list()
+        self.ids = dict()
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.source = np.zeros(capacity, dtype=np.intp)
+        self.target = np.zeros(capacity, dtype=np.intp)
+        self.weight = np.zeros(capacity)
+        self.n_edges = 0
+        self.n_dead = 0
+        self._csr = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, agent):
+        return agent in self.ids
+
+    #
+    # Construction
+    #
+
+    def add_node(self, agent):
+        if agent in self.ids:
+            return
+        if len(self.agents) == len(self.alive):
+            self.alive = _grown(self.alive, len(self.agents) + 1)
+        self.ids[agent] = len(self.agents)
+        self.alive[len(self.agents)] = True
+        self.agents.append(agent)
+        self._csr = None
+
+    def add_nodes_from(self, agents):
+        for agent in agents:
+            self.add_node(agent)
+
+    def _append_edges(self, source, target, weight):
+        """
+        Appends edges given as arrays of ids
+        """
+        stop = self.n_edges + len(source)
+        if stop > len(self.source):
+            self.source = _grown(self.source, stop)
+            self.target = _grown(self.target, stop)
+            self.weight = _grown(self.weight, stop)
+        self.source[self.n_edges:stop] = source
+        self.target[self.n_edges:stop] = target
+        self.weight[self.n_edges:stop] = weight
+        self.n_edges = stop
+        self._csr = None
+
+    def add_edge(self, u, v, weight=1):
+        """
+        Adds an edge u -> v, and the nodes if needed
+        Edges are expected to be added once,
+            parallel edges are summed in csr()
+        """
+        self.add_node(u)
+        self.add_node(v)
+        self._append_edges([self.ids[u]], [self.ids[v]], [weight])
+
+    def add_weighted_edges_from(self, edges):
+        """
+        Adds edges from an iterable of (u, v, weight)
+        """
+        for u, v, weight in edges:
+            self.add_edge(u, v, weight)
+
+    def add_block(self, rows, cols, mask, weight):
+        """
+        Adds an edge rows[i] -> cols[j] for every True mask[i, j]
+        rows, cols: list<mm.Agent>, already nodes of the graph
+        mask: np.array of bool of shape (len(rows), len(cols))
+        weight: np.array of the same shape
+        """
+        i, j = np.nonzero(mask)
+        if len(i) == 0:
+            return
+        row_ids = np.fromiter((self.ids[a] for a in rows),
+                              dtype=np.intp, count=len(rows))
+        col_ids = np.fromiter((self.ids[a] for a in cols),
+                              dtype=np.intp, count=len(cols))
+        self._append_edges(row_ids[i], col_ids[j], weight[i, j])
+
+    #
+    # Removal
+    #
+
+    def remove_node(self, agent):
+        """
+        Tombstones agent's id, compacts if half of the ids are dead
+        """
+        i = self.ids.pop(agent)
+        self.alive[i] = False
+        self.agents[i] = None
+        self.n_dead += 1
+        self._csr = None
+        if self.n_dead * 2 > len(self.agents):
+            self.compact()
+
+    def remove_nodes_from(self, agents):
+        for agent in agents:
+            self.remove_node(agent)
+
+    def _live_edges(self):
+        """
+        Boolean mask of the stored edges between live nodes
+        """
+        source = self.source[:self.n_edges]
+        target = self.target[:self.n_edges]
+        return self.alive[source] & self.alive[target]
+
+    def compact(self):
+        """
+        Drops the ids and edges of removed agents
+        Live agents are renumbered, keeping their order
+        """
+        live = self._live_edges()
+        new_id = np.cumsum(self.alive[:len(self.agents)]) - 1
+        source = new_id[self.source[:self.n_edges][live]]
+        target = new_id[self.target[:self.n_edges][live]]
+        weight = self.weight[:self.n_edges][live]
+        self.agents = [a for a in self.agents if a is not None]
+        self.ids = {a: i for i, a in enumerate(self.agents)}
+        self.alive[:] = False
+        self.alive[:len(self.agents)] = True
+        self.n_edges = len(source)
+        self.source[:self.n_edges] = source
+        self.target[:self.n_edges] = target
+        self.weight[:self.n_edges] = weight
+        self.n_dead = 0
+        self._csr = None
+
+    #
+    # Queries
+    #
+
+    def csr(self):
+        """
+        scipy.sparse.csr_matrix adjacency of weights, indexed by id
+        Rows and columns of removed agents are empty
+        """
+        if self._csr is None:
+            live = self._live_edges()
+            n = len(self.agents)
+            self._csr = sparse.csr_matrix(
+                (self.weight[:self.n_edges][live],
+                 (self.source[:self.n_edges][live],
+                  self.target[:self.n_edges][live])),
+                shape=(n, n))
+        return self._csr
+
+    def nodes(self):
+        """
+        list of live agents
+        """
+        return list(self.ids)
+
+    def number_of_nodes(self):
+        return len(self.ids)
+
+    def number_of_edges(self):
+        return int(np.count_nonzero(self._live_edges()))
+
+    def edges(self, data=False):
+        """
+        list of (u, v) edges between live agents
+        data=True gives (u, v, {"weight": w}),
+            data="weight" gives (u, v, w), as in NetworkX
+        """
+        live = self._live_edges()
+        source = self.source[:self.n_edges][live].tolist()
+        target = self.target[:self.n_edges][live].tolist()
+        if not data:
+            return [(self.agents[i], self.agents[j])
+                    for i, j in zip(source, target)]
+        weight = self.weight[:self.n_edges][live].tolist()
+        if data is True:
+            return [(self.agents[i], self.agents[j], {"weight": w})
+                    for i, j, w in zip(source, target, weight)]
+        return [(self.agents[i], self.agents[j], w)
+                for i, j, w in zip(source, target, weight)]
+
+    def subgraph(self, agents):
+        """
+        SparseGraph induced by agents, sliced from the CSR matrix
+        agents not in the graph are ignored
+        """
+        agents = [a for a in agents if a in self.ids]
+        ids = np.fromiter((self.ids[a] for a in agents),
+                          dtype=np.intp, count=len(agents))
+        block = self.csr()[ids][:, ids].tocoo()
+        result = SparseGraph(self.multigraph, capacity=len(agents))
+        result.add_nodes_from(agents)
+        result._append_edges(block.row, block.col, block.data)
+        return result
+
+    def to_networkx(self):
+        """
+        NetworkX DiGraph (MultiDiGraph if multigraph) of the live graph
+        """
+        Graph = nx.MultiDiGraph() if self.multigraph else nx.DiGraph()
+        Graph.add_nodes_from(self.ids)
+        Graph.add_weighted_edges_from(self.edges(data="weight"))
+        return Graph
+
+
+def as_networkx(Graph):
+    """
+    Graph as a NetworkX graph, exported if it's a SparseGraph
+    """
+    if isinstance(Graph, SparseGraph):
+        return Graph.to_networkx()
+    return Graph
+
+
+def _grown(array, needed):
+    """
+    array with its length doubled until it holds needed entries
+    """
+    size = len(array)
+    while size < needed:
+        size *= 2
+    grown = np.zeros(size, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
@@ -1,21 +1,38 @@
-from scipy.stats import poisson
+import inspect
+import weakref
+from collections import deque
 import numpy as np
 import networkx as nx
 
-from matchingmarkets.agent import Agent
+from matchingmarkets.agent import AgentArrays
+from matchingmarkets.graph import SparseGraph
+from matchingmarkets.matrix import MatchMatrix
+from matchingmarkets.pool import AgentPool, ColumnarAgentPool
 from matchingmarkets.metaalgorithms import meta_always
 from matchingmarkets.generators.basic import *
 from matchingmarkets.algorithms.basic import *
 
-import matplotlib
-try:
-    matplotlib.use('qt5agg')
-    CANT_PLOT = False
-except ImportError as ie:
-    CANT_PLOT = True
-    print(f"Can't import plotting backend: \n {ie}")
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
+_plt = None
+
+
+def _pyplot():
+    """
+    matplotlib.pyplot on the interactive qt5agg backend
+    Imported on first use so headless markets never load matplotlib
+    Returns None if the backend can't be loaded
+    """
+    global _plt
+    if _plt is None:
+        try:
+            import matplotlib.pyplot
+            # Loads the backend now so a missing Qt binding shows here
+            matplotlib.pyplot.switch_backend('qt5agg')
+            matplotlib.pyplot.ion()  # Interactive plotting
+            _plt = matplotlib.pyplot
+        except ImportError as ie:
+            print(f"Can't import plotting backend: \n {ie}")
+            _plt = False
+    return _plt or None
 
 
 class Market:
@@ -23,8 +40,9 @@ class Market:
     Contains a matching market
     Attributes
     ----------
-    Agents: list<agent>
+    Agents: mm.AgentPool
         container for agents
+        list-like, with O(1) removal and lookup by name
     arrival_rate: int or float
         expected number of arrivals between t and t+1
         Usually the lambda in a poisson process
@@ -45,10 +63,30 @@ class Market:
         cumul sum of utility of succesful matches
     total_agents: int
         total distinct agents who ever entered market
+    holders: dict<name, set<agent>>
+        reverse index of the preference dicts
+        agents whose match_util / match_fail_prob hold "name"
+        used to evict departing agents from survivors' maps
+    Graph: nx.DiGraph or mm.SparseGraph
+        network of potential matches, depending on graph_backend
+        built lazily from the preference maps when not maintained
+    has_graph: bool
+        whether Graph is maintained incrementally in the current update
+    rng: np.random.Generator or None
+        source of the market's random draws
+        None uses the global numpy state
+    matrix: mm.MatchMatrix or None
+        slot-indexed utility and success probability matrices
+        backing agents' preference maps when the matrix engine is on
+    kidney_timings: deque<dict>
+        seconds spent in each step by kidney exchange algorithms,
+        one dict per call, for the last 1000 calls
     """
-    def __init__(self, arrival_rate=1, success_prob=lambda: 1,
-                 max_agents=1000, graph=True, plots=False,
-                 plot_time=0.5, selfMatch=False,):
+    def __init__(self, arrival_rate=1, success_prob=alwaysSucceed,
+                 max_agents=1000, graph=None, plots=False,
+                 plot_time=0.5, selfMatch=False, matrix=False,
+                 columnar=False, graph_backend="networkx",
+                 seed=None, rng=None):
         """
         Generate new market object
         Arguments
@@ -61,21 +99,45 @@ class Market:
             parameter passed in a match probability function
         max_agents: int
             maximum number of agents over all periods in Market
-        graph: bool
-            store network of potential matches in a NetworkX DiGraph object
-            necessary for graph plotting
         plots: bool
             output network graph plots 3 times per update
         plot_time: float
             time per frame on plot
-        graph: bool
+        graph: bool or None
             if True, market maintains a networkX DiGraph object
             nodes are agents, directed edges are compatibility
             edge weight is expected match utility
                 so match utility * match success probability
-        max
+            if False, no graph is maintained, Market.Graph is built
+                from the preference maps when accessed
+            if None (default), the graph is maintained only in updates
+                whose algorithm has needs_graph set (see
+                algorithms.needs_graph) or when plotting
+        graph_backend: "networkx" or "sparse"
+            "networkx" keeps Graph as a NetworkX DiGraph
+            "sparse" keeps it as a mm.SparseGraph (scipy.sparse),
+                exported to NetworkX only where NetworkX is needed
+            plotting always uses "networkx"
+        matrix: bool
+            if True, match utilities and success probabilities are
+            stored in dense NumPy matrices (see mm.MatchMatrix)
+            agents' match_util and match_fail_prob become row views
+            arrivals fill whole row and column blocks at once
+        columnar: bool
+            if True, agents' members are stored in NumPy columns
+            (see mm.ColumnarAgentPool), so time updates and
+            criticality counts are vectorized over the pool
+        seed: None, int or np.random.SeedSequence
+            seed of the market's random number generator
+        rng: np.random.Generator
+            random number generator of the market (overrides seed)
+            passed to arrival, criticality, type, compat, utility
+            and success_prob functions that take an "rng" argument,
+            and used by algorithms to break ties
+            if neither seed nor rng are given, draws come from
+            the global numpy state (np.random)
         """
-        self.Agents = list()
+        self.Agents = ColumnarAgentPool() if columnar else AgentPool()
         self.arrival_rate = arrival_rate
         self.acceptable_prob = success_prob
         self.max_agents = max_agents
@@ -86,21 +148,26 @@ class Market:
         self.welfare = 0
         self.total_agents = 0
         self.loss = 0
-        self.has_graph = graph
+        if graph_backend not in ("networkx", "sparse"):
+            raise Exception("Unknown graph backend ", graph_backend)
+        self.graph_backend = graph_backend
+        self.graph_setting = graph
+        self.has_graph = graph is True
+        self._graph = None
         self.plots_on = plots
         self.selfMatch = selfMatch
-        if self.has_graph:
-            if self.selfMatch:
-                self.Graph = nx.MultiDiGraph()
-            else:
-                self.Graph = nx.DiGraph()
+        self.matrix = MatchMatrix() if matrix else None
+        if rng is None and seed is not None:
+            rng = np.random.default_rng(seed)
+        self.rng = rng
+        self.holders = dict()
+        self.kidney_timings = deque(maxlen=1000)
         if self.plots_on:
-            if CANT_PLOT:
+            if _pyplot() is None:
                 print("WARNING: Cant plot dur to qt5agg backend import error")
                 self.plots_on = False
-            plt.ion()  # Interactive plotting
-            self.has_graph = True
-            self.Graph = nx.DiGraph()
+            self.graph_setting = self.has_graph = True
+            self.graph_backend = "networkx"
             self.graph_labels = dict()
             self.color_map = dict()
             self.graph_colors = list()
@@ -119,11 +186,11 @@ class Market:
 
 
     def update(self, metaAlgorithm=meta_always, algorithm=arbitraryMatch,
-               compatFct=std_compat, discount=lambda: 1, algoParams=dict(),
-               matchUtilFct=lambda x, y, **kwarg: 1, utilityFctInput=1,
-               time_to_crit=lambda x: poisson.rvs(x), crit_input=0,
-               typeGenerator=lambda x: 1, typeGen2=lambda x: 1, numTypes=1,
-               verbose=False, arrival_fct=lambda x: poisson.rvs(x)
+               compatFct=std_compat, discount=noDiscount, algoParams=dict(),
+               matchUtilFct=utilConstant, utilityFctInput=1,
+               time_to_crit=poissonDraw, crit_input=0,
+               typeGenerator=singleType, typeGen2=singleType, numTypes=1,
+               verbose=False, arrival_fct=poissonDraw
                ):
         """
         Updates the market to a new time period
@@ -140,6 +207,7 @@ class Market:
             Matching Algorithm
             takes current agents in market as input
             returns a list of matches
+            an agent matched to None leaves without match utility
             see algorithms.py for details
         arrival_fct: fct(float) -> int
             function that returns number of arrival this period
@@ -179,6 +247,11 @@ class Market:
         verbose: bool
             print on relevant actions in update
         """
+        # Maintain the graph only if asked or if the algorithm reads it
+        if self.graph_setting is None:
+            self.has_graph = getattr(algorithm, "needs_graph", False)
+        if not self.has_graph:
+            self._graph = None
         # If verbose, welcome message
         if verbose:
             print("\n\n--------------------Verbose Update--------------------")
@@ -188,6 +261,7 @@ class Market:
         #
         # Plot state coming in
         #
+        plt = _pyplot() if self.plots_on else None
         if self.plots_on:
             # Fill color dict
             if self.time == 0:
@@ -197,6 +271,7 @@ class Market:
                 type_names = set()
                 for i in range(10000):
                     type_names.add(typeGenerator(numTypes))
+                from matplotlib import cm
                 colors = iter(cm.rainbow(np.linspace(0, 1, len(type_names))))
                 for i in type_names:
                     self.color_map[i] = next(colors)
@@ -228,19 +303,25 @@ class Market:
         # Check if market full, if not get new arrivals
         #
         if self.total_agents < self.max_agents:
-            new_agents = arrival_fct(self.arrival_rate)
+            new_agents = self._draw(arrival_fct, self.arrival_rate)
             if verbose:
                 print("New Agents: ", new_agents)
+            # Draw the arrivals' attributes, one call per attribute
+            # when generators are batched
+            names = np.arange(self.total_agents,
+                              self.total_agents + new_agents)
+            new_discounts = self._draw_arrivals(discount, names)
+            new_times_to_crit = self._draw_arrivals(time_to_crit, names,
+                                                    crit_input)
+            new_types = self._draw_arrivals(typeGenerator, names, numTypes)
+            new_types2 = self._draw_arrivals(typeGen2, names, numTypes)
             # Create new agents to market
             for i in range(new_agents):
-                new_discount = discount()
-                new_time_to_crit = time_to_crit(crit_input)
-                new_type = typeGenerator(numTypes)
-                new_type2 = typeGen2(numTypes)
-                newAgent = Agent(name=self.total_agents,
-                                 discount_rate=new_discount,
-                                 time_to_critical=new_time_to_crit,
-                                 myType=new_type, myType2=new_type2)
+                newAgent = self.Agents.agent_class(
+                    name=self.total_agents,
+                    discount_rate=new_discounts[i],
+                    time_to_critical=new_times_to_crit[i],
+                    myType=new_types[i], myType2=new_types2[i])
                 self.Agents.append(newAgent)
                 # Update DiGraph with new nodes
                 if self.has_graph:
@@ -249,78 +330,15 @@ class Market:
                         self.graph_labels[newAgent] = \
                              newAgent.time_to_critical - newAgent.sojourn
                 self.total_agents += 1
-            if verbose:
-                print("\nAdding new agents to existings' preference maps")
-            # Add new agents to existings' preference maps
-            for oldAgent in self.Agents[:-new_agents]:
-                for newAgent in self.Agents[-new_agents:]:
-                    oldAgent.addNewToMap(
-                                newAgent,
-                                utilityResult=matchUtilFct(oldAgent,
-                                                           newAgent,
-                                                           cutoff=utilityFctInput),
-                                failProbResult=compatFct(oldAgent,
-                                                         newAgent,
-                                                         cutoff=self.acceptable_prob()
-                                                         )
-                                         )
-                    # Add new edge to nx Graph
-                    if self.has_graph:
-                        if oldAgent.match_fail_prob[newAgent.name] > 0:
-                            self.Graph.add_edge(
-                                    oldAgent, newAgent,
-                                    weight=oldAgent.match_fail_prob[newAgent.name] *
-                                    oldAgent.match_util[newAgent.name])
-                if verbose:
-                    print("\nAgent ", oldAgent.name, "( type", oldAgent.type,
-                          ") Life left",
-                          oldAgent.time_to_critical - oldAgent.sojourn,
-                          "-------------------------\n\tMatch Util ",
-                          oldAgent.match_util, "\n\tMatch Fail Prob ",
-                          oldAgent.match_fail_prob)
-            if verbose:
-                print("\nFilling preference maps of new agents")
-            # Fill preference maps of new agents
-            for newAgent in self.Agents[-new_agents:]:
-                for otherAgent in [x for i, x
-                                   in enumerate(self.Agents) if i != newAgent]:
-                        newAgent.addNewToMap(
-                                    otherAgent,
-                                    utilityResult=matchUtilFct(newAgent,
-                                                               otherAgent,
-                                                               cutoff=utilityFctInput
-                                                               ),
-                                    failProbResult=compatFct(
-                                                        newAgent,
-                                                        otherAgent,
-                                                        cutoff=self.acceptable_prob()
-                                                            )
-                                             )
-                        # If self matches not allowed, clean maps
-                        if self.selfMatch is not True:
-                            newAgent.match_util[newAgent.name] = 0
-                            newAgent.match_fail_prob[newAgent.name] = 0
-                        # Add new edge to nx Graph
-                        if self.has_graph:
-                            if newAgent.match_fail_prob[otherAgent.name] > 0:
-                                self.Graph.add_edge(
-                                    newAgent, otherAgent,
-                                    weight=newAgent.match_fail_prob[otherAgent.name] *
-                                    newAgent.match_util[otherAgent.name]
-                                                    )
-                if verbose:
-                    print("\nAgent ", newAgent.name, " ( type", newAgent.type,
-                          ") Life Left:",
-                          newAgent.time_to_critical - newAgent.sojourn,
-                          "-------------------------\n\tMatch Util ",
-                          newAgent.match_util, "\n\tMatch success Prob ",
-                          newAgent.match_fail_prob)
+            if new_agents > 0:
+                newAgents = self.Agents[-new_agents:]
+                self._fill_maps(newAgents, compatFct, matchUtilFct,
+                                utilityFctInput, verbose=verbose)
         #
         # update time on agents
         #
         self.time += 1
-        for agent in self.Agents:
-            agent.update()
+        self.Agents.update()
 
         #
         # plot new arrivals
@@ -419,10 +437,12 @@ class Market:
         for agent in self.Agents:
             if agent.name in matches.keys():
                 before = self.welfare
-                self.welfare += agent.utilFct(t=agent.sojourn,
-                                              matchUtility=agent.match_util[
-                                                  matches[agent.name]]
-                                              )
+                # Matched to None: leaves the market without a partner
+                # (ex. the end of a kidney chain), no utility
+                if matches[agent.name] is not None:
+                    self.welfare += agent.utilFct(
+                        t=agent.sojourn,
+                        matchUtility=agent.match_util[matches[agent.name]])
                 if verbose:
                     print("\nUtility ", agent.name, " ", self.welfare-before, " sojourn ", agent.sojourn)
 
@@ -445,6 +465,13 @@ class Market:
                 if self.plots_on:
                     if agent in self.graph_labels:
                         del self.graph_labels[agent]
+            else:
+                # Graph built during matching is now stale
+                self._graph = None
+            if self.matrix is not None:
+                self.matrix.remove(agent)
+            else:
+                self._evict(agent)
             self.Agents.remove(agent)
         if verbose:
             print("Perished: ")
@@ -468,13 +495,326 @@ class Market:
             if verbose:
                 print("Loss ", self.loss)
 
+    def _fill_maps(self, newAgents, compatFct, matchUtilFct,
+                   utilityFctInput, verbose=False):
+        """
+        Fills preference maps with the arrivals in newAgents
+        Existing agents get entries for new agents,
+        new agents get entries for everyone in the market
+        Both are computed as blocks (see _pair_block)
+            then written to the dicts or to self.matrix
+        """
+        oldAgents = self.Agents[:-len(newAgents)]
+        old = self.Agents.arrays(0, len(oldAgents))
+        new = self.Agents.arrays(len(oldAgents))
+        everyone = self.Agents.arrays()
+        # Rows: new agents against everyone, including themselves
+        n_old, n = len(oldAgents), len(self.Agents)
+        util_rows = self._pair_block(matchUtilFct, newAgents, self.Agents,
+                                     utilityFctInput, (new, everyone),
+                                     ((n_old, n), (0, n)))
+        prob_rows = self._pair_block(compatFct, newAgents, self.Agents,
+                                     self.acceptable_prob, (new, everyone),
+                                     ((n_old, n), (0, n)))
+        # If self matches not allowed, clean diagonal
+        if self.selfMatch is not True:
+            diag = np.arange(len(newAgents))
+            util_rows[diag, len(oldAgents) + diag] = 0
+            prob_rows[diag, len(oldAgents) + diag] = 0
+        # Columns: existing agents against new agents
+        util_cols = self._pair_block(matchUtilFct, oldAgents, newAgents,
+                                     utilityFctInput, (old, new),
+                                     ((0, n_old), (n_old, n)))
+        prob_cols = self._pair_block(compatFct, oldAgents, newAgents,
+                                     self.acceptable_prob, (old, new),
+                                     ((0, n_old), (n_old, n)))
+        if verbose:
+            print("\nAdding new agents to existings' preference maps")
+        if self.matrix is not None:
+            new_slots = self.matrix.add(newAgents)
+            old_slots = self.matrix.slots(oldAgents)
+            all_slots = np.concatenate((old_slots, new_slots))
+            self.matrix.set_block(new_slots, all_slots, util_rows, prob_rows)
+            self.matrix.set_block(old_slots, new_slots, util_cols, prob_cols)
+        else:
+            all_names = [a.name for a in self.Agents]
+            new_names = all_names[len(oldAgents):]
+            for i, newAgent in enumerate(newAgents):
+                newAgent.match_util.update(zip(all_names,
+                                               util_rows[i].tolist()))
+                newAgent.match_fail_prob.update(zip(all_names,
+                                                    prob_rows[i].tolist()))
+            for i, oldAgent in enumerate(oldAgents):
+                oldAgent.match_util.update(zip(new_names,
+                                               util_cols[i].tolist()))
+                oldAgent.match_fail_prob.update(zip(new_names,
+                                                    prob_cols[i].tolist()))
+            # Everyone now holds the new agents,
+            # new agents hold everyone
+            for name in all_names[:len(oldAgents)]:
+                self.holders[name].update(newAgents)
+            for name in new_names:
+                self.holders[name] = set(self.Agents)
+        # Add new edges to Graph
+        if self.has_graph:
+            for rows, cols, util, prob in (
+                    (newAgents, self.Agents, util_rows, prob_rows),
+                    (oldAgents, newAgents, util_cols, prob_cols)):
+                self._add_edges(self.Graph, rows, cols, prob, util)
+        if verbose:
+            for agent in self.Agents:
+                print("\nAgent ", agent.name, " ( type", agent.type,
+                      ") Life Left:",
+                      agent.time_to_critical - agent.sojourn,
+                      "-------------------------\n\tMatch Util ",
+                      agent.match_util, "\n\tMatch success Prob ",
+                      agent.match_fail_prob)
+
+    def _evict(self, agent):
+        """
+        Deletes a departing agent from the preference maps holding it
+            and releases its own maps
+        Uses the self.holders reverse index, so cost is O(degree)
+        """
+        for holder in self.holders.pop(agent.name, ()):
+            holder.match_util.pop(agent.name, None)
+            holder.match_fail_prob.pop(agent.name, None)
+        for name in agent.match_util:
+            if name in self.holders:
+                self.holders[name].discard(agent)
+        agent.match_util = dict()
+        agent.match_fail_prob = dict()
+
+    def _pair_block(self, fct, rows, cols, cutoff, arrays=None, span=None):
+        """
+        Evaluates fct(agent, otherAgent, cutoff) on every pair
+            of rows x cols
+        If fct advertises a batched version (see generators.batched),
+            the whole block is computed in one call
+        Otherwise fct is called once per pair (e.g. user lambdas)
+        cutoff: float or f() -> float
+            if callable, drawn once per pair
+        arrays: (mm.AgentArrays, mm.AgentArrays) or None
+            columns of rows and cols, if already available
+        span: ((int, int), (int, int)) or None
+            positions of rows and cols in self.Agents
+            if given and fct declares its compatible types
+            (see generators.by_type), fct (or its batched version)
+            is only evaluated on pairs from compatible type buckets
+        Returns
+        -------
+        np.array of shape (len(rows), len(cols))
+        """
+        shape = (len(rows), len(cols))
+        if callable(cutoff):
+            cutoff = self._draw_block(cutoff, shape)
+        if span is not None and hasattr(fct, "compatible_types") and \
+                self.Agents.types is not None:
+            return self._typed_block(fct, rows, cols, cutoff, arrays, span)
+        if hasattr(fct, "batched"):
+            if arrays is None:
+                arrays = (AgentArrays.from_agents(rows),
+                          AgentArrays.from_agents(cols))
+            block = fct.batched(*arrays, cutoff=cutoff,
+                                **self._rng_kwarg(fct.batched))
+            return np.array(np.broadcast_to(block, shape), dtype=float)
+        if np.ndim(cutoff) == 0:
+            cutoff = np.broadcast_to(cutoff, shape)
+        kwargs = self._rng_kwarg(fct)
+        block = np.fromiter((fct(a, b, cutoff=cutoff[i, j], **kwargs)
+                             for i, a in enumerate(rows)
+                             for j, b in enumerate(cols)),
+                            dtype=float, count=shape[0] * shape[1])
+        return block.reshape(shape)
+
+    def _typed_block(self, fct, rows, cols, cutoff, arrays, span):
+        """
+        _pair_block for functions declaring compatible types
+        Rows are grouped by type, and each group is only evaluated
+            against the pool's buckets of compatible types
+        Other entries are 0
+        """
+        (row_start, row_stop), (col_start, col_stop) = span
+        row_field, col_field = fct.type_fields
+        block = np.zeros((len(rows), len(cols)))
+        groups = self.Agents.groups(row_field, row_start, row_stop)
+        for value, sub_rows in groups.items():
+            compatible = fct.compatible_types(value)
+            if compatible is None:
+                sub_cols = np.arange(len(cols))
+            else:
+                sub_cols = self.Agents.positions(col_field, compatible,
+                                                 col_start, col_stop)
+            if len(sub_cols) == 0:
+                continue
+            sub = np.ix_(sub_rows, sub_cols)
+            sub_arrays = None
+            if arrays is not None:
+                sub_arrays = (arrays[0].take(sub_rows),
+                              arrays[1].take(sub_cols))
+            if sub_arrays is not None and hasattr(fct, "batched"):
+                # Only the sizes of the agent lists are read
+                sub_agents = (sub_rows, sub_cols)
+            else:
+                sub_agents = ([rows[i] for i in sub_rows.tolist()],
+                              [cols[j] for j in sub_cols.tolist()])
+            block[sub] = self._pair_block(
+                fct, *sub_agents,
+                cutoff if np.ndim(cutoff) == 0 else cutoff[sub],
+                sub_arrays)
+        return block
+
+    def _draw(self, fct, *args, **kwargs):
+        """
+        Calls a generator function
+        Keyword arguments (and the market's rng) are only passed
+            if fct takes an argument of that name
+        """
+        kwargs["rng"] = self.rng
+        return fct(*args, **{key: value for key, value in kwargs.items()
+                             if _takes_kwarg(fct, key)})
+
+    def _rng_kwarg(self, fct):
+        """
+        {"rng": self.rng} if fct takes an rng argument, else empty
+        """
+        if _takes_kwarg(fct, "rng"):
+            return {"rng": self.rng}
+        return dict()
+
+    def _draw_arrivals(self, fct, names, *args):
+        """
+        list of draws of fct(*args), one per arriving agent in names
+        Uses fct.batched(*args, size=len(names)) when advertised
+            (see generators.batched)
+        """
+        if hasattr(fct, "batched"):
+            draws = self._draw(fct.batched, *args, size=len(names),
+                               name=names)
+            return np.broadcast_to(draws, (len(names),) +
+                                   np.shape(draws)[1:]).tolist()
+        return [self._draw(fct, *args, name=name)
+                for name in names.tolist()]
+
+    def _draw_block(self, fct, shape):
+        """
+        Array of draws from fct() of the given shape
+        Uses fct.batched(size=shape) when advertised
+        """
+        if hasattr(fct, "batched"):
+            return np.broadcast_to(
+                fct.batched(size=shape, **self._rng_kwarg(fct.batched)),
+                shape)
+        kwargs = self._rng_kwarg(fct)
+        return np.fromiter((fct(**kwargs)
+                            for i in range(shape[0] * shape[1])),
+                           dtype=float,
+                           count=shape[0] * shape[1]).reshape(shape)
+
+    @property
+    def Graph(self):
+        """
+        Graph of potential matches (see graph_backend)
+        Built from the preference maps if not already up to date
+        """
+        if self._graph is None:
+            self._graph = self._build_graph()
+        return self._graph
+
+    @Graph.setter
+    def Graph(self, value):
+        self._graph = value
+
+    def _build_graph(self):
+        """
+        Graph of the current pool from the preference maps
+        edge weight is match utility * match success probability
+        """
+        if self.graph_backend == "sparse":
+            Graph = SparseGraph(multigraph=self.selfMatch)
+        elif self.selfMatch:
+            Graph = nx.MultiDiGraph()
+        else:
+            Graph = nx.DiGraph()
+        Graph.add_nodes_from(self.Agents)
+        if self.matrix is not None:
+            slots = self.matrix.slots(self.Agents)
+            block = np.ix_(slots, slots)
+            self._add_edges(Graph, self.Agents, self.Agents,
+                            self.matrix.prob[block], self.matrix.util[block])
+        else:
+            for agent in self.Agents:
+                for name, prob in agent.match_fail_prob.items():
+                    if prob > 0 and name in self.Agents:
+                        Graph.add_edge(agent, self.Agents.get(name),
+                                       weight=prob * agent.match_util[name])
+        return Graph
+
+    @staticmethod
+    def _add_edges(Graph, rows, cols, prob, util):
+        """
+        Adds an edge rows[i] -> cols[j] for every prob[i, j] > 0
+        edge weight is prob * util
+        """
+        if isinstance(Graph, SparseGraph):
+            Graph.add_block(rows, cols, prob > 0, prob * util)
+            return
+        for i, j in zip(*np.nonzero(prob > 0)):
+            Graph.add_edge(rows[i], cols[j], weight=prob[i, j] * util[i, j])
+
+    def preferences(self, rows, cols):
+        """
+        Match utilities and success probabilities between two lists
+            of agents, as arrays of shape (len(rows), len(cols))
+        Entry [i, j] is for rows[i] matching cols[j]
+            (0 where rows[i] holds no entry for cols[j])
+        Returns
+        -------
+        (util, prob) tuple of np.array
+        """
+        if self.matrix is not None:
+            row_slots = self.matrix.slots(rows)
+            col_slots = self.matrix.slots(cols)
+            block = np.ix_(row_slots, col_slots)
+            return self.matrix.util[block], self.matrix.prob[block]
+        names = [b.name for b in cols]
+        util = np.array([[a.match_util.get(name, 0) for name in names]
+                         for a in rows], dtype=float)
+        prob = np.array([[a.match_fail_prob.get(name, 0) for name in names]
+                         for a in rows], dtype=float)
+        return (util.reshape(len(rows), len(cols)),
+                prob.reshape(len(rows), len(cols)))
+
     def critical(self):
         """
         Returns:
             # of critical agents in market at current time
         """
-        counter = 0
-        for i in self.Agents:
-            if i.is_critical:
-                counter += 1
-        return counter
+        return self.Agents.critical()
+
+
+_arg_names_cache = weakref.WeakKeyDictionary()
+
+
+def _takes_kwarg(fct, name):
+    """
+    Whether fct has an argument called name
+    Argument names are cached as long as fct is alive
+    """
+    try:
+        names = _arg_names_cache[fct]
+    except (KeyError, TypeError):
+        names = _arg_names(fct)
+        try:
+            _arg_names_cache[fct] = names
+        except TypeError:
+            # not weak-referenceable (builtins)
+            pass
+    return name in names
+
+
+def _arg_names(fct):
+    try:
+        return frozenset(inspect.signature(fct).parameters)
+    except (TypeError, ValueError):
+        return frozenset()
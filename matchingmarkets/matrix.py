@@ -0,0 +1,195 @@
+import numpy as np
+
+
+class MatchMatrix:
+    """
+    Dense store of pairwise match utilities and success probabilities
+    Replaces the per-agent match_util / match_fail_prob dicts
+
+    Every live agent owns a slot (row and column index)
+    util[i, j] is the utility for agent in slot i of matching slot j
+    prob[i, j] is the success probability of that match
+    Slots of removed agents are recycled, so the matrices stay
+    bounded by the largest live pool, not by total arrivals
+
+    Attributes
+    ----------
+    util: np.array (capacity x capacity)
+        match utility, indexed by slot
+    prob: np.array (capacity x capacity)
+        match success probability, indexed by slot
+    agents: list<mm.Agent or None>
+        agent in each slot
+    names: np.array<object>
+        name of the agent in each slot, None for free slots
+    slot_of: dict<name, int>
+        slot of each live agent
+    """
+    def __init__(self, capacity=64):
+        capacity = max(int(capacity), 1)
+        self.util = np.zeros((capacity, capacity))
+        self.prob = np.zeros((capacity, capacity))
+        self.agents = [None] * capacity
+        self.names = np.full(capacity, None, dtype=object)
+        self.slot_of = dict()
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __contains__(self, name):
+        return name in self.slot_of
+
+    @property
+    def capacity(self):
+        return len(self.agents)
+
+    def _grow(self, needed):
+        """
+        Doubles capacity until needed slots fit
+        """
+        old = self.capacity
+        new = old
+        while new - len(self.slot_of) < needed:
+            new *= 2
+        if new == old:
+            return
+        for attr in ("util", "prob"):
+            grown = np.zeros((new, new))
+            grown[:old, :old] = getattr(self, attr)
+            setattr(self, attr, grown)
+        self.agents.extend([None] * (new - old))
+        names = np.full(new, None, dtype=object)
+        names[:old] = self.names
+        self.names = names
+        self.free = list(range(new - 1, old - 1, -1)) + self.free
+
+    def add(self, agents):
+        """
+        Gives each agent a slot and binds its preference maps
+            to views of the matrix rows
+        Returns
+        -------
+        np.array of the new slots, in input order
+        """
+        self._grow(len(agents))
+        slots = np.empty(len(agents), dtype=np.intp)
+        for i, agent in enumerate(agents):
+            slot = self.free.pop()
+            self.agents[slot] = agent
+            self.names[slot] = agent.name
+            self.slot_of[agent.name] = slot
+            agent.match_util = MatrixRow(self, "util", slot)
+            agent.match_fail_prob = MatrixRow(self, "prob", slot)
+            slots[i] = slot
+        return slots
+
+    def remove(self, agent):
+        """
+        Frees an agent's slot
+        The agent's preference maps are released
+        """
+        slot = self.slot_of.pop(agent.name)
+        self.util[slot, :] = 0
+        self.util[:, slot] = 0
+        self.prob[slot, :] = 0
+        self.prob[:, slot] = 0
+        self.agents[slot] = None
+        self.names[slot] = None
+        self.free.append(slot)
+        agent.match_util = dict()
+        agent.match_fail_prob = dict()
+
+    def live_slots(self):
+        """
+        np.array of occupied slots, in increasing order
+        """
+        return np.fromiter(sorted(self.slot_of.values()), dtype=np.intp,
+                           count=len(self.slot_of))
+
+    def slots(self, Agents):
+        """
+        np.array of the slots of a list of agents, in list order
+        """
+        return np.fromiter((self.slot_of[a.name] for a in Agents),
+                           dtype=np.intp, count=len(Agents))
+
+    def set_block(self, rows, cols, util, prob):
+        """
+        Writes a whole block of utilities and probabilities
+        rows, cols: np.array of slots
+        util, prob: np.array of shape (len(rows), len(cols))
+        """
+        block = np.ix_(rows, cols)
+        self.util[block] = util
+        self.prob[block] = prob
+
+    def weights(self, Agents, cols=None):
+        """
+        Expected utility matrix (utility * success probability)
+            between agents in Agents (rows) and cols (default: Agents)
+        Row/column order follows the input lists
+        """
+        rows = self.slots(Agents)
+        cols = rows if cols is None else self.slots(cols)
+        block = np.ix_(rows, cols)
+        return self.util[block] * self.prob[block]
+
+
+class MatrixRow:
+    """
+    dict-like view of one agent's row in a MatchMatrix
+    Keys are names of live agents, values read from the matrix
+    """
+    __slots__ = ("owner", "kind", "slot")
+
+    def __init__(self, owner, kind, slot):
+        self.owner = owner
+        self.kind = kind
+        self.slot = slot
+
+    def _row(self):
+        # Looked up every time: owner arrays are replaced when growing
+        return getattr(self.owner, self.kind)[self.slot]
+
+    def __getitem__(self, name):
+        return self._row()[self.owner.slot_of[name]].item()
+
+    def __setitem__(self, name, value):
+        self._row()[self.owner.slot_of[name]] = value
+
+    def __contains__(self, name):
+        return name in self.owner.slot_of
+
+    def __iter__(self):
+        return iter(self.owner.slot_of)
+
+    def __len__(self):
+        return len(self.owner.slot_of)
+
+    def keys(self):
+        return self.owner.slot_of.keys()
+
+    def get(self, name, default=None):
+        if name in self.owner.slot_of:
+            return self[name]
+        return default
+
+    def items(self):
+        row = self._row()
+        return [(name, row[slot].item())
+                for name, slot in self.owner.slot_of.items()]
+
+    def values(self):
+        return [v for _, v in self.items()]
+
+    def neighbors(self):
+        """
+        names of live agents with a nonzero entry
+        """
+        # Free slots hold zeros, so only live agents come out
+        row = self._row()
+        return self.owner.names[np.flatnonzero(row > 0)].tolist()
+
+    def __repr__(self):
+        return repr(dict(self.items()))
@@ -46,8 +46,11 @@ def meta_patient(Market, match=arbitraryMatch, a=np.inf,
     """
     if verbose:
         print("meta_patient")
-    AgentList = [ag for ag in Market.Agents if ag.is_critical or
-                 ag.sojourn == a]
+    AgentList = Market.Agents.critical_agents()
+    AgentList += [ag for ag in Market.Agents.with_sojourn(a)
+                  if not ag.is_critical]
+    # Matching algorithms depend on the order of agents
+    AgentList = Market.Agents.ordered(AgentList)
     return match(Market, AgentList, verbose=verbose, **kwargs)
 
 
@@ -57,7 +60,7 @@ def meta_greedy(Market, match=arbitraryMatch, verbose=False, **kwargs):
     """
     if verbose:
         print("meta_greedy")
-    AgentList = [ag for ag in Market.Agents if ag.sojourn == 0]
+    AgentList = Market.Agents.new_agents()
     return match(Market, AgentList, verbose=verbose, **kwargs)
 
 
@@ -72,7 +75,7 @@ def meta_agents_critical(Market, match=arbitraryMatch, agents=5,
     if len(Market.Agents) == agents:
         return match(Market, Market.Agents, verbose=verbose, **kwargs)
     if Market.critical() > num_critical:
-        AgentList = [ag for ag in Market.Agents if ag.is_critical]
+        AgentList = Market.Agents.ordered(Market.Agents.critical_agents())
         return match(Market, AgentList, verbose=verbose, **kwargs)
     else:
         return dict()
@@ -0,0 +1,382 @@
+import numpy as np
+
+from matchingmarkets.agent import Agent, AgentArrays
+
+
+class AgentPool:
+    """
+    Container of the agents in a market
+    O(1) append, remove, membership and lookup by name
+
+    Agents are stored in a list in arrival order, with the position
+    of each one indexed by name. Removing an agent leaves a hole in
+    its position, the holes are compacted away in O(n) on the next
+    positional access (iteration, indexing, slicing), so a batch of
+    removals costs one pass.
+    Supports the list operations used on Market.Agents
+    (iteration, len, positional indexing and slicing)
+
+    The pool also indexes critical agents and arrival cohorts,
+    so metaalgorithms can get the critical agents or the agents
+    of a given sojourn in O(k) for k agents returned.
+    Agents are also bucketed by type and type2, so markets can find
+    the agents of compatible types without scanning the pool
+    Time must be advanced with update() for these to stay valid
+
+    Attributes
+    ----------
+    agents: list<mm.Agent>
+        the agents in the pool, in arrival order
+    index: dict<name, int>
+        position of each agent in agents
+        (in the list with holes until it's compacted)
+    time: int
+        number of calls to update()
+    critical_index: dict<name, mm.Agent>
+        critical agents, in the order they became critical
+    cohorts: dict<int, dict<name, mm.Agent>>
+        agents by arrival time, so sojourn == time - arrival - 1
+    arrivals: dict<name, int>
+        arrival time of each agent
+    types: dict<str, dict<type, set<name>>> or None
+        names of the agents with each value of "type" and "type2"
+        None once an agent with an unhashable type is added
+    agent_class: type
+        class of the agents the market creates for this pool
+    """
+    agent_class = Agent
+
+    def __init__(self, agents=()):
+        self._agents = list()
+        self._holes = 0
+        self.index = dict()
+        self.time = 0
+        self.critical_index = dict()
+        self.cohorts = dict()
+        self.arrivals = dict()
+        self.types = {"type": dict(), "type2": dict()}
+        self.extend(agents)
+
+    @property
+    def agents(self):
+        if self._holes:
+            self._compact()
+        return self._agents
+
+    def _compact(self):
+        """
+        Removes the holes left by removed agents, in O(n)
+        """
+        self._agents = [a for a in self._agents if a is not None]
+        self.index = {a.name: i for i, a in enumerate(self._agents)}
+        self._holes = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.agents)
+
+    def __getitem__(self, i):
+        """
+        Positional access, slices return lists
+        Use get() to look agents up by name
+        """
+        return self.agents[i]
+
+    def __contains__(self, agent):
+        """
+        agent can be an mm.Agent or an agent name
+        """
+        return getattr(agent, "name", agent) in self.index
+
+    def __repr__(self):
+        return "AgentPool(" + repr([a.name for a in self.agents]) + ")"
+
+    def append(self, agent):
+        if agent.name in self.index:
+            raise ValueError("Agent " + str(agent.name) + " already in pool")
+        self.index[agent.name] = len(self._agents)
+        self._agents.append(agent)
+        arrival = self.time - agent.sojourn - 1
+        self.arrivals[agent.name] = arrival
+        self.cohorts.setdefault(arrival, dict())[agent.name] = agent
+        if agent.is_critical:
+            self.critical_index[agent.name] = agent
+        if self.types is not None:
+            try:
+                for field, buckets in self.types.items():
+                    buckets.setdefault(getattr(agent, field),
+                                       set()).add(agent.name)
+            except TypeError:
+                self.types = None
+
+    def extend(self, agents):
+        for agent in agents:
+            self.append(agent)
+
+    def remove(self, agent):
+        """
+        Removes agent in O(1) by leaving a hole in its place
+        Raises ValueError if agent isn't in the pool
+        """
+        i = self.index.pop(agent.name, None)
+        if i is None:
+            raise ValueError("Agent " + str(agent.name) + " not in pool")
+        self.critical_index.pop(agent.name, None)
+        arrival = self.arrivals.pop(agent.name)
+        cohort = self.cohorts[arrival]
+        del cohort[agent.name]
+        if not cohort:
+            del self.cohorts[arrival]
+        if self.types is not None:
+            for field, buckets in self.types.items():
+                value = getattr(agent, field)
+                buckets[value].discard(agent.name)
+                if not buckets[value]:
+                    del buckets[value]
+        if i == len(self._agents) - 1:
+            self._agents.pop()
+        else:
+            self._agents[i] = None
+            self._holes += 1
+
+    def get(self, name, default=None):
+        """
+        Agent named name, or default
+        """
+        i = self.index.get(name)
+        if i is None:
+            return default
+        return self._agents[i]
+
+    def names(self):
+        """
+        set-like view of the names of agents in the pool
+        """
+        return self.index.keys()
+
+    def update(self):
+        """
+        Advances time on every agent in the pool
+        """
+        for agent in self.agents:
+            was_critical = agent.is_critical
+            agent.update()
+            if agent.is_critical and not was_critical:
+                self.critical_index[agent.name] = agent
+        self.time += 1
+
+    def critical(self):
+        """
+        # of critical agents in the pool
+        """
+        return len(self.critical_index)
+
+    def critical_agents(self):
+        """
+        list of critical agents, in the order they became critical
+        """
+        return list(self.critical_index.values())
+
+    def ordered(self, agents):
+        """
+        list of the pooled agents in agents, in arrival order
+        Sorts by index, which holes don't reorder, in O(k log k)
+        """
+        return sorted(agents, key=lambda agent: self.index[agent.name])
+
+    def with_sojourn(self, sojourn):
+        """
+        list of agents whose sojourn equals sojourn
+        """
+        cohort = self.cohorts.get(self.time - sojourn - 1)
+        if cohort is None:
+            return list()
+        return list(cohort.values())
+
+    def new_agents(self):
+        """
+        list of agents in their first period (sojourn == 0)
+        """
+        return self.with_sojourn(0)
+
+    def positions(self, field, values, start=0, stop=None):
+        """
+        np.array of the positions in [start, stop), relative to start,
+            of agents whose field ("type" or "type2") is in values
+        Only reads the buckets of values
+        """
+        agents = self.agents
+        stop = len(agents) if stop is None else stop
+        buckets = self.types[field]
+        found = np.fromiter((self.index[name] for value in values
+                             for name in buckets.get(value, ())),
+                            dtype=np.intp)
+        found = found[(found >= start) & (found < stop)]
+        found.sort()
+        return found - start
+
+    def groups(self, field, start=0, stop=None):
+        """
+        dict<type, np.array> positions in [start, stop), relative to
+            start, of the agents with each value of field
+        """
+        groups = dict()
+        for i, agent in enumerate(self.agents[start:stop]):
+            groups.setdefault(getattr(agent, field), list()).append(i)
+        return {value: np.array(rows, dtype=np.intp)
+                for value, rows in groups.items()}
+
+    def arrays(self, start=0, stop=None):
+        """
+        mm.AgentArrays of the agents in positions [start, stop)
+        """
+        return AgentArrays.from_agents(self.agents[start:stop])
+
+
+class PooledAgent(Agent):
+    """
+    Agent whose time-varying members are stored in the columns
+    of a ColumnarAgentPool while it's in the pool
+    Outside of a pool (before arrival, after matching or perishing)
+    it behaves like a regular mm.Agent
+    Attributes
+    ---------
+    pool: ColumnarAgentPool or None
+        pool holding the agent's columns
+    """
+    __slots__ = ("pool",)
+
+    def __init__(self, *args, **kwargs):
+        self.pool = None
+        Agent.__init__(self, *args, **kwargs)
+
+
+def _column_property(field):
+    """
+    Member of a PooledAgent read from and written to the pool's column
+    Falls back on the Agent slot of the same name outside of a pool
+    """
+    stored = getattr(Agent, field)
+
+    def fget(self):
+        if self.pool is None:
+            return stored.__get__(self)
+        return self.pool.columns[field][self.pool.index[self.name]].item()
+
+    def fset(self, value):
+        if self.pool is None:
+            stored.__set__(self, value)
+        else:
+            self.pool.columns[field][self.pool.index[self.name]] = value
+
+    return property(fget, fset)
+
+
+class ColumnarAgentPool(AgentPool):
+    """
+    AgentPool storing agents' members in NumPy columns
+    Row i of every column belongs to agents[i], rows are compacted
+    with the agents
+    Time updates and criticality counts are vectorized over the pool
+
+    Agents must be PooledAgent; their discount_rate, time_to_critical,
+    sojourn and is_critical are views of the columns while pooled
+    and are copied back to the agent when it leaves the pool
+
+    Attributes
+    ----------
+    columns: dict<str, np.array>
+        name, type, type2, discount_rate, time_to_critical,
+        sojourn and is_critical of the agents, by position
+        arrays have spare capacity, only the first len(pool)
+        rows are live
+    """
+    agent_class = PooledAgent
+    dtypes = {"name": np.int64, "type": object, "type2": object,
+              "discount_rate": np.float64, "time_to_critical": np.float64,
+              "sojourn": np.int64, "is_critical": np.int8}
+    # members that change while an agent is pooled
+    mutable = ("discount_rate", "time_to_critical", "sojourn",
+               "is_critical")
+
+    def __init__(self, agents=(), capacity=64):
+        capacity = max(int(capacity), 1)
+        self.columns = {field: np.zeros(capacity, dtype=dtype)
+                        for field, dtype in self.dtypes.items()}
+        AgentPool.__init__(self, agents)
+
+    def _grow(self):
+        """
+        Doubles the capacity of the columns
+        """
+        for field, column in self.columns.items():
+            grown = np.zeros(2 * len(column), dtype=column.dtype)
+            grown[:len(column)] = column
+            self.columns[field] = grown
+
+    def _write(self, row, agent):
+        for field in self.dtypes:
+            self.columns[field][row] = getattr(agent, field)
+
+    def append(self, agent):
+        if not isinstance(agent, PooledAgent):
+            raise TypeError("ColumnarAgentPool holds PooledAgent, "
+                            "create agents with pool.agent_class")
+        if agent.pool is not None:
+            raise ValueError("Agent " + str(agent.name) +
+                             " already in a pool")
+        row = len(self._agents)
+        if row == len(self.columns["name"]):
+            self._grow()
+        self._write(row, agent)
+        AgentPool.append(self, agent)
+        agent.pool = self
+
+    def remove(self, agent):
+        """
+        Removes agent in O(1), its members are copied back to it
+        """
+        if agent.name not in self.index:
+            raise ValueError("Agent " + str(agent.name) + " not in pool")
+        values = [getattr(agent, field) for field in self.mutable]
+        AgentPool.remove(self, agent)
+        agent.pool = None
+        for field, value in zip(self.mutable, values):
+            setattr(agent, field, value)
+
+    def _compact(self):
+        rows = np.fromiter((i for i, a in enumerate(self._agents)
+                            if a is not None), dtype=np.intp)
+        for column in self.columns.values():
+            column[:len(rows)] = column[rows]
+        AgentPool._compact(self)
+
+    def update(self):
+        """
+        Vectorized mm.Agent.update over the pool
+        """
+        n = len(self.agents)
+        sojourn = self.columns["sojourn"][:n]
+        sojourn += 1
+        is_critical = self.columns["is_critical"][:n]
+        rows = np.flatnonzero(
+            (sojourn >= self.columns["time_to_critical"][:n]) &
+            (is_critical == 0))
+        is_critical[rows] = 1
+        for row in rows.tolist():
+            agent = self.agents[row]
+            self.critical_index[agent.name] = agent
+        self.time += 1
+
+    def arrays(self, start=0, stop=None):
+        rows = slice(*slice(start, stop).indices(len(self.agents)))
+        return AgentArrays(self.columns["name"][rows],
+                           self.columns["type"][rows],
+                           self.columns["type2"][rows])
+
+
+for _field in ColumnarAgentPool.mutable:
+    setattr(PooledAgent, _field, _column_property(_field))
+del _field
@@ -1,8 +1,17 @@
+import os
+import pickle
+import random
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 import numpy as np
-from numpy.random import random
-from scipy.stats import poisson
 from scipy import optimize
 
+try:
+    import cloudpickle
+except ImportError:
+    cloudpickle = None
+
 
 from matchingmarkets.agent import Agent
 from matchingmarkets.metaalgorithms import *
@@ -11,6 +20,21 @@ from matchingmarkets.market import Market
 from matchingmarkets.generators.basic import *
 
 
+def _matches(market):
+    """
+    Number of matches made in market, default single_run objective
+    """
+    return len(market.matched)
+
+
+def _loss(market):
+    """
+    Loss of market, default brute_search objective
+    Module-level so pickle can send it to worker processes
+    """
+    return market.loss
+
+
 class simulation:
     def __init__(self, runs=10, time_per_run=1, max_agents=1000,
                  verbose=False,
@@ -19,16 +43,17 @@ class simulation:
                  metaAlgorithm=meta_always,
                  algorithm=arbitraryMatch,
                  compatFct=std_compat,
-                 discount=lambda: 1,
-                 matchUtilFct=lambda x, y, **kwarg: 1,
-                 time_to_crit=lambda x: poisson.rvs(x),
+                 discount=noDiscount,
+                 matchUtilFct=utilConstant,
+                 time_to_crit=poissonDraw,
                  crit_input=0,
-                 typeGenerator=lambda x: 1,
-                 typeGen2=lambda x: 1,
+                 typeGenerator=singleType,
+                 typeGen2=singleType,
                  algoParams=dict(),
                  numTypes=1, selfMatch=False,
-                 success_prob=lambda: 1 if random() > 0.5 else 0,
-                 arrival_fct=lambda x: poisson.rvs(x)):
+                 success_prob=coinFlip,
+                 arrival_fct=poissonDraw,
+                 matrix=False, columnar=False, seed=None):
         """
         Initializes a simulation object
 
@@ -95,12 +120,22 @@ class simulation:
             function generating agent time to crit
         typeGenerator: fct(int) -> int
             function generating agent type
+        matrix: bool
+            markets store match utilities and probabilities
+            in NumPy matrices instead of per-agent dicts
+        columnar: bool
+            markets store agents' members in NumPy columns
+        seed: None or int
+            root seed of the runs
+            each run gets its own stream spawned from it,
+            so results don't depend on the number of workers
         """
         # Montecarlo information
         self.logAllData = logAllData
         self.runs = runs
         self.time_per_run = time_per_run
         self.verbose = verbose
+        self.seed = seed
 
         # Simulation parameters
         self.max_agents = max_agents
@@ -119,6 +154,8 @@ class simulation:
         self.numTypes = numTypes
         self.selfMatch = selfMatch
         self.arrival_fct = arrival_fct
+        self.matrix = matrix
+        self.columnar = columnar
 
         # Collected stats on a run
         self.welfare = 0
@@ -142,7 +179,7 @@ class simulation:
         self.loss_matrix = np.zeros((self.runs, self.time_per_run))
         self.perished_matrix = np.zeros((self.runs, self.time_per_run))
 
-    def run(self):
+    def run(self, workers=1):
         """
         Runs a simulation
         Default simulation is a one period market
@@ -150,7 +187,12 @@ class simulation:
         utility is 1 for a match by default
         Arguments
         ---------
-        (void)
+        workers: int
+            number of processes the runs are spread across
+            1 runs in this process, -1 uses every CPU
+            Generator, compat and algorithm functions are shipped
+            to workers with cloudpickle if installed, pickle otherwise
+            (so with pickle they must be module-level functions)
         runs based on simulation object attributes
         Returns
         -----------
@@ -159,38 +201,26 @@ class simulation:
                  simulation object will only store the results of
                  the latest one.
         """
-        # parallelize this for loop
-        for i in range(self.runs):
-            newMarket = Market(arrival_rate=self.arrival_rate,
-                               success_prob=self.success_prob,
-                               selfMatch=self.selfMatch,
-                               max_agents=self.max_agents)
-            for j in range(self.time_per_run):
-                newMarket.update(metaAlgorithm=self.metaAlgorithm,
-                                 algorithm=self.algorithm,
-                                 compatFct=self.compatFct,
-                                 discount=self.discount,
-                                 matchUtilFct=self.matchUtilFct,
-                                 time_to_crit=self.time_to_crit,
-                                 crit_input=self.crit_input,
-                                 algoParams=self.algoParams,
-                                 typeGenerator=self.typeGenerator,
-                                 typeGen2=self.typeGen2,
-                                 numTypes=self.numTypes,
-                                 arrival_fct=self.arrival_fct,
-                                 verbose=self.verbose)
-                if self.logAllData is True:
-                    self.welfare_matrix[i, j] = newMarket.welfare
-                    self.matches_matrix[i, j] = len(newMarket.matched)
-                    self.loss_matrix[i, j] = newMarket.loss
-                    self.perished_matrix[i, j] = len(newMarket.perished)
-                j += 1
-            if self.logAllData is False:
-                self.welfare_matrix[i, -1:] = newMarket.welfare
-                self.matches_matrix[i, -1:] = len(newMarket.matched)
-                self.loss_matrix[i, -1:] = newMarket.loss
-                self.perished_matrix[i, -1:] = len(newMarket.perished)
-            i += 1
+        # Independent RNG stream for each run
+        seeds = np.random.SeedSequence(self.seed).spawn(self.runs)
+        params = (self._market_params(), self._update_params(),
+                  self.time_per_run, self.logAllData)
+        if workers == -1:
+            workers = os.cpu_count()
+        if workers > 1 and self.runs > 1:
+            executor = ProcessPoolExecutor(max_workers=workers,
+                                           initializer=_init_worker,
+                                           initargs=(_dumps(params),))
+            with executor:
+                results = list(executor.map(_run_worker, seeds))
+        else:
+            # Without a seed, serial runs draw from the global state
+            if self.seed is None:
+                seeds = [None] * self.runs
+            results = [_run_market(*params, seed=seed) for seed in seeds]
+        for i, result in enumerate(results):
+            (self.welfare_matrix[i], self.matches_matrix[i],
+             self.loss_matrix[i], self.perished_matrix[i]) = result
         # update simulation stats
         self.welfare = np.average(self.welfare_matrix[:, -1:])
         self.matches = np.average(self.matches_matrix[:, -1:])
@@ -209,6 +239,35 @@ class simulation:
         self.matches_var = np.var(self.matches_matrix[:, -1:])
         self.perished_var = np.var(self.perished_matrix[:, -1:])
 
+    def _market_params(self):
+        """
+        kwargs of the Market objects built by the simulation
+        """
+        return dict(arrival_rate=self.arrival_rate,
+                    success_prob=self.success_prob,
+                    selfMatch=self.selfMatch,
+                    max_agents=self.max_agents,
+                    matrix=self.matrix,
+                    columnar=self.columnar)
+
+    def _update_params(self):
+        """
+        kwargs of Market.update in the simulation
+        """
+        return dict(metaAlgorithm=self.metaAlgorithm,
+                    algorithm=self.algorithm,
+                    compatFct=self.compatFct,
+                    discount=self.discount,
+                    matchUtilFct=self.matchUtilFct,
+                    time_to_crit=self.time_to_crit,
+                    crit_input=self.crit_input,
+                    algoParams=self.algoParams,
+                    typeGenerator=self.typeGenerator,
+                    typeGen2=self.typeGen2,
+                    numTypes=self.numTypes,
+                    arrival_fct=self.arrival_fct,
+                    verbose=self.verbose)
+
     def stats(self):
         """
         Prints market statistics
@@ -240,41 +299,25 @@ class simulation:
             number of periods to run the graph for
             default is the attribute of the simulation object
         """
-        newMarket = Market(arrival_rate=self.arrival_rate,
-                           success_prob=self.success_prob,
-                           max_agents=self.max_agents,
-                           graph=True, plots=True,
-                           selfMatch=self.selfMatch,
-                           plot_time=plot_time)
+        newMarket = Market(graph=True, plots=True, plot_time=plot_time,
+                           **self._market_params())
         if period is None:
             run_time = self.time_per_run
         else:
             run_time = period
         for j in range(run_time):
-                newMarket.update(metaAlgorithm=self.metaAlgorithm,
-                                 algorithm=self.algorithm,
-                                 compatFct=self.compatFct,
-                                 discount=self.discount,
-                                 matchUtilFct=self.matchUtilFct,
-                                 time_to_crit=self.time_to_crit,
-                                 crit_input=self.crit_input,
-                                 algoParams=self.algoParams,
-                                 typeGenerator=self.typeGenerator,
-                                 typeGen2=self.typeGen2,
-                                 numTypes=self.numTypes,
-                                 verbose=self.verbose,
-                                 arrival_fct=self.arrival_fct)
+                newMarket.update(**self._update_params())
 
     def single_run(self, weights, metaParamNames=list(),
-                   objective=lambda x: x.matches):
+                   objective=_matches):
         """
         Performs one simulation run
         Non-stochastic default parameters
         returns one parameter from created market as specified by "objective"
             default is market.loss
 
-        Doesn't take algoParams dict for meta algorithm kwargs
-            instead takes weights array and metaParamNames list of strings
+        Meta algorithm kwargs are the simulation's algoParams dict
+            updated with weights array and metaParamNames list of strings
             which combined creates dict
 
         Arguments
@@ -295,42 +338,18 @@ class simulation:
         Objective function after specified number of runs
         So for welfare it would return market welfare after one run
         """
-        # Create new meta-algorithm kwargs dict
-        params = dict()
-        # this refactors weights input
-        if type(weights) == np.ndarray:
-            if weights.shape == ():
-                weights = [weights]
-        for i in range(len(metaParamNames)):
-            params[metaParamNames[i]] = weights[i]
-        # Create new Market for simulation
-        newMarket = Market(arrival_rate=self.arrival_rate,
-                           success_prob=self.success_prob,
-                           selfMatch=self.selfMatch,
-                           max_agents=self.max_agents)
-        # Run simulation
-        for i in range(self.time_per_run):
-                newMarket.update(metaAlgorithm=self.metaAlgorithm,
-                                 algorithm=self.algorithm,
-                                 compatFct=self.compatFct,
-                                 discount=self.discount,
-                                 matchUtilFct=self.matchUtilFct,
-                                 time_to_crit=self.time_to_crit,
-                                 crit_input=self.crit_input,
-                                 algoParams=self.algoParams,
-                                 typeGenerator=self.typeGenerator,
-                                 typeGen2=self.typeGen2,
-                                 numTypes=self.numTypes,
-                                 arrival_fct=self.arrival_fct,
-                                 verbose=self.verbose)
-        return objective(newMarket)
+        update_params = _weighted_update_params(
+            self._update_params(), weights, metaParamNames)
+        return _run_objective(self._market_params(), update_params,
+                              self.time_per_run, objective)
 
     def brute_search(self, weights, metaParamNames=list(),
-                     objective=lambda x: x.loss,
+                     objective=_loss,
                      negative_objective=False,
                      stochastic_objective=True,
                      stochastic_samples=25,
                      stochastic_precision=0.01,
+                     workers=1,
                      ):
         """
         Uses BFS to find optimal simulation hyperparameters
@@ -353,36 +372,243 @@ class simulation:
             by default number of matches
             can be changed to loss, for example, by
                 "objective=lambda x: x.loss"
+        workers: int
+            number of processes evaluating the objective
+            both the grid points and the stochastic samples
+            of each point are spread across the pool
+            -1 uses every CPU
+            Sample k of every grid point is seeded by the k-th stream
+            spawned from the simulation seed, so results don't depend
+            on the number of workers
         returns
         -------
         np.array of weights where function is minimized
                 if negative_objective=True, where maximized
         """
-        def this_run(w):
-            # note - sign here
-            # TODO fix negative sign
-            sign = 1 if negative_objective else -1
-            if stochastic_objective:
-                result = 0
-                # If objective stochastic, make montecarlo draws & average
-                for i in range(stochastic_samples):
-                    result += sign * \
-                            self.single_run(w,
-                                            metaParamNames=metaParamNames,
-                                            objective=objective)
-                # Average montecarlo draws
-                result = result/stochastic_samples
-                # Tune precision for convergence
-                result = int(result/stochastic_precision)*stochastic_precision
-                return result
-            else:
-                return sign*self.single_run(w,
-                                            metaParamNames=metaParamNames,
-                                            objective=objective)
-        # res = []
-        # for i in range(10):
-        #    res.append(this_run(weights))
-        res = optimize.brute(this_run, weights, full_output=True, disp=True,
-                             finish=optimize.fmin
-                             )
+        # note - sign here
+        # TODO fix negative sign
+        sign = 1 if negative_objective else -1
+        if not stochastic_objective:
+            stochastic_samples = 1
+        # Sample k uses the same seed at every grid point
+        seeds = np.random.SeedSequence(self.seed).spawn(stochastic_samples)
+        params = (self._market_params(), self._update_params(),
+                  self.time_per_run, metaParamNames, objective)
+        if workers == -1:
+            workers = os.cpu_count()
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers,
+                                           initializer=_init_worker,
+                                           initargs=(_dumps(params),))
+            this_run = _BruteObjective(sign, seeds, stochastic_objective,
+                                       stochastic_precision,
+                                       executor.map, _task_worker)
+        else:
+            executor = None
+            this_run = _BruteObjective(sign, seeds, stochastic_objective,
+                                       stochastic_precision, map,
+                                       partial(_run_task, params))
+        try:
+            res = optimize.brute(this_run, weights, full_output=True,
+                                 disp=True, finish=optimize.fmin,
+                                 workers=this_run.grid_map
+                                 if executor is not None else 1)
+        finally:
+            if executor is not None:
+                executor.shutdown()
         return res[0]
+
+
+#
+# Process pool helpers
+# Module level so they can be sent to worker processes
+#
+
+def _dumps(obj):
+    """
+    Serializes simulation parameters for worker processes
+    cloudpickle handles lambdas and closures, pickle needs
+    module-level functions
+    """
+    if cloudpickle is not None:
+        return cloudpickle.dumps(obj)
+    try:
+        return pickle.dumps(obj)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        raise ValueError("Simulation functions can't be sent to worker "
+                         "processes. Install cloudpickle or use "
+                         "module-level functions instead of lambdas"
+                         ) from e
+
+
+_worker_params = None
+
+
+def _init_worker(payload):
+    """
+    Unpacks simulation parameters once per worker process
+    """
+    global _worker_params
+    _worker_params = pickle.loads(payload)
+
+
+def _run_worker(seed):
+    return _run_market(*_worker_params, seed=seed)
+
+
+def _task_worker(task):
+    return _run_task(_worker_params, task)
+
+
+@contextmanager
+def _seeded_globals(seed):
+    """
+    Seeds the global numpy and random states from a SeedSequence
+        and gives the caller's states back on exit
+    """
+    np_state = np.random.get_state()
+    random_state = random.getstate()
+    np.random.seed(seed.generate_state(4))
+    random.seed(int(seed.generate_state(1, dtype=np.uint64)[0]))
+    try:
+        yield
+    finally:
+        np.random.set_state(np_state)
+        random.setstate(random_state)
+
+
+@contextmanager
+def _seeded_market(market_params, seed=None):
+    """
+    New Market drawing from its own Generator seeded by seed
+    The global numpy and random states are seeded too while
+        the market runs, for user functions that don't take an rng
+    No seed: the market draws from the global states
+    """
+    if seed is None:
+        yield Market(**market_params)
+        return
+    # Children derived without spawn(), which would mutate seed
+    market_seed, global_seed = [
+        np.random.SeedSequence(seed.entropy, pool_size=seed.pool_size,
+                               spawn_key=seed.spawn_key + (i,))
+        for i in range(2)]
+    with _seeded_globals(global_seed):
+        yield Market(rng=np.random.default_rng(market_seed), **market_params)
+
+
+def _run_market(market_params, update_params, periods, logAllData,
+                seed=None):
+    """
+    Runs one market of a simulation
+    Returns
+    -------
+    welfare, matches, loss, perished
+        np.arrays of length periods
+        only the last period is filled if logAllData is False
+    """
+    result = np.zeros((4, periods))
+    with _seeded_market(market_params, seed) as newMarket:
+        for j in range(periods):
+            newMarket.update(**update_params)
+            if logAllData is True or j == periods - 1:
+                result[:, j] = (newMarket.welfare, len(newMarket.matched),
+                                newMarket.loss, len(newMarket.perished))
+    return result
+
+
+def _weight_params(weights, metaParamNames):
+    """
+    Meta algorithm kwargs from weights and their names
+    """
+    params = dict()
+    # this refactors weights input
+    if type(weights) == np.ndarray:
+        if weights.shape == ():
+            weights = [weights]
+    for i in range(len(metaParamNames)):
+        params[metaParamNames[i]] = weights[i]
+    return params
+
+
+def _weighted_update_params(update_params, weights, metaParamNames):
+    """
+    Market.update kwargs whose algoParams are updated with the
+        meta algorithm kwargs from weights and their names
+    """
+    algoParams = dict(update_params["algoParams"])
+    algoParams.update(_weight_params(weights, metaParamNames))
+    return dict(update_params, algoParams=algoParams)
+
+
+def _run_objective(market_params, update_params, periods, objective,
+                   seed=None):
+    """
+    Runs one market
+    Returns
+    -------
+    objective(market) at the end of the run
+    """
+    with _seeded_market(market_params, seed) as newMarket:
+        for i in range(periods):
+            newMarket.update(**update_params)
+        return objective(newMarket)
+
+
+def _run_task(params, task):
+    """
+    One brute_search sample
+    task is (weights, seed)
+    """
+    market_params, update_params, periods, metaParamNames, objective = params
+    weights, seed = task
+    # Same market as single_run(weights, metaParamNames)
+    update_params = _weighted_update_params(update_params, weights,
+                                            metaParamNames)
+    return _run_objective(market_params, update_params, periods, objective,
+                          seed=seed)
+
+
+class _BruteObjective:
+    """
+    Objective minimized by simulation.brute_search
+    Averages one run per seed at each weights point
+    mapper: map-like fct(fct, iterable)
+        evaluates the runs, in this process or in a pool
+    run: fct((weights, seed)) -> float
+    """
+    def __init__(self, sign, seeds, stochastic, precision, mapper, run):
+        self.sign = sign
+        self.seeds = seeds
+        self.stochastic = stochastic
+        self.precision = precision
+        self.mapper = mapper
+        self.run = run
+
+    def _reduce(self, values):
+        if not self.stochastic:
+            return self.sign * values[0]
+        result = 0
+        # If objective stochastic, make montecarlo draws & average
+        for value in values:
+            result += self.sign * value
+        result = result/len(values)
+        # Tune precision for convergence
+        return int(result/self.precision)*self.precision
+
+    def __call__(self, w):
+        tasks = [(w, seed) for seed in self.seeds]
+        return self._reduce(list(self.mapper(self.run, tasks)))
+
+    def grid_map(self, func, points):
+        """
+        map-like passed as brute's workers
+        Sends every sample of every grid point to the pool at once
+        func (brute's wrapper of self) is replaced by the flat tasks
+        """
+        points = [np.asarray(w).flatten() for w in points]
+        tasks = [(w, seed) for w in points for seed in self.seeds]
+        values = list(self.mapper(self.run, tasks))
+        n = len(self.seeds)
+        return [self._reduce(values[i*n:(i+1)*n])
+                for i in range(len(points))]
@@ -2,6 +2,7 @@ from matchingmarkets.agent import Agent
 from matchingmarkets.market import Market
 from matchingmarkets.simulations import simulation
 from matchingmarkets.algorithms import *
+from matchingmarkets.algorithms import pulp
 from matchingmarkets.metaalgorithms import *
 from matchingmarkets.generators.basic import *
 
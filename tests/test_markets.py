@@ -4,8 +4,24 @@ AgentTest, MarketTest, SimulationTest
 """
 import matchingmarkets as mm
 import numpy.random as rng
+import copy
+import inspect
+import itertools
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tempfile
 import unittest
 
+# Seconds allowed for `import matchingmarkets` in a fresh interpreter
+IMPORT_TIME_BUDGET = 3.0
+
+
+def welfare(market):
+    return market.welfare
+
 
 class TestMarkets(unittest.TestCase):
     def test_agent(self):
@@ -68,6 +84,8 @@ class TestMarkets(unittest.TestCase):
         welfareTest = sim.single_run(0, objective=lambda x: x.welfare)
         matchTest = sim.single_run(0, objective=lambda x: len(x.matched))
         arrival_r = rng.randint(1, 5)
+        # period is a kwarg of meta_periodic
+        sim.metaAlgorithm = mm.meta_periodic
         welfareTest1 = sim.single_run(
             [2], metaParamNames=["period"], objective=lambda x: x.welfare)
         welfareTest2 = sim.single_run(
@@ -83,6 +101,35 @@ class TestMarkets(unittest.TestCase):
             stochastic_precision=1.,
         )
 
+    def test_simulation_weights(self):
+        """
+        single_run and brute_search pass the weights to the meta algorithm
+        """
+        sim = mm.simulation(time_per_run=6, arrival_rate=10,
+                            metaAlgorithm=mm.meta_periodic,
+                            algoParams={"period": 1})
+        values = list()
+        for period in (1, 4, 8):
+            rng.seed(11)
+            random.seed(11)
+            values.append(sim.single_run([period], metaParamNames=["period"],
+                                         objective=lambda x: len(x.matched)))
+        # Same arrivals, fewer matching periods: fewer matches
+        self.assertGreater(values[0], values[1])
+        self.assertGreater(values[1], values[2])
+        self.assertEqual(sim.algoParams, {"period": 1})
+        rng.seed(11)
+        random.seed(11)
+        self.assertEqual(sim.single_run(1, objective=lambda x: len(x.matched)),
+                         values[0])
+        # Seeded samples: the grid point with the fewest matches wins
+        sim.seed = 5
+        res = sim.brute_search([slice(1, 9, 3)], metaParamNames=["period"],
+                               objective=lambda x: len(x.matched),
+                               negative_objective=True,
+                               stochastic_objective=False)
+        self.assertGreaterEqual(res[0], 4)
+
     def test_plotting(self):
         """
         Market Plotting Test
@@ -109,5 +156,973 @@ class TestMarkets(unittest.TestCase):
                     numTypes=5
                 )
 
+    def test_matrix_engine(self):
+        """
+        Matrix engine holds the same preference maps as the dict engine
+        """
+        def no_match(Market, match=None, verbose=False, **kwargs):
+            return dict()
+        markets = [mm.Market(arrival_rate=3), mm.Market(arrival_rate=3,
+                                                         matrix=True)]
+        type_cycles = [itertools.cycle(range(3)) for m in markets]
+        for i in range(10):
+            for market, types in zip(markets, type_cycles):
+                market.update(metaAlgorithm=no_match,
+                              compatFct=mm.neighborSameType,
+                              matchUtilFct=lambda x, y, **kw: x.name + y.name,
+                              arrival_fct=lambda x: x,
+                              time_to_crit=lambda x: 4,
+                              typeGenerator=lambda x: next(types))
+            dict_market, matrix_market = markets
+            self.assertEqual([a.name for a in dict_market.Agents],
+                             [a.name for a in matrix_market.Agents])
+            live = [a.name for a in dict_market.Agents]
+            for a, b in zip(dict_market.Agents, matrix_market.Agents):
+                self.assertEqual(sorted(a.neighbors()),
+                                 sorted(b.neighbors()))
+                # Departed agents are evicted from the dicts
+                self.assertEqual(sorted(a.match_util), sorted(live))
+                for name in live:
+                    self.assertEqual(a.match_util[name], b.match_util[name])
+                    self.assertEqual(a.match_fail_prob[name],
+                                     b.match_fail_prob[name])
+            self.assertEqual(len(dict_market.Graph.edges()),
+                             len(matrix_market.Graph.edges()))
+            self.assertEqual(sorted(dict_market.holders), sorted(live))
+            matrix = matrix_market.matrix
+            self.assertEqual([a and a.name for a in matrix.agents],
+                             matrix.names.tolist())
+
+    def test_batched_generators(self):
+        """
+        Batched generator functions agree with their scalar versions
+        """
+        blood = ["O+", "O-", "A+", "A-", "B+", "B-", "AB+", "AB-"]
+        agents = [mm.Agent(name=i, myType=blood[rng.randint(8)],
+                           myType2=blood[rng.randint(8)])
+                  for i in range(20)]
+        block = mm.AgentArrays.from_agents(agents)
+        for fct in [mm.neighborSameType, mm.neighborSameTypeWithSelf,
+                    mm.utilSameType, mm.std_compat,
+                    mm.transplant_compatibility, mm.blood_compatibility]:
+            result = fct.batched(block, block, cutoff=0.5)
+            for i, a in enumerate(agents):
+                for j, b in enumerate(agents):
+                    self.assertEqual(result[i, j], fct(a, b, cutoff=0.5))
+        self.assertTrue(hasattr(mm.Market().acceptable_prob, "batched"))
+        self.assertTrue((mm.alwaysSucceed.batched(size=(3, 4)) ==
+                         mm.alwaysSucceed()).all())
+        draws = mm.stochastic_neighborSameType.batched(block, block)
+        self.assertEqual(draws.shape, (20, 20))
+        self.assertTrue((draws[mm.neighborSameType.batched(block, block)
+                               == 0] == 0).all())
+
+    def test_batched_arrivals(self):
+        """
+        Batched arrival generators draw whole periods at once
+        and markets build the same agents through either path
+        """
+        gen = rng.default_rng(0)
+        types = mm.blood_types.batched(None, size=20000, rng=gen)
+        self.assertEqual(types.shape, (20000,))
+        self.assertAlmostEqual((types == "O+").mean(), 0.374, delta=0.02)
+        self.assertIn(mm.blood_types(None), list(mm.BLOOD_TYPES))
+        draws = mm.randomType.batched(4, size=50, rng=gen)
+        self.assertTrue(((draws >= 0) & (draws < 4)).all())
+        self.assertEqual(mm.poissonDraw.batched(3, size=7).shape, (7,))
+        agents = []
+        for typeGenerator in (mm.alternatingType,
+                              lambda numTypes, name: name % numTypes):
+            market = mm.Market(arrival_rate=5, seed=7)
+            for j in range(10):
+                market.update(typeGenerator=typeGenerator,
+                              time_to_crit=lambda x: 2, numTypes=3)
+            everyone = list(market.Agents) + market.matched + \
+                market.perished
+            agents.append(sorted((a.name, a.type, a.time_to_critical)
+                                 for a in everyone))
+        self.assertEqual(agents[0], agents[1])
+        self.assertGreater(len(agents[0]), 0)
+
+    def test_typed_compatibility(self):
+        """
+        Scalar functions declaring compatible types are only called
+        on compatible pairs, with the same preference maps
+        """
+        calls = []
+
+        def compat(agent, otherAgent, cutoff=1):
+            calls[-1] += 1
+            return mm.blood_compatibility(agent, otherAgent, cutoff)
+
+        typed = mm.by_type(mm.blood_compatibility.compatible_types,
+                           *mm.blood_compatibility.type_fields)(
+                               lambda a, b, cutoff=1: compat(a, b, cutoff))
+        maps = []
+        for compatFct in (compat, typed):
+            calls.append(0)
+            market = mm.Market(arrival_rate=6, seed=8)
+            for j in range(10):
+                market.update(compatFct=compatFct,
+                              typeGenerator=mm.blood_types,
+                              typeGen2=mm.blood_types, crit_input=5)
+            maps.append({a.name: dict(a.match_fail_prob)
+                         for a in market.Agents})
+        self.assertEqual(maps[0], maps[1])
+        self.assertLess(calls[1], calls[0])
+        self.assertGreater(calls[1], 0)
+
+        # Batched functions are evaluated on compatible sub-blocks
+        def block(agents, others, cutoff=1):
+            calls[-1] += len(agents) * len(others)
+            return mm.blood_compatibility.batched(agents, others, cutoff)
+
+        batched = mm.batched(block)(
+            lambda a, b, cutoff=1: compat(a, b, cutoff))
+        typed = mm.by_type(mm.blood_compatibility.compatible_types,
+                           *mm.blood_compatibility.type_fields)(
+                               mm.batched(block)(
+                                   lambda a, b, cutoff=1: compat(a, b, cutoff)))
+        for compatFct in (batched, typed):
+            calls.append(0)
+            market = mm.Market(arrival_rate=6, seed=8)
+            for j in range(10):
+                market.update(compatFct=compatFct,
+                              typeGenerator=mm.blood_types,
+                              typeGen2=mm.blood_types, crit_input=5)
+            maps.append({a.name: dict(a.match_fail_prob)
+                         for a in market.Agents})
+        self.assertEqual(maps[2], maps[0])
+        self.assertEqual(maps[3], maps[0])
+        self.assertLess(calls[3], calls[2])
+        self.assertGreater(calls[3], 0)
+
+    def test_parallel_runs(self):
+        """
+        Seeded runs are reproducible whatever the number of workers
+        """
+        results = []
+        for workers in [1, 2]:
+            sim = mm.simulation(runs=4, time_per_run=20, logAllData=True,
+                                arrival_rate=5, seed=42,
+                                compatFct=mm.stochastic_neighborSameType,
+                                typeGenerator=mm.randomType, numTypes=3,
+                                crit_input=4)
+            # Seeded runs leave the caller's global states alone
+            rng.seed(1)
+            random.seed(1)
+            sim.run(workers=workers)
+            self.assertEqual(rng.randint(1000000),
+                             rng.RandomState(1).randint(1000000))
+            self.assertEqual(random.random(), random.Random(1).random())
+            results.append(sim.welfare_matrix)
+        self.assertTrue((results[0] == results[1]).all())
+        self.assertTrue((results[0][:, -1] > 0).all())
+        self.assertFalse((results[0][0] == results[0][1]).all())
+
+    def test_parallel_brute_search(self):
+        """
+        Seeded brute search is reproducible whatever the number of workers
+        """
+        results = []
+        for workers in [1, 2]:
+            sim = mm.simulation(time_per_run=10, arrival_rate=5, seed=7,
+                                metaAlgorithm=mm.meta_periodic,
+                                compatFct=mm.stochastic_neighborSameType,
+                                typeGenerator=mm.randomType, numTypes=3,
+                                crit_input=4)
+            results.append(sim.brute_search(
+                [slice(1, 4)], metaParamNames=["period"],
+                objective=welfare, stochastic_samples=3,
+                stochastic_precision=1., workers=workers))
+        self.assertEqual(results[0], results[1])
+        # Default objectives can be sent to workers without cloudpickle
+        for method in (sim.single_run, sim.brute_search):
+            objective = inspect.signature(method).parameters[
+                "objective"].default
+            self.assertIs(pickle.loads(pickle.dumps(objective)), objective)
+
+    def test_seeded_market(self):
+        """
+        Markets with the same seed are reproducible
+        """
+        histories = []
+        for i in range(2):
+            market = mm.Market(arrival_rate=5, seed=3,
+                               success_prob=mm.coinFlip)
+            for j in range(30):
+                market.update(compatFct=mm.stochastic_neighborSameType,
+                              matchUtilFct=mm.utilRandom,
+                              typeGenerator=mm.randomType,
+                              typeGen2=mm.alternatingType,
+                              numTypes=3, crit_input=4)
+            histories.append((market.welfare,
+                              [a.name for a in market.matched],
+                              [(a.type, a.type2) for a in market.Agents]))
+        self.assertEqual(histories[0], histories[1])
+        self.assertGreater(len(histories[0][1]), 0)
+
+    def test_agent_pool(self):
+        """
+        AgentPool keeps its name index consistent and its agents
+        in arrival order through removals
+        """
+        agents = [mm.Agent(name=i)
+                  for i in range(6)]
+        pool = mm.AgentPool(agents)
+        pool.remove(agents[1])
+        pool.remove(agents[5])
+        pool.append(mm.Agent(name=6))
+        self.assertEqual(len(pool), 5)
+        self.assertEqual([a.name for a in pool], [0, 2, 3, 4, 6])
+        self.assertNotIn(agents[1], pool)
+        self.assertIn(3, pool)
+        for i, agent in enumerate(pool):
+            self.assertEqual(pool.index[agent.name], i)
+            self.assertIs(pool.get(agent.name), agent)
+        self.assertIsNone(pool.get(1))
+        self.assertEqual(set(pool.names()), {0, 2, 3, 4, 6})
+        with self.assertRaises(ValueError):
+            pool.remove(agents[1])
+
+    def test_columnar_pool(self):
+        """
+        Columnar and object agent pools run the same market
+        """
+        markets = [mm.Market(arrival_rate=6, seed=5, columnar=columnar)
+                   for columnar in (False, True)]
+        for market in markets:
+            for j in range(20):
+                market.update(compatFct=mm.neighborSameType,
+                              matchUtilFct=mm.utilRandom,
+                              typeGenerator=mm.randomType,
+                              numTypes=3, crit_input=4)
+        plain, columnar = markets
+        self.assertIsInstance(columnar.Agents, mm.ColumnarAgentPool)
+        self.assertEqual(plain.welfare, columnar.welfare)
+        self.assertEqual(plain.critical(), columnar.critical())
+        for pooled, left in ((plain.Agents, columnar.Agents),
+                             (plain.matched, columnar.matched),
+                             (plain.perished, columnar.perished)):
+            self.assertEqual(
+                [(a.name, a.type, a.sojourn, a.is_critical,
+                  a.time_to_critical) for a in pooled],
+                [(a.name, a.type, a.sojourn, a.is_critical,
+                  a.time_to_critical) for a in left])
+        self.assertTrue(all(a.pool is None for a in columnar.matched))
+        # Names are given in order of arrival
+        for market in markets:
+            names = [a.name for a in market.Agents]
+            self.assertEqual(names, sorted(names))
+            self.assertEqual(market.Agents.arrays().name.tolist(), names)
+        with self.assertRaises(AttributeError):
+            mm.Agent().extra = 1
+
+    def test_pool_indexes(self):
+        """
+        Critical and cohort indexes of the pool agree with scans
+        """
+        for columnar, meta in itertools.product(
+                (False, True),
+                (mm.meta_patient, mm.meta_greedy, mm.meta_agents_critical)):
+            market = mm.Market(arrival_rate=4, seed=6, columnar=columnar)
+            for j in range(25):
+                market.update(metaAlgorithm=meta,
+                              algoParams={"a": 2} if
+                              meta is mm.meta_patient else {},
+                              compatFct=mm.neighborSameType,
+                              typeGenerator=mm.randomType,
+                              numTypes=4, crit_input=3)
+                pool = market.Agents
+                self.assertEqual(
+                    {a.name for a in pool.critical_agents()},
+                    {a.name for a in pool if a.is_critical})
+                self.assertEqual(market.critical(),
+                                 sum(1 for a in pool if a.is_critical))
+                for sojourn in range(4):
+                    self.assertEqual(
+                        {a.name for a in pool.with_sojourn(sojourn)},
+                        {a.name for a in pool if a.sojourn == sojourn})
+            self.assertGreater(len(market.matched), 0)
+
+    def test_meta_agent_order(self):
+        """
+        Metaalgorithms pass agents to matching algorithms in
+        arrival order, like scans of the pool
+        """
+        def patient(Market, match, a=float("inf"), verbose=False,
+                    **kwargs):
+            AgentList = [ag for ag in Market.Agents if ag.is_critical or
+                         ag.sojourn == a]
+            return match(Market, AgentList, verbose=verbose, **kwargs)
+
+        def agents_critical(Market, match, agents=5, num_critical=5,
+                            verbose=False, **kwargs):
+            if len(Market.Agents) == agents:
+                return match(Market, Market.Agents, verbose=verbose,
+                             **kwargs)
+            if Market.critical() > num_critical:
+                AgentList = [ag for ag in Market.Agents if ag.is_critical]
+                return match(Market, AgentList, verbose=verbose, **kwargs)
+            return dict()
+
+        for (meta, scan, algoParams), algorithm in itertools.product(
+                ((mm.meta_patient, patient, {"a": 2}),
+                 (mm.meta_agents_critical, agents_critical,
+                  {"num_critical": 2})),
+                (mm.arbitraryMatch, mm.serialDictatorship)):
+            results = []
+            for metaAlgorithm in (meta, scan):
+                market = mm.Market(arrival_rate=5, seed=12)
+                for j in range(25):
+                    market.update(metaAlgorithm=metaAlgorithm,
+                                  algorithm=algorithm,
+                                  algoParams=algoParams,
+                                  compatFct=mm.neighborSameType,
+                                  matchUtilFct=mm.utilRandom,
+                                  typeGenerator=mm.randomType,
+                                  numTypes=2, crit_input=6)
+                results.append((market.welfare,
+                                [a.name for a in market.matched]))
+            self.assertEqual(results[0], results[1])
+            self.assertGreater(len(results[0][1]), 0)
+
+    def test_headless_market(self):
+        """
+        Markets only maintain a graph for algorithms needing it
+        The graph built on access matches a maintained one
+        """
+        markets = [mm.Market(arrival_rate=5, seed=4, graph=graph)
+                   for graph in (None, True)]
+        for market in markets:
+            for j in range(15):
+                market.update(algorithm=mm.arbitraryMatch,
+                              compatFct=mm.neighborSameType,
+                              matchUtilFct=mm.utilRandom,
+                              typeGenerator=mm.randomType,
+                              numTypes=3, crit_input=4)
+        headless, maintained = markets
+        self.assertIsNone(headless._graph)
+        self.assertFalse(headless.has_graph)
+        self.assertEqual(headless.welfare, maintained.welfare)
+        self.assertEqual(
+            sorted((u.name, v.name, w) for u, v, w
+                   in headless.Graph.edges(data="weight")),
+            sorted((u.name, v.name, w) for u, v, w
+                   in maintained.Graph.edges(data="weight")))
+        self.assertTrue(getattr(mm.max_weight_matching, "needs_graph"))
+
+    def test_sparse_graph(self):
+        """
+        Sparse graph backend tracks the same graph as NetworkX
+        """
+        graphs = []
+        for backend in ("networkx", "sparse"):
+            market = mm.Market(arrival_rate=5, seed=9, graph=True,
+                               graph_backend=backend)
+            for j in range(20):
+                market.update(metaAlgorithm=mm.meta_patient,
+                              compatFct=mm.neighborSameType,
+                              matchUtilFct=mm.utilRandom,
+                              typeGenerator=mm.randomType,
+                              numTypes=3, crit_input=4)
+            graphs.append(market.Graph)
+        dense, sparse = graphs
+        self.assertIsInstance(sparse, mm.SparseGraph)
+        self.assertLessEqual(sparse.n_dead * 2, len(sparse.agents))
+        self.assertEqual({a.name for a in dense.nodes()},
+                         {a.name for a in sparse.nodes()})
+        self.assertEqual(
+            sorted((u.name, v.name, w) for u, v, w
+                   in dense.edges(data="weight")),
+            sorted((u.name, v.name, w) for u, v, w
+                   in sparse.edges(data="weight")))
+        self.assertGreater(sparse.number_of_edges(), 0)
+        half = {a.name for a in sparse.nodes()[::2]}
+        induced = sparse.subgraph(
+            [a for a in sparse.nodes() if a.name in half]).to_networkx()
+        expected = dense.subgraph(
+            [a for a in dense.nodes() if a.name in half])
+        self.assertEqual(
+            sorted((u.name, v.name, w) for u, v, w
+                   in induced.edges(data="weight")),
+            sorted((u.name, v.name, w) for u, v, w
+                   in expected.edges(data="weight")))
+
+    def test_graph_matchings(self):
+        """
+        Graph matching algorithms return bilateral matches
+        between neighbors, without touching the market graph
+        """
+        for backend, algorithm in itertools.product(
+                ("networkx", "sparse"),
+                (mm.max_weight_matching, mm.max_cardinality_matching)):
+            market = mm.Market(arrival_rate=5, seed=10,
+                               graph_backend=backend)
+            for j in range(15):
+                before = sorted((u.name, v.name, w) for u, v, w in
+                                market.Graph.edges(data="weight"))
+                agents = market.Agents.critical_agents()
+                matches = algorithm(market, agents)
+                self.assertEqual(before, sorted(
+                    (u.name, v.name, w) for u, v, w in
+                    market.Graph.edges(data="weight")))
+                for name, match in matches.items():
+                    self.assertEqual(matches[match], name)
+                    agent = market.Agents.get(name)
+                    other = market.Agents.get(match)
+                    self.assertIn(agent, agents)
+                    self.assertTrue(match in agent.neighbors() or
+                                    name in other.neighbors())
+                market.update(algorithm=algorithm,
+                              metaAlgorithm=mm.meta_patient,
+                              compatFct=mm.neighborSameType,
+                              matchUtilFct=mm.utilRandom,
+                              typeGenerator=mm.randomType,
+                              numTypes=3, crit_input=3)
+            self.assertGreater(len(market.matched), 0)
+
+    def test_bipartite_matching(self):
+        """
+        Assignment-based bipartite matching finds the same
+        optimum as the blossom algorithm on two-sided markets
+        """
+        def weight(market, matches):
+            total = 0
+            for name, match in matches.items():
+                agent = market.Agents.get(name)
+                total += agent.match_util[match] * \
+                    agent.match_fail_prob[match]
+            return total
+
+        for matrix in (False, True):
+            market = mm.Market(arrival_rate=8, seed=11, matrix=matrix)
+            for j in range(6):
+                market.update(metaAlgorithm=mm.meta_patient,
+                              compatFct=lambda a, b, cutoff=1:
+                                  float(a.type != b.type),
+                              matchUtilFct=mm.utilRandom,
+                              typeGenerator=mm.randomType,
+                              numTypes=2, crit_input=8)
+            agents = list(market.Agents)
+            matches = mm.algorithms.bipartite_max_weight_matching(
+                market, agents, m=0, f=1)
+            blossom = mm.max_weight_matching(market, agents)
+            self.assertGreater(len(matches), 0)
+            self.assertEqual(len(matches), len(blossom))
+            self.assertAlmostEqual(weight(market, matches),
+                                   weight(market, blossom))
+            for name, match in matches.items():
+                self.assertEqual(matches[match], name)
+                self.assertNotEqual(market.Agents.get(name).type,
+                                    market.Agents.get(match).type)
+
+    def test_gale_shapley(self):
+        """
+        Deferred acceptance gives a stable matching
+        that respects the acceptors' capacities
+        """
+        def value(market, agent, name):
+            return agent.match_util[name] * agent.match_fail_prob[name]
+
+        market = mm.Market(arrival_rate=8, seed=5)
+        for j in range(6):
+            market.update(metaAlgorithm=mm.meta_patient,
+                          compatFct=lambda a, b, cutoff=1:
+                              float(a.type != b.type),
+                          matchUtilFct=mm.utilRandom,
+                          typeGenerator=mm.randomType,
+                          numTypes=2, crit_input=8)
+        agents = list(market.Agents)
+        men = [a for a in agents if a.type == 0]
+        fem = [a for a in agents if a.type == 1]
+        for capacity in (1, 2):
+            matches = mm.algorithms.gale_shapley(market, agents, m=0, f=1,
+                                                 capacity=capacity)
+            self.assertGreater(len(matches), 0)
+            admitted = {a.name: [m.name for m in men
+                                 if matches.get(m.name) == a.name]
+                        for a in fem}
+            for a in fem:
+                self.assertLessEqual(len(admitted[a.name]), capacity)
+            # No blocking pair: no man prefers a woman who has a free
+            # seat or holds a man she likes less than him
+            for m in men:
+                for a in fem:
+                    if a.name == matches.get(m.name):
+                        continue
+                    current = matches.get(m.name)
+                    if current is not None and value(market, m, a.name) <= \
+                            value(market, m, current):
+                        continue
+                    if len(admitted[a.name]) < capacity:
+                        self.assertLessEqual(value(market, m, a.name), 0)
+                        continue
+                    worst = min(value(market, a, n)
+                                for n in admitted[a.name])
+                    self.assertLessEqual(value(market, a, m.name), worst)
+
+    def test_TTC(self):
+        """
+        TTC matches the round-by-round top trading cycles
+        """
+        def reference(agents):
+            value = {a.name: {n: a.match_util[n] * p
+                              for n, p in a.match_fail_prob.items()
+                              if p > 0} for a in agents}
+            left = set(value)
+            matched = dict()
+            while left:
+                top = dict()
+                for name in list(left):
+                    choices = [n for n in value[name] if n in left]
+                    if choices:
+                        top[name] = max(choices, key=value[name].get)
+                    else:
+                        left.discard(name)
+                for name in list(top):
+                    # Follow top choices until a name repeats
+                    seen = list()
+                    while name in top and name not in seen:
+                        seen.append(name)
+                        name = top[name]
+                    if name in seen and name in left:
+                        cycle = seen[seen.index(name):]
+                        for n in cycle:
+                            matched[n] = top[n]
+                        left.difference_update(cycle)
+                top = {n: t for n, t in top.items() if n in left}
+            return matched
+
+        market = mm.Market(arrival_rate=10, seed=7)
+        for j in range(5):
+            market.update(metaAlgorithm=mm.meta_patient,
+                          compatFct=mm.stochastic_neighborSameType,
+                          matchUtilFct=mm.utilRandom,
+                          typeGenerator=mm.randomType,
+                          numTypes=2, crit_input=8)
+        agents = list(market.Agents)
+        matches = mm.TTC(market, agents)
+        self.assertGreater(len(matches), 0)
+        self.assertEqual(matches, reference(agents))
+        # Cycles: every matched agent is given to exactly one agent
+        self.assertEqual(sorted(matches.values()), sorted(matches))
+
+    def test_kidney_exchange(self):
+        """
+        Kidney exchange picks disjoint compatible cycles and chains
+        within the length bounds
+        """
+        def ndd(agent):
+            return agent.name % 8 == 0
+
+        market = mm.Market(arrival_rate=8, seed=9)
+        for j in range(6):
+            market.update(metaAlgorithm=mm.meta_patient,
+                          compatFct=mm.transplant_compatibility,
+                          typeGenerator=mm.blood_types,
+                          typeGen2=mm.blood_types, crit_input=8)
+        agents = list(market.Agents)
+        matches = mm.algorithms.kidney_exchange(market, agents, ndd=ndd,
+                                                solver="highs")
+        self.assertGreater(len(matches), 0)
+        self.assertEqual(len(market.kidney_timings), 1)
+        self.assertIn("solve", market.kidney_timings[0])
+        # Every agent receives at most once, altruists never receive
+        receivers = [v for v in matches.values() if v is not None]
+        self.assertEqual(len(receivers), len(set(receivers)))
+        walks = list()
+        for name in set(matches) - set(receivers):
+            # Chain: from its altruist to the last pair, who gives to nobody
+            walk = [name]
+            while matches[walk[-1]] is not None:
+                walk.append(matches[walk[-1]])
+            walks.append((walk, True))
+        chained = set(n for walk, _ in walks for n in walk)
+        for name in set(matches) - chained:
+            # Cycle: walk it once, from its lowest name
+            walk = [name]
+            while matches[walk[-1]] != name:
+                walk.append(matches[walk[-1]])
+            if min(walk) == name:
+                walks.append((walk, False))
+        for walk, chain in walks:
+            donors = [market.Agents.get(n) for n in walk]
+            if chain:
+                self.assertLessEqual(len(donors), 4)
+                self.assertEqual([a for a in donors if ndd(a)], donors[:1])
+                edges = zip(donors[:-1], donors[1:])
+            else:
+                self.assertLessEqual(len(donors), 3)
+                self.assertFalse(any(ndd(a) for a in donors))
+                edges = zip(donors, donors[1:] + donors[:1])
+            for a, b in edges:
+                self.assertIn(b.name, a.neighbors())
+        self.assertTrue(any(chain for _, chain in walks))
+
+    def test_kidney_chains(self):
+        """
+        Chains listed from fresh vertices are the chains
+        through fresh vertices, each listed once
+        """
+        from matchingmarkets.algorithms import kidney_solvers
+
+        rng.seed(3)
+        for trial in range(20):
+            n = 12
+            compatible = rng.random_sample((n, n)) < 0.3
+            diag = list(range(n))
+            compatible[diag, diag] = False
+            altruists = rng.choice(n, 3, replace=False).tolist()
+            compatible[:, altruists] = False
+            successors = [[j for j in range(n) if compatible[i, j]]
+                          for i in range(n)]
+            fresh = rng.choice(n, 4, replace=False).tolist()
+            for max_length in (1, 2, 3):
+                every = kidney_solvers.kidney_chains(successors, altruists,
+                                                     max_length)
+                found = kidney_solvers.kidney_chains(successors, altruists,
+                                                     max_length, fresh=fresh)
+                self.assertEqual(len(found), len(set(found)))
+                self.assertEqual(sorted(found),
+                                 sorted(c for c in every
+                                        if not set(c).isdisjoint(fresh)))
+
+    def test_kidney_model(self):
+        """
+        A kidney model kept across periods holds the same cycles
+        and chains as one built from scratch, and its pulp problem
+        has one variable per cycle or chain
+        """
+        from matchingmarkets.algorithms import kidney_solvers, pulp
+
+        def ndd(agent):
+            return agent.name % 8 == 0
+
+        def structures(model):
+            return sorted((sorted(key), round(weight, 9))
+                          for key, weight in model.weights.items())
+
+        market = mm.Market(arrival_rate=8, seed=4)
+        model = kidney_solvers.KidneyModel(ndd=ndd, solver="highs")
+        tracked = kidney_solvers.KidneyModel(
+            ndd=ndd, solver=pulp.COIN_CMD(warmStart=True))
+        for j in range(6):
+            market.update(algorithm=model,
+                          compatFct=mm.transplant_compatibility,
+                          typeGenerator=mm.blood_types,
+                          typeGen2=mm.blood_types, crit_input=4)
+            agents = list(market.Agents)
+            model.update(market, agents)
+            tracked.update(market, agents)
+            fresh = kidney_solvers.KidneyModel(ndd=ndd, solver="highs")
+            fresh.update(market, agents)
+            self.assertEqual(structures(model), structures(fresh))
+            self.assertEqual(structures(tracked), structures(fresh))
+            self.assertEqual(len(tracked.problem.variables()),
+                             len(tracked.weights))
+            for name, keys in tracked.members.items():
+                constraint = tracked.problem.constraints.get(
+                    "agent_" + str(name), {})
+                self.assertEqual(len(constraint), len(keys))
+        self.assertGreater(len(market.matched), 0)
+        self.assertEqual(len(market.kidney_timings), 6)
+        self.assertIsNotNone(market.kidney_timings.maxlen)
+
+        # Initial values are written as a cbc MIP start
+        variables = [pulp.LpVariable("x" + str(i), cat=pulp.LpBinary)
+                     for i in range(3)]
+        for i, var in enumerate(variables):
+            var.setInitialValue(i % 2)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "start.mst")
+            pulp.COIN_CMD().writesol(path, variables,
+                                     {v.name: "X" + str(i)
+                                      for i, v in enumerate(variables)})
+            with open(path) as f:
+                lines = f.read().splitlines()
+        self.assertEqual(len(lines), len(variables) + 1)
+        self.assertEqual(lines[2].split(), ["1", "X1", "1", "0"])
+
+    def test_kidney_model_markets(self):
+        """
+        A kidney model called on another market starts over
+        instead of keeping the cycles and chains of the first one
+        """
+        from matchingmarkets.algorithms import kidney_solvers
+
+        def structures(model):
+            return sorted((sorted(key), round(weight, 9))
+                          for key, weight in model.weights.items())
+
+        def arrivals(Mrkt, Agents, verbose=False):
+            return dict()
+
+        model = kidney_solvers.KidneyModel(solver="highs")
+        for seed in (4, 5, 4):
+            # Markets name their agents 0, 1, ... so the names overlap
+            market = mm.Market(arrival_rate=10, seed=seed)
+            for j in range(3):
+                market.update(algorithm=arrivals,
+                              compatFct=mm.transplant_compatibility,
+                              typeGenerator=mm.blood_types,
+                              typeGen2=mm.blood_types, crit_input=8)
+            model(market, list(market.Agents))
+            fresh = kidney_solvers.KidneyModel(solver="highs")
+            fresh.update(market, list(market.Agents))
+            self.assertEqual(structures(model), structures(fresh))
+            self.assertIs(model.market(), market)
+
+    def test_pulp_cbc_dll(self):
+        """
+        The in-process CBC solver solves a MIP from a MIP start,
+        it is only used when asked for
+        """
+        from matchingmarkets.algorithms import pulp
+        self.assertNotIsInstance(pulp.LpSolverDefault, pulp.CBC_DLL)
+        if not pulp.CBC_DLL.available():
+            self.skipTest("CBC library not found")
+        x = [pulp.LpVariable("x" + str(i), cat=pulp.LpBinary)
+             for i in range(4)]
+        problem = pulp.LpProblem("cbc_dll", pulp.LpMaximize)
+        problem += pulp.lpDot([3, 2, 2, 1], x)
+        problem += x[0] + x[1] <= 1, "a"
+        problem += x[0] + x[2] <= 1, "b"
+        for var in x:
+            var.setInitialValue(0)
+        status = problem.solve(pulp.CBC_DLL(warmStart=True))
+        self.assertEqual(status, pulp.LpStatusOptimal)
+        self.assertEqual([var.varValue for var in x], [0, 1, 1, 1])
+        self.assertAlmostEqual(pulp.value(problem.objective), 5)
+
+    def test_pulp_arrays(self):
+        """
+        The column arrays passed to solver dlls hold every constraint
+        coefficient once, including variables with repeated names
+        """
+        import ctypes
+        import numpy as np
+        from matchingmarkets.algorithms import pulp
+
+        rng.seed(5)
+        variables = [pulp.LpVariable("x" + str(i % 40), 0, 1)
+                     for i in range(50)]
+        dense = rng.randint(-3, 4, size=(30, 50)) * (rng.rand(30, 50) < .2)
+        problem = pulp.LpProblem("arrays", pulp.LpMaximize)
+        problem += pulp.lpSum(variables)
+        for i, row in enumerate(dense):
+            problem += pulp.LpConstraint(
+                pulp.LpAffineExpression([(variables[j], float(row[j]))
+                                         for j in np.flatnonzero(row)]),
+                pulp.LpConstraintLE, "c" + str(i), 1)
+        solver = pulp.LpSolver()
+        arrays = solver.getCplexStyleArrays(problem)
+        numels, starts, lengths, index, elements = arrays[2], *arrays[10:14]
+        self.assertEqual(numels, np.count_nonzero(dense))
+        rebuilt = np.zeros((len(dense), len(variables)))
+        column = {v: k for k, v in enumerate(variables)}
+        for v, j in solver.v2n.items():
+            for k in range(starts[j], starts[j] + lengths[j]):
+                row = int(solver.n2c[index[k]][1:])
+                rebuilt[row, column[v]] = elements[k]
+        np.testing.assert_array_equal(rebuilt, dense)
+
+        # The ctypes arrays are views of the matrix buffers
+        matrix = pulp.sparse.Matrix(2, 3)
+        matrix.addentries([1, 0, 1], [2, 0, 0], [1., 2., 3.])
+        numels, starts, lengths, index, elements = matrix.col_based_arrays()
+        self.assertEqual(starts.tolist(), [0, 2, 2, 3])
+        self.assertEqual(index.tolist(), [0, 1, 1])
+        self.assertEqual(elements.tolist(), [2., 3., 1.])
+        view = pulp.ctypesArrayView(index)
+        self.assertIsInstance(view[0], int)
+        self.assertEqual(ctypes.addressof(view), index.ctypes.data)
+        self.assertRaises(RuntimeError, matrix.add, 2, 0, 1.)
+
+    def test_pulp_writers(self):
+        """
+        MPS and LP writers stream the same model to files, text
+        and binary streams, with every coefficient in COLUMNS
+        """
+        import io
+        from matchingmarkets.algorithms import pulp
+
+        rng.seed(6)
+        variables = [pulp.LpVariable("x" + str(i), 0, 2, pulp.LpInteger)
+                     for i in range(20)]
+        problem = pulp.LpProblem("writers", pulp.LpMaximize)
+        problem += pulp.lpSum(variables)
+        for i in range(10):
+            chosen = rng.choice(20, size=5, replace=False)
+            problem += pulp.LpConstraint(
+                pulp.LpAffineExpression([(variables[j], float(j + 1))
+                                         for j in chosen]),
+                pulp.LpConstraintLE, "c" + str(i), 7)
+        for write in (problem.writeMPS, problem.writeLP):
+            text, binary = io.StringIO(), io.BytesIO()
+            write(text)
+            write(binary)
+            self.assertFalse(binary.closed)
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "model")
+                write(path)
+                with open(path) as f:
+                    self.assertEqual(f.read(), text.getvalue())
+            self.assertEqual(binary.getvalue().decode(), text.getvalue())
+        lines = text.getvalue().splitlines()
+        self.assertEqual(lines[-1], "End")
+        mps = io.StringIO()
+        problem.writeMPS(mps)
+        lines = mps.getvalue().splitlines()
+        entries = [line.split() for line in
+                   lines[lines.index("COLUMNS") + 1:lines.index("RHS")]
+                   if "MARKER" not in line]
+        coefficients = {(var, row): float(value)
+                        for var, row, value in entries if row != "OBJ"}
+        self.assertEqual(coefficients, {
+            (v.name, name): c for name, constraint in
+            problem.constraints.items() for v, c in constraint.items()})
+
+    def test_pulp_variable_index(self):
+        """
+        LpProblem.variables() is kept sorted as the objective and
+        constraints get variables, without rescanning them
+        """
+        from matchingmarkets.algorithms import pulp
+
+        def scanned(problem):
+            found = {id(v): v for v in problem.objective}
+            for constraint in problem.constraints.values():
+                found.update((id(v), v) for v in constraint)
+            return sorted(v.name for v in found.values())
+
+        x = [pulp.LpVariable("x" + str(i), 0, 1) for i in range(12)]
+        problem = pulp.LpProblem("index", pulp.LpMaximize)
+        problem += x[5] + x[3]
+        problem += x[7] + x[1] <= 1, "a"
+        variables = problem.variables()
+        self.assertEqual([v.name for v in variables], scanned(problem))
+        # Callers get their own list
+        variables.pop()
+        self.assertEqual([v.name for v in problem.variables()],
+                         scanned(problem))
+        # addterm, += on held expressions and item setting of constraints
+        problem.objective += x[9]
+        problem.constraints["a"] += x[0]
+        problem.constraints["b"] = x[11] + x[2] >= 1
+        problem.setObjective(problem.objective + x[4])
+        self.assertEqual([v.name for v in problem.variables()],
+                         scanned(problem))
+        self.assertIs(problem.variablesDict()["x11"], x[11])
+        copied = pickle.loads(pickle.dumps(problem))
+        copied.constraints["c"] = copied.objective <= 2
+        self.assertEqual([v.name for v in copied.variables()],
+                         scanned(copied))
+        problem.constraints["a"].pop(x[0])
+        problem.deleteVariables([x[0], x[9]])
+        self.assertEqual([v.name for v in problem.variables()],
+                         scanned(problem))
+        self.assertNotIn("x0", problem.variablesDict())
+        # Deep copies keep their own index
+        copied = copy.deepcopy(problem)
+        copied.constraints["b"].addterm(x[6], 1)
+        self.assertEqual([v.name for v in copied.variables()],
+                         scanned(copied))
+        self.assertNotIn("x6", problem.variablesDict())
+        # Replaced objectives and constraints leave the index alone
+        replaced = problem.objective
+        problem.setObjective(x[5] + x[3])
+        replaced.addterm(x[8], 1)
+        removed = problem.constraints.pop("b")
+        removed.addterm(x[10], 1)
+        self.assertNotIn("x8", problem.variablesDict())
+        self.assertNotIn("x10", problem.variablesDict())
+        # Item setting, update and setdefault on held expressions
+        # (like a rescan, the index keeps variables of the replaced
+        # objective and removed constraint)
+        problem.constraints["a"][x[2]] = 1
+        problem.constraints["a"].update({x[6]: 2})
+        problem.objective.setdefault(x[10], 3)
+        names = [v.name for v in problem.variables()]
+        self.assertEqual(names, sorted(names))
+        self.assertLessEqual(set(scanned(problem)), set(names))
+        colNames = pulp.LpSolver().getCplexStyleArrays(problem)[17]
+        self.assertEqual([name.decode() for name in colNames], names)
+        with tempfile.TemporaryDirectory() as tmp:
+            problem.writeMPS(os.path.join(tmp, "index.mps"))
+        # extend renames the variables it adds
+        other = pulp.LpProblem("other", pulp.LpMaximize)
+        other += x[0] + x[11] + x[1]
+        other += x[0] + x[11] <= 1, "d"
+        self.assertEqual([v.name for v in other.variables()],
+                         ["x0", "x1", "x11"])
+        problem.extend(other)
+        names = [v.name for v in problem.variables()]
+        self.assertEqual(names, sorted(names))
+        self.assertLessEqual(set(scanned(problem)), set(names))
+        self.assertEqual([v.name for v in other.variables()],
+                         scanned(other))
+        self.assertIs(problem.variablesDict()["otherx0"], x[0])
+
+    def test_pulp_bulk_expressions(self):
+        """
+        Expressions built from arrays, lpSum and lpDot hold the same
+        terms as expressions built term by term
+        """
+        import numpy as np
+        from matchingmarkets.algorithms import pulp
+
+        def terms(expression):
+            # c * v drops zero terms, addterm keeps them
+            return (sorted((v.name, c) for v, c in expression.items()
+                           if c != 0), expression.constant)
+
+        rng.seed(7)
+        x = [pulp.LpVariable("x" + str(i)) for i in range(30)]
+        picked = [x[i] for i in rng.randint(30, size=60)]
+        weights = rng.randint(-3, 4, size=60)
+        reference = pulp.LpAffineExpression(constant=2)
+        for v, c in zip(picked, weights.tolist()):
+            reference.addterm(v, c)
+        built = pulp.LpAffineExpression.fromArrays(picked, weights, 2)
+        self.assertEqual(terms(built), terms(reference))
+        reference.constant = 0
+        self.assertEqual(terms(pulp.lpSum(c * v for v, c in
+                                          zip(picked, weights.tolist()))),
+                         terms(pulp.lpSum([reference])))
+        dot = pulp.lpDot(weights.tolist(), picked)
+        self.assertEqual(terms(dot), terms(pulp.lpSum(
+            c * v for v, c in zip(picked, weights.tolist()))))
+        self.assertEqual(terms(pulp.lpSum([x[0], [x[1], 3], {"a": x[0]},
+                                           2 * x[2] + 1])),
+                         ([("x0", 2), ("x1", 1), ("x2", 2)], 4))
+        constraint = pulp.LpConstraint.fromArrays(
+            x[:3], np.array([1., 2., 3.]), pulp.LpConstraintLE, rhs=1)
+        self.assertEqual(constraint.sense, pulp.LpConstraintLE)
+        self.assertEqual(terms(constraint),
+                         ([("x0", 1.), ("x1", 2.), ("x2", 3.)], -1))
+        self.assertRaises(ValueError, pulp.LpAffineExpression.fromArrays,
+                          x[:3], [1, 2])
+
+    def test_import_time(self):
+        """
+        Importing the package leaves plotting, pulp and tests unloaded
+        and stays within the import time budget
+        """
+        code = ("import sys, time\n"
+                "start = time.perf_counter()\n"
+                "import matchingmarkets\n"
+                "print(time.perf_counter() - start)\n"
+                "print(' '.join(sys.modules))")
+        out = subprocess.run([sys.executable, "-c", code], check=True,
+                             capture_output=True, text=True).stdout
+        seconds, modules = out.splitlines()[-2:]
+        modules = modules.split()
+        for lazy in ("matplotlib", "matchingmarkets.algorithms.pulp",
+                     "matchingmarkets.tests"):
+            self.assertNotIn(lazy, modules)
+        self.assertLess(float(seconds), IMPORT_TIME_BUDGET)
+        self.assertTrue(callable(mm.pulp.LpProblem))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file